@@ -23,14 +23,19 @@ import fcntl
 import gdbm
 import glob
 import gzip
+import hashlib
+import itertools
+import json
 import locale
 import logging
 import logging.handlers
+import mmap
 import os
 import pty
 import re
 import signal
 import socket
+import sqlite3
 import stat
 import string
 import subprocess
@@ -159,8 +164,48 @@ HREF_BUG_UBUNTU = "https://bugs.launchpad.net/bugs/%s"
 MATCH_CVE="CVE-\d{4}-\d{4}"
 HREF_CVE="http://web.nvd.nist.gov/view/vuln/detail?vulnId=%s"
 
+# Regular expressions to parse the header and trailer lines of an entry
+# in a Debian changelog
+MATCH_CHANGELOG_HEADER = re.compile(r"(?P<source>.+) \((?P<version>.*)\) "
+                                    r"(?P<dist>.+); urgency=(?P<urgency>.+)")
+MATCH_CHANGELOG_TRAILER = re.compile(r"^ -- (?P<maintainer>.+) "
+                                     r"(?P<mail><.+>)  (?P<date>.+) "
+                                     r"(?P<offset>[-\+][0-9]+)$")
+
 SYNAPTIC_PIN_FILE = "/var/lib/synaptic/preferences"
 
+# Flags of the package classification which is used to apply the filters
+FLAG_INSTALLED = 1
+FLAG_SUPPORTED = 2
+FLAG_FREE = 4
+FLAG_NOT_FREE = 8
+FLAG_GUI = 16
+FLAG_COLLECTION = 32
+FLAG_DEVEL = 64
+
+# Map the filters to a flag and if the flag has to be set or unset
+FILTER_FLAG_MAP = {
+    enums.FILTER_INSTALLED: (FLAG_INSTALLED, True),
+    enums.FILTER_NOT_INSTALLED: (FLAG_INSTALLED, False),
+    enums.FILTER_SUPPORTED: (FLAG_SUPPORTED, True),
+    enums.FILTER_NOT_SUPPORTED: (FLAG_SUPPORTED, False),
+    enums.FILTER_FREE: (FLAG_FREE, True),
+    enums.FILTER_NOT_FREE: (FLAG_NOT_FREE, True),
+    enums.FILTER_GUI: (FLAG_GUI, True),
+    enums.FILTER_NOT_GUI: (FLAG_GUI, False),
+    enums.FILTER_COLLECTIONS: (FLAG_COLLECTION, True),
+    enums.FILTER_NOT_COLLECTIONS: (FLAG_COLLECTION, False),
+    enums.FILTER_DEVELOPMENT: (FLAG_DEVEL, True),
+    enums.FILTER_NOT_DEVELOPMENT: (FLAG_DEVEL, False),
+    }
+
+# Map the kind of a GStreamer what-provides query to the package record
+GSTREAMER_RECORD_MAP = {"encoder": "Gstreamer-Encoders",
+                        "decoder": "Gstreamer-Decoders",
+                        "urisource": "Gstreamer-Uri-Sources",
+                        "urisink": "Gstreamer-Uri-Sinks",
+                        "element": "Gstreamer-Elements"}
+
 # After the given amount of seconds without any updates on the console or
 # progress kill the installation
 TIMEOUT_IDLE_INSTALLATION = 10 * 60 * 10000
@@ -177,6 +222,15 @@ try:
 except locale.Error:
     pklog.debug("Failed to unset LC_TIME")
 
+def get_modalias_prefix(modalias):
+    """Return the bus of a modalias or "*" if the pattern could match any
+    bus, e.g. "pci" for "pci:v00008086d*".
+    """
+    prefix = modalias.split(":")[0]
+    if prefix == modalias or "*" in prefix or "?" in prefix or "[" in prefix:
+        return "*"
+    return prefix
+
 def catch_pkerror(func):
     """Decorator to catch a backend error and report
     it correctly to the daemon.
@@ -231,6 +285,412 @@ class PKError(Exception):
         return "%s: %s" % (self.enum, self.msg)
 
 
+def open_index_database(path, schema):
+    """Return a connection to the sqlite database of an index, after
+    executing the given statements to create its tables.
+
+    If the database cannot be opened an in-memory one is returned, so that
+    the index only lives as long as the backend.
+    """
+    try:
+        db = sqlite3.connect(path)
+        for statement in schema:
+            db.execute(statement)
+        db.commit()
+    except sqlite3.Error as error:
+        pklog.warning("Failed to open the index %s: %s" % (path, error))
+        db = sqlite3.connect(":memory:")
+        for statement in schema:
+            db.execute(statement)
+        db.commit()
+    db.text_factory = str
+    return db
+
+
+class DpkgFileIndex(object):
+
+    """Persistent index of the files which have been installed by dpkg.
+
+    Every path of the /var/lib/dpkg/info/*.list files is stored together
+    with its basename and the package shipping it, so that a file search
+    only needs a few index lookups instead of reading the file lists of
+    all installed packages. A list file is only read again if its
+    modification time has changed.
+    """
+
+    def __init__(self, path, info_dir):
+        self._info_dir = info_dir
+        self._info_mtime = None
+        self._db = open_index_database(path, [
+            "CREATE TABLE IF NOT EXISTS lists "
+            "(package TEXT PRIMARY KEY, mtime REAL)",
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT, basename TEXT, package TEXT)",
+            "CREATE INDEX IF NOT EXISTS files_path ON files (path)",
+            "CREATE INDEX IF NOT EXISTS files_basename ON files (basename)",
+            "CREATE INDEX IF NOT EXISTS files_package ON files (package)",
+            ])
+
+    def update(self):
+        """Reindex the list files which have been added, changed or removed
+        since the last update.
+        """
+        # dpkg replaces the list files by renaming, so the directory
+        # changes whenever a package gets installed, upgraded or removed
+        try:
+            info_mtime = os.stat(self._info_dir).st_mtime
+        except OSError:
+            return
+        if info_mtime == self._info_mtime:
+            return
+        current = {}
+        for fname in os.listdir(self._info_dir):
+            if not fname.endswith(".list"):
+                continue
+            try:
+                current[fname[:-5]] = os.stat(os.path.join(self._info_dir,
+                                                           fname)).st_mtime
+            except OSError:
+                continue
+        indexed = dict(self._db.execute("SELECT package, mtime FROM lists"))
+        with self._db:
+            for package in set(indexed) - set(current):
+                self._remove_package(package)
+            for package, mtime in current.iteritems():
+                if indexed.get(package) != mtime:
+                    self._add_package(package, mtime)
+        self._info_mtime = info_mtime
+
+    def _remove_package(self, package):
+        self._db.execute("DELETE FROM files WHERE package = ?", (package,))
+        self._db.execute("DELETE FROM lists WHERE package = ?", (package,))
+
+    def _add_package(self, package, mtime):
+        self._remove_package(package)
+        try:
+            with open(os.path.join(self._info_dir,
+                                   "%s.list" % package)) as list_file:
+                paths = [line.rstrip("\n") for line in list_file]
+        except IOError:
+            return
+        self._db.executemany("INSERT INTO files VALUES (?, ?, ?)",
+                             ((path, os.path.basename(path), package)
+                              for path in paths if path))
+        self._db.execute("INSERT INTO lists VALUES (?, ?)", (package, mtime))
+
+    def find(self, filenames):
+        """Return the names of the packages which ship any of the files.
+
+        An absolute filename has to match the whole path, otherwise it has
+        to match the end of the path.
+        """
+        names = set()
+        for filename in filenames:
+            if filename.startswith("/"):
+                for (package,) in self._db.execute("SELECT package FROM files "
+                                                   "WHERE path = ?",
+                                                   (filename,)):
+                    names.add(package)
+            else:
+                suffix = "/%s" % filename
+                for package, path in self._db.execute(
+                                        "SELECT package, path FROM files "
+                                        "WHERE basename = ?",
+                                        (os.path.basename(filename),)):
+                    if path.endswith(suffix):
+                        names.add(package)
+        # Strip the architecture qualifier of multi-arch list files
+        return set(name.split(":")[0] for name in names)
+
+
+class ProvidesIndex(object):
+
+    """Persistent index of the modaliases and GStreamer capabilities of
+    the packages in the cache.
+
+    The modalias patterns are grouped by their bus prefix (e.g. "pci") and
+    the GStreamer records by the GStreamer version and record, so that a
+    what-provides query only has to match a small number of candidates.
+    The index is rebuilt if the cache key passed to update changes.
+    """
+
+    def __init__(self, path):
+        self._db = open_index_database(path, [
+            "CREATE TABLE IF NOT EXISTS meta "
+            "(key TEXT PRIMARY KEY, value TEXT)",
+            "CREATE TABLE IF NOT EXISTS modaliases "
+            "(prefix TEXT, pattern TEXT, package TEXT)",
+            "CREATE TABLE IF NOT EXISTS gstreamer "
+            "(version TEXT, record TEXT, data TEXT, "
+            "package TEXT)",
+            "CREATE INDEX IF NOT EXISTS modaliases_prefix "
+            "ON modaliases (prefix)",
+            "CREATE INDEX IF NOT EXISTS gstreamer_version "
+            "ON gstreamer (version, record)",
+            ])
+
+    def update(self, cache, cache_key):
+        """Rebuild the index from the given apt.Cache if the cache key
+        differs from the one the index was built for.
+        """
+        for (value,) in self._db.execute("SELECT value FROM meta "
+                                         "WHERE key = 'cache'"):
+            if value == cache_key:
+                return
+        pklog.debug("Building the provides index")
+        system_architecture = apt_pkg.get_architectures()[0]
+        modaliases = []
+        gstreamer = []
+        for pkg in cache:
+            # skip foreign architectures, we usually only want native
+            # driver packages
+            if (pkg.candidate and
+                pkg.candidate.architecture in ("all", system_architecture) and
+                "Modaliases" in pkg.candidate.record):
+                modaliases.extend(self._parse_modaliases(pkg))
+            if pkg.installed:
+                version = pkg.installed
+            elif pkg.candidate:
+                version = pkg.candidate
+            else:
+                continue
+            if not "Gstreamer-Version" in version.record:
+                continue
+            for record in GSTREAMER_RECORD_MAP.values():
+                if record in version.record:
+                    gstreamer.append((version.record["Gstreamer-Version"],
+                                      record, version.record[record],
+                                      pkg.name))
+        with self._db:
+            self._db.execute("DELETE FROM modaliases")
+            self._db.execute("DELETE FROM gstreamer")
+            self._db.executemany("INSERT INTO modaliases VALUES (?, ?, ?)",
+                                 modaliases)
+            self._db.executemany("INSERT INTO gstreamer VALUES (?, ?, ?, ?)",
+                                 gstreamer)
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES "
+                             "('cache', ?)", (cache_key,))
+
+    def _parse_modaliases(self, pkg):
+        """Return the (prefix, pattern, package) rows of the Modaliases
+        header of the candidate of the given package.
+        """
+        header = pkg.candidate.record["Modaliases"]
+        rows = []
+        try:
+            for part in header.split(")"):
+                part = part.strip(", ")
+                if not part:
+                    continue
+                module, lst = part.split("(")
+                for alias in lst.split(","):
+                    alias = alias.strip()
+                    rows.append((get_modalias_prefix(alias), alias,
+                                 pkg.name))
+        except ValueError:
+            pklog.warning("Package %s has invalid modalias header: %s" % (
+                pkg.name, header))
+        return rows
+
+    def find_modalias(self, modalias):
+        """Return the names of the packages with a modalias pattern which
+        matches the given modalias.
+        """
+        names = set()
+        for package, pattern in self._db.execute(
+                                    "SELECT package, pattern FROM modaliases "
+                                    "WHERE prefix IN (?, '*')",
+                                    (get_modalias_prefix(modalias),)):
+            if package not in names and fnmatch.fnmatch(modalias, pattern):
+                names.add(package)
+        return names
+
+    def get_gstreamer_records(self, gst_version, record):
+        """Return (package name, record data) tuples of the packages which
+        provide the given record for the given GStreamer version.
+        """
+        return self._db.execute("SELECT package, data FROM gstreamer "
+                                "WHERE version = ? AND record = ?",
+                                (gst_version, record)).fetchall()
+
+
+class ContentsIndex(object):
+
+    """Index of the files in the Contents files of the repositories.
+
+    For each Contents file two tables are written: one with the lines
+    "path<TAB>packages" sorted by path and one with the lines
+    "basename<TAB>path<TAB>packages" sorted by basename. The tables are
+    plain text, so they can be memory mapped and searched with a binary
+    search instead of decompressing and scanning the Contents files.
+    """
+
+    def __init__(self, index_dir):
+        self._index_dir = index_dir
+
+    def _get_table_names(self, contents_files):
+        """Return a dict which maps the table names to the Contents files."""
+        tables = {}
+        for path in contents_files:
+            # Contents files of the same name can be found in different
+            # directories, so the directory is part of the table name
+            directory = os.path.dirname(path).strip("/").replace("/", "_")
+            name = "%s_%s" % (directory,
+                              os.path.basename(path).rsplit(".", 1)[0])
+            tables[name] = path
+        return tables
+
+    def _is_table_current(self, name, path):
+        """Return True if the tables of the Contents file are up to date."""
+        table = os.path.join(self._index_dir, "%s.basenames" % name)
+        return (os.path.exists(table) and
+                os.path.getmtime(table) >= os.path.getmtime(path))
+
+    def is_current(self, contents_files):
+        """Return True if there are up to date tables for exactly the
+        given Contents files.
+        """
+        tables = self._get_table_names(contents_files)
+        try:
+            indexed = set(fname.rsplit(".", 1)[0]
+                          for fname in os.listdir(self._index_dir))
+            if indexed != set(tables):
+                return False
+            for name, path in tables.items():
+                if not self._is_table_current(name, path):
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def update(self, contents_files):
+        """Rebuild the tables of the Contents files which have been changed
+        since and remove the tables of the ones which are gone.
+        """
+        if not os.path.isdir(self._index_dir):
+            os.makedirs(self._index_dir)
+        tables = self._get_table_names(contents_files)
+        for name, path in tables.items():
+            if self._is_table_current(name, path):
+                continue
+            pklog.debug("Indexing %s" % path)
+            self._build_tables(path, name)
+        for fname in os.listdir(self._index_dir):
+            if fname.rsplit(".", 1)[0] not in tables:
+                os.remove(os.path.join(self._index_dir, fname))
+
+    def _build_tables(self, path, name):
+        """Write the sorted tables of a gzipped Contents file."""
+        paths_table = os.path.join(self._index_dir, "%s.paths" % name)
+        basenames_table = os.path.join(self._index_dir, "%s.basenames" % name)
+        # Use sort to keep the memory usage low, the C locale sorts
+        # byte-wise like python compares strings
+        env = {"LC_ALL": "C", "PATH": os.environ.get("PATH", "/usr/bin:/bin")}
+        sort_paths = subprocess.Popen(["sort", "-o", "%s.new" % paths_table],
+                                      stdin=subprocess.PIPE, env=env)
+        sort_basenames = subprocess.Popen(["sort", "-o",
+                                           "%s.new" % basenames_table],
+                                          stdin=subprocess.PIPE, env=env)
+        contents = gzip.open(path)
+        try:
+            # Older Contents files start with a description, which ends
+            # with the "FILE LOCATION" header
+            lines = list(itertools.islice(contents, 50))
+            for count, line in enumerate(lines):
+                if re.match("^FILE\s+LOCATION", line):
+                    lines = lines[count + 1:]
+                    break
+            for line in itertools.chain(lines, contents):
+                try:
+                    file_path, locations = line.rstrip("\n").rsplit(None, 1)
+                except ValueError:
+                    continue
+                file_path = "/" + file_path.lstrip("/")
+                packages = ",".join(location.split("/")[-1]
+                                    for location in locations.split(","))
+                sort_paths.stdin.write("%s\t%s\n" % (file_path, packages))
+                sort_basenames.stdin.write(
+                    "%s\t%s\t%s\n" % (os.path.basename(file_path),
+                                        file_path, packages))
+        finally:
+            contents.close()
+            sort_paths.stdin.close()
+            sort_basenames.stdin.close()
+            sort_paths.wait()
+            sort_basenames.wait()
+        if sort_paths.returncode or sort_basenames.returncode:
+            pklog.warning("Failed to index %s" % path)
+            return
+        os.rename("%s.new" % paths_table, paths_table)
+        # The basenames table is written last, since its modification time
+        # tells if the tables are up to date
+        os.rename("%s.new" % basenames_table, basenames_table)
+
+    def _lookup(self, table, key):
+        """Return the fields following the key of all lines of the sorted
+        table which start with the given key.
+        """
+        try:
+            with open(table, "rb") as table_file:
+                if not os.fstat(table_file.fileno()).st_size:
+                    return []
+                data = mmap.mmap(table_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return []
+        prefix = "%s\t" % key
+        try:
+            # Find the first line which isn't lower than the prefix
+            low, high = 0, len(data)
+            while low < high:
+                middle = (low + high) // 2
+                start = data.rfind("\n", 0, middle) + 1
+                end = data.find("\n", start)
+                if data[start:end] < prefix:
+                    low = end + 1
+                else:
+                    high = start
+            results = []
+            while low < len(data):
+                end = data.find("\n", low)
+                line = data[low:end]
+                if not line.startswith(prefix):
+                    break
+                results.append(line[len(prefix):].split("\t"))
+                low = end + 1
+            return results
+        finally:
+            data.close()
+
+    def find(self, filenames):
+        """Return the names of the packages which ship any of the files.
+
+        An absolute filename has to match the whole path, otherwise it has
+        to match the end of the path.
+        """
+        try:
+            tables = set(fname.rsplit(".", 1)[0]
+                         for fname in os.listdir(self._index_dir)
+                         if fname.endswith(".basenames"))
+        except OSError:
+            return set()
+        names = set()
+        for table in tables:
+            table = os.path.join(self._index_dir, table)
+            for filename in filenames:
+                if filename.startswith("/"):
+                    for (packages,) in self._lookup("%s.paths" % table,
+                                                    filename):
+                        names.update(packages.split(","))
+                    continue
+                suffix = "/%s" % filename
+                for path, packages in self._lookup("%s.basenames" % table,
+                                                   os.path.basename(filename)):
+                    if path.endswith(suffix):
+                        names.update(packages.split(","))
+        return names
+
+
 class PackageKitOpProgress(apt.progress.base.OpProgress):
 
     """Handle the cache opening progress."""
@@ -628,6 +1088,18 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         signal.signal(signal.SIGQUIT, self._sigquit)
         self._cache = None
         self._last_cache_refresh = None
+        self._file_index = None
+        self._reverse_depends = None
+        self._provides_index = None
+        self._contents_index = None
+        self._changelog_details = {}
+        self._changelog_children = []
+        self._package_classes = {}
+        self._filter_masks = {}
+        self._pin_files = None
+        self._marked = False
+        self._status_mtime = None
+        self._status_digest = None
         apt_pkg.init_config()
         apt_pkg.config.set("DPkg::Options::", '--force-confdef')
         apt_pkg.config.set("DPkg::Options::", '--force-confold')
@@ -641,7 +1113,8 @@ class PackageKitAptBackend(PackageKitBaseBackend):
     def search_file(self, filters, filenames):
         """Search for files in packages.
 
-        Works only for installed files if apt-file isn't installed.
+        Works only for installed files if the index of the Contents files
+        isn't up to date and apt-file isn't installed.
         """
         pklog.info("Searching for file: %s" % filenames)
         self.status(enums.STATUS_QUERY)
@@ -649,55 +1122,47 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         self._check_init(progress=False)
         self.allow_cancel(True)
 
-        result_names = set()
-        # Optionally make use of apt-file's Contents cache to search for not
-        # installed files. But still search for installed files additionally
-        # to make sure that we provide up-to-date results
-        if (os.path.exists("/usr/bin/apt-file") and
-            enums.FILTER_INSTALLED not in filters):
-            #FIXME: Make use of rapt-file on Debian if the network is available
-            #FIXME: Show a warning to the user if the apt-file cache is several
-            #       weeks old
-            pklog.debug("Using apt-file")
-            filenames_regex = []
-            for filename in filenames:
-                if filename.startswith("/"):
-                    pattern = "^%s$" % filename[1:].replace("/", "\/")
-                else:
-                    pattern = "\/%s$" % filename
-                filenames_regex.append(pattern)
-            cmd = ["/usr/bin/apt-file", "--regexp", "--non-interactive",
-                   "--package-only", "find", "|".join(filenames_regex)]
-            pklog.debug("Calling: %s" % cmd)
-            apt_file = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-            stdout, stderr = apt_file.communicate()
-            if apt_file.returncode == 0:
+        try:
+            result_names = set()
+            # Make use of the index of the Contents files to search for
+            # not installed files. But still search for installed files
+            # additionally to make sure that we provide up-to-date results
+            if enums.FILTER_INSTALLED not in filters:
+                #FIXME: Show a warning to the user if the Contents files are
+                #       several weeks old
                 #FIXME: Actually we should check if the file is part of the
                 #       candidate, e.g. if unstable and experimental are
                 #       enabled and a file would only be part of the
                 #       experimental version
-                result_names.update(stdout.split())
-                self._emit_visible_packages_by_name(filters, result_names)
-            else:
-                raise PKError(enums.ERROR_INTERNAL_ERROR,
-                              format_string("%s %s" % (stdout, stderr)))
-        # Search for installed files
-        filenames_regex = []
-        for filename in filenames:
-            if filename.startswith("/"):
-                pattern = "^%s$" % filename.replace("/", "\/")
-            else:
-                pattern = ".*\/%s$" % filename
-            filenames_regex.append(pattern)
-        files_pattern = re.compile("|".join(filenames_regex))
-        for pkg in self._cache:
-            if pkg.name in result_names:
-                continue
-            for installed_file in pkg.installed_files:
-                if files_pattern.match(installed_file):
-                    self._emit_visible_package(filters, pkg)
-                    break
+                # The index is only built by refresh_cache, since that can
+                # take minutes, so fall back to apt-file until it caught up
+                contents_files = self._get_contents_files()
+                index = self._get_contents_index()
+                if contents_files and index.is_current(contents_files):
+                    names = index.find(filenames)
+                elif os.path.exists("/usr/bin/apt-file"):
+                    names = self._search_apt_file(filenames)
+                else:
+                    names = set()
+                result_names.update(name for name in names
+                                    if name in self._cache)
+                self._emit_visible_packages_by_name(filters,
+                                                    sorted(result_names))
+            # Search for installed files
+            if not self._file_index:
+                status = apt_pkg.config.find_file("Dir::State::status")
+                self._file_index = DpkgFileIndex(
+                    os.path.join(apt_pkg.config.find_dir("Dir::Cache"),
+                                 "packagekit-files.db"),
+                    os.path.join(os.path.dirname(status), "info"))
+            self._file_index.update()
+            for name in sorted(self._file_index.find(filenames) -
+                               result_names):
+                if name in self._cache:
+                    self._emit_visible_package(filters, self._cache[name])
+        except (IOError, OSError) as error:
+            raise PKError(enums.ERROR_INTERNAL_ERROR,
+                          format_string(str(error)))
 
     @catch_pkerror
     def search_group(self, filters, groups):
@@ -885,37 +1350,17 @@ class PackageKitAptBackend(PackageKitBaseBackend):
     @catch_pkerror
     def get_update_detail(self, pkg_ids):
         """Get details about updates."""
-        def get_bug_urls(changelog):
-            """Return a list of urls pointing to closed bugs in the
-            changelog.
-            """
-            urls = []
-            for r in re.findall(MATCH_BUG_CLOSES_DEBIAN, changelog,
-                                re.IGNORECASE | re.MULTILINE):
-                urls.extend([HREF_BUG_DEBIAN % bug for bug in \
-                             re.findall(MATCH_BUG_NUMBERS, r)])
-            for r in re.findall(MATCH_BUG_CLOSES_UBUNTU, changelog,
-                                re.IGNORECASE | re.MULTILINE):
-                urls.extend([HREF_BUG_UBUNTU % bug for bug in \
-                             re.findall(MATCH_BUG_NUMBERS, r)])
-            return urls
-
-        def get_cve_urls(changelog):
-            """Return a list of urls pointing to CVEs reports referred to in
-            the changelog.
-            """
-            return [HREF_CVE % c for c in re.findall(MATCH_CVE, changelog,
-                                                     re.MULTILINE)]
-
         pklog.info("Get update details of %s" % pkg_ids)
         self.status(enums.STATUS_DOWNLOAD_CHANGELOG)
         self.percentage(0)
         self.allow_cancel(True)
         self._check_init(progress=False)
+        pkgs = [self._get_package_by_id(pkg_id) for pkg_id in pkg_ids]
+        # Download the missing changelogs at the same time
+        self._prefetch_changelogs(pkgs)
         total = len(pkg_ids)
-        for count, pkg_id in enumerate(pkg_ids):
+        for count, (pkg_id, pkg) in enumerate(zip(pkg_ids, pkgs)):
             self.percentage(count * 100 / total)
-            pkg = self._get_package_by_id(pkg_id)
             # FIXME add some real data
             if pkg.installed.origins:
                 installed_origin = pkg.installed.origins[0].label
@@ -927,86 +1372,19 @@ class PackageKitAptBackend(PackageKitBaseBackend):
             obsoletes = ""
             vendor_url = ""
             restart = "none"
-            update_text = ""
             state = ""
-            issued = ""
-            updated = ""
             #FIXME: make this more configurable. E.g. a dbus update requires
             #       a reboot on Ubuntu but not on Debian
             if pkg.name.startswith("linux-image-") or \
                pkg.name in ["libc6"]:
                 restart == enums.RESTART_SYSTEM
-            #FIXME: Should be part of python-apt
-            changelog_dir = apt_pkg.config.find_dir("Dir::Cache::Changelogs")
-            if changelog_dir == "/":
-                changelog_dir = os.path.join(apt_pkg.config.find_dir("Dir::"
-                                                                     "Cache"),
-                                             "Changelogs")
-            filename = os.path.join(changelog_dir,
-                                    "%s_%s.gz" % (pkg.name,
-                                                  pkg.candidate.version))
-            changelog_raw = ""
-            if os.path.exists(filename):
-                pklog.debug("Reading changelog from cache")
-                changelog_file = gzip.open(filename, "rb")
-                try:
-                    changelog_raw = changelog_file.read().decode("UTF-8")
-                finally:
-                    changelog_file.close()
-            if not changelog_raw:
-                pklog.debug("Downloading changelog")
-                changelog_raw = pkg.get_changelog()
-                # The internal download error string of python-apt ist not
-                # provided as unicode object
-                if not isinstance(changelog_raw, unicode):
-                    changelog_raw = changelog_raw.decode("UTF-8")
-                else:
-                    # Write the changelog to the cache
-                    if not os.path.exists(changelog_dir):
-                        os.makedirs(changelog_dir)
-                    # Remove obsolete cached changelogs
-                    pattern = os.path.join(changelog_dir, "%s_*.gz" % pkg.name)
-                    for old_changelog in glob.glob(pattern):
-                        os.remove(os.path.join(changelog_dir, old_changelog))
-                    with gzip.open(filename, mode="wb") as changelog_file:
-                        changelog_file.write(changelog_raw.encode("UTF-8"))
-            # Convert the changelog to markdown syntax
-            changelog = ""
-            for line in changelog_raw.split("\n"):
-                if line == "":
-                    changelog += " \n"
-                else:
-                    changelog += "    %s  \n" % line
-                if line.startswith(pkg.candidate.source_name):
-                    match = re.match(r"(?P<source>.+) \((?P<version>.*)\) "
-                                      "(?P<dist>.+); urgency=(?P<urgency>.+)",
-                                     line)
-                    update_text += "%s\n%s\n\n" % (match.group("version"),
-                                                    "=" * \
-                                                    len(match.group("version")))
-                elif line.startswith("  "):
-                    update_text += "  %s  \n" % line
-                elif line.startswith(" --"):
-                    #FIXME: Add %z for the time zone - requires Python 2.6
-                    update_text += "  \n"
-                    match = re.match("^ -- (?P<maintainer>.+) (?P<mail><.+>)  "
-                                     "(?P<date>.+) (?P<offset>[-\+][0-9]+)$",
-                                     line)
-                    date = datetime.datetime.strptime(match.group("date"),
-                                                      "%a, %d %b %Y %H:%M:%S")
-
-                    issued = date.isoformat()
-                    if not updated:
-                        updated = date.isoformat()
-            if issued == updated:
-                updated = ""
-            bugzilla_url = ";;".join(get_bug_urls(changelog))
-            cve_url = ";;".join(get_cve_urls(changelog))
+            details = self._get_changelog_details(pkg)
             self.update_detail(pkg_id, updates, obsoletes, vendor_url,
-                               bugzilla_url, cve_url, restart,
-                               format_string(update_text),
-                               format_string(changelog),
-                               state, issued, updated)
+                               details["bugzilla_url"], details["cve_url"],
+                               restart,
+                               format_string(details["update_text"]),
+                               format_string(details["changelog"]),
+                               state, details["issued"], details["updated"])
 
     @catch_pkerror
     def get_details(self, pkg_ids):
@@ -1058,6 +1436,7 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         self.allow_cancel(False)
         self.percentage(0)
         self._check_init(fail_broken=False)
+        self._marked = True
         try:
             self._cache._depcache.fix_broken()
         except SystemError:
@@ -1076,6 +1455,7 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         self.allow_cancel(False)
         self.percentage(0)
         self._check_init(fail_broken=False)
+        self._marked = True
         try:
             self._cache._depcache.fix_broken()
         except SystemError:
@@ -1627,6 +2007,11 @@ class PackageKitAptBackend(PackageKitBaseBackend):
             self.message(enums.MESSAGE_REPO_METADATA_DOWNLOAD_FAILED,
                          format_string(str(error)))
         self._open_cache(start=95, end=100)
+        # Index the Contents files for searching not installed files
+        try:
+            self._get_contents_index().update(self._get_contents_files())
+        except (IOError, OSError) as error:
+            pklog.warning("Failed to index the Contents files: %s" % error)
         self.percentage(100)
 
     @catch_pkerror
@@ -1666,7 +2051,8 @@ class PackageKitAptBackend(PackageKitBaseBackend):
     def get_depends(self, filters, ids, recursive):
         """Emit all dependencies of the given package ids.
 
-        Doesn't support recursive dependency resolution.
+        If recursive is set the dependencies of the dependencies are
+        emitted too, until the whole closure has been walked.
         """
         def emit_blocked_dependency(base_dependency, pkg=None,
                                     filters=[]):
@@ -1693,34 +2079,55 @@ class PackageKitAptBackend(PackageKitBaseBackend):
             self.package("%s;%s;;" % (base_dependency.name, version),
                          enums.INFO_BLOCKED, summary)
 
-        def check_dependency(pkg, base_dep):
-            """Check if the given apt.package.Package can satisfy the
-            BaseDepenendcy and emit the corresponding package signals.
+        def get_satisfying_version(pkg, base_dep):
+            """Return the apt.package.Version of the given
+            apt.package.Package which satisfies the BaseDependency or None.
             """
-            if not self._is_package_visible(pkg, filters):
-                return
-            if base_dep.version:
-                satisfied = False
-                # Sort the version list to check the installed
-                # and candidate before the other ones
-                ver_list = list(pkg.versions)
-                if pkg.installed:
-                    ver_list.remove(pkg.installed)
-                    ver_list.insert(0, pkg.installed)
-                if pkg.candidate:
-                    ver_list.remove(pkg.candidate)
-                    ver_list.insert(0, pkg.candidate)
-                for dep_ver in ver_list:
-                    if apt_pkg.check_dep(dep_ver.version,
-                                         base_dep.relation,
-                                         base_dep.version):
-                        self._emit_pkg_version(dep_ver)
-                        satisfied = True
-                        break
-                if not satisfied:
-                    emit_blocked_dependency(base_dep, pkg, filters)
+            if not base_dep.version:
+                if not pkg.is_installed and pkg.candidate:
+                    return pkg.candidate
+                return pkg.installed
+            # Sort the version list to check the installed
+            # and candidate before the other ones
+            ver_list = list(pkg.versions)
+            if pkg.installed:
+                ver_list.remove(pkg.installed)
+                ver_list.insert(0, pkg.installed)
+            if pkg.candidate:
+                ver_list.remove(pkg.candidate)
+                ver_list.insert(0, pkg.candidate)
+            for dep_ver in ver_list:
+                if apt_pkg.check_dep(dep_ver.version,
+                                     base_dep.relation,
+                                     base_dep.version):
+                    return dep_ver
+            return None
+
+        def resolve_dependency(base_dep):
+            """Return a list of (package, version) tuples which could
+            satisfy the given BaseDependency. The version is None if the
+            package cannot satisfy it and the package is None if there
+            isn't any package of the required name.
+
+            The result is cached for each name, relation and version, and
+            virtual packages are only looked up once.
+            """
+            key = (base_dep.name, base_dep.relation, base_dep.version)
+            if key in resolved:
+                return resolved[key]
+            if self._cache.is_virtual_package(base_dep.name):
+                if base_dep.name not in providers:
+                    providers[base_dep.name] = \
+                        self._cache.get_providing_packages(base_dep.name)
+                pkgs = providers[base_dep.name]
+            elif base_dep.name in self._cache:
+                pkgs = [self._cache[base_dep.name]]
             else:
-                self._emit_package(pkg)
+                pkgs = [None]
+            resolved[key] = [(pkg, pkg and get_satisfying_version(pkg,
+                                                                  base_dep))
+                             for pkg in pkgs]
+            return resolved[key]
 
         # Setup the transaction
         pklog.info("Get depends (%s,%s,%s)" % (filter, ids, recursive))
@@ -1732,56 +2139,113 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         dependency_types = ["PreDepends", "Depends"]
         if apt_pkg.config["APT::Install-Recommends"]:
             dependency_types.append("Recommends")
+        resolved = {}
+        providers = {}
+        # The ids of the emitted versions and the keys of the blocked
+        # dependencies, only used for recursive resolution
+        emitted = set()
+        blocked = set()
         total = len(ids)
         for count, id in enumerate(ids):
             self.percentage(count / 100 * total)
             version = self._get_version_by_id(id)
-            for dependency in version.get_dependencies(*dependency_types):
-                # Walk through all or_dependencies
-                for base_dep in dependency.or_dependencies:
-                    if self._cache.is_virtual_package(base_dep.name):
-                        # Check each proivider of a virtual package
-                        for provider in \
-                              self._cache.get_providing_packages(base_dep.name):
-                            check_dependency(provider, base_dep)
-                    elif base_dep.name in self._cache:
-                        check_dependency(self._cache[base_dep.name], base_dep)
-                    else:
-                        # The dependency does not exist
-                        emit_blocked_dependency(base_dep, filters=filters)
+            emitted.add(self._get_id_from_version(version))
+            # Walk the dependencies breadth first, emitting them on the way
+            queue = [version]
+            while queue:
+                version = queue.pop(0)
+                for dependency in version.get_dependencies(*dependency_types):
+                    # Walk through all or_dependencies
+                    for base_dep in dependency.or_dependencies:
+                        for pkg, dep_ver in resolve_dependency(base_dep):
+                            if pkg and \
+                               not self._is_package_visible(pkg, filters):
+                                continue
+                            if not dep_ver and pkg and not base_dep.version:
+                                # Neither installed nor available, so there
+                                # isn't anything to emit
+                                pklog.debug("Package %s hasn't got any "
+                                            "version." % pkg.name)
+                                continue
+                            if not dep_ver:
+                                key = (base_dep.name, base_dep.relation,
+                                       base_dep.version)
+                                if recursive and key in blocked:
+                                    continue
+                                blocked.add(key)
+                                emit_blocked_dependency(base_dep, pkg,
+                                                        filters=filters)
+                                continue
+                            if recursive:
+                                dep_id = self._get_id_from_version(dep_ver)
+                                if dep_id in emitted:
+                                    continue
+                                emitted.add(dep_id)
+                                queue.append(dep_ver)
+                            self._emit_pkg_version(dep_ver)
 
     @catch_pkerror
     def get_requires(self, filters, ids, recursive):
         """Emit all packages which depend on the given ids.
 
-        Recursive searching is not supported.
+        If recursive is set the packages which depend on those are
+        emitted too, and so on.
         """
         pklog.info("Get requires (%s,%s,%s)" % (filter, ids, recursive))
         self.status(enums.STATUS_DEP_RESOLVE)
         self.percentage(None)
         self._check_init(progress=False)
         self.allow_cancel(True)
+        reverse_depends = self._get_reverse_dependencies()
+        emitted = set()
         total = len(ids)
         for count, id in enumerate(ids):
             self.percentage(count / 100 * total)
-            version = self._get_version_by_id(id)
-            for pkg in self._cache:
-                if not self._is_package_visible(pkg, filters):
-                    continue
-                if pkg.is_installed:
-                    pkg_ver = pkg.installed
-                elif pkg.candidate:
-                    pkg_ver = pkg.candidate
-                for dependency in pkg_ver.dependencies:
-                    satisfied = False
-                    for base_dep in dependency.or_dependencies:
-                        if version.package.name == base_dep.name or \
-                           base_dep.name in version.provides:
-                            satisfied = True
-                            break
-                    if satisfied:
-                        self._emit_package(pkg)
-                        break
+            if not recursive:
+                emitted = set()
+            # Walk the reverse dependencies breadth first
+            queue = [self._get_version_by_id(id)]
+            while queue:
+                version = queue.pop(0)
+                requires = set()
+                for name in [version.package.name] + version.provides:
+                    requires.update(reverse_depends.get(name, ()))
+                for name in sorted(requires - emitted):
+                    pkg = self._cache[name]
+                    if not self._is_package_visible(pkg, filters):
+                        continue
+                    self._emit_package(pkg)
+                    emitted.add(name)
+                    if not recursive:
+                        continue
+                    if pkg.is_installed:
+                        queue.append(pkg.installed)
+                    else:
+                        queue.append(pkg.candidate)
+
+    def _get_reverse_dependencies(self):
+        """Return a dict which maps package names and provides to the
+        names of the packages depending on them.
+
+        The installed or else the candidate version of each package is
+        taken into account. The map is built once for each opened cache.
+        """
+        if self._reverse_depends is not None:
+            return self._reverse_depends
+        pklog.debug("Building the reverse dependencies")
+        self._reverse_depends = {}
+        for pkg in self._cache:
+            if pkg.is_installed:
+                pkg_ver = pkg.installed
+            elif pkg.candidate:
+                pkg_ver = pkg.candidate
+            else:
+                continue
+            for dependency in pkg_ver.dependencies:
+                for base_dep in dependency.or_dependencies:
+                    self._reverse_depends.setdefault(base_dep.name,
+                                                     set()).add(pkg.name)
+        return self._reverse_depends
 
     @catch_pkerror
     def what_provides(self, filters, provides_type, search):
@@ -1832,11 +2296,7 @@ class PackageKitAptBackend(PackageKitBaseBackend):
             # Search for privided gstreamer plugins using the package
             # metadata
             import gst
-            GSTREAMER_RECORD_MAP = {"encoder": "Gstreamer-Encoders",
-                                    "decoder": "Gstreamer-Decoders",
-                                    "urisource": "Gstreamer-Uri-Sources",
-                                    "urisink": "Gstreamer-Uri-Sinks",
-                                    "element": "Gstreamer-Elements"}
+            provides_index = self._get_provides_index()
             for search_item in search:
                 try:
                     gst_version, gst_record, gst_data, gst_caps = \
@@ -1846,31 +2306,22 @@ class PackageKitAptBackend(PackageKitBaseBackend):
                         break # ignore invalid codec query, probably for other types
                     else:
                         raise
-                for pkg in self._cache:
-                    if pkg.installed:
-                        version = pkg.installed
-                    elif pkg.candidate:
-                        version = pkg.candidate
-                    else:
-                        continue
-                    if not "Gstreamer-Version" in version.record:
-                        continue
-                    if version.record["Gstreamer-Version"] != gst_version:
-                        continue
+                names = set()
+                for name, elements in \
+                        provides_index.get_gstreamer_records(gst_version,
+                                                             gst_record):
                     if gst_caps:
                         try:
-                            pkg_caps = gst.Caps(version.record[gst_record])
-                        except KeyError:
+                            pkg_caps = gst.Caps(elements)
+                        except (TypeError, ValueError):
+                            pklog.debug("Invalid GStreamer caps of %s: %s" %
+                                        (name, elements))
                             continue
                         if gst_caps.intersect(pkg_caps):
-                            self._emit_visible_package(filters, pkg)
-                    else:
-                        try:
-                            elements = version.record[gst_record]
-                        except KeyError:
-                            continue
-                        if gst_data in elements:
-                            self._emit_visible_package(filters, pkg)
+                            names.add(name)
+                    elif gst_data in elements:
+                        names.add(name)
+                self._emit_visible_packages_by_name(filters, sorted(names))
 
         if provides_type in (enums.PROVIDES_MIMETYPE, enums.PROVIDES_ANY):
             supported_type = True
@@ -1898,7 +2349,6 @@ class PackageKitAptBackend(PackageKitBaseBackend):
 
         if provides_type in (enums.PROVIDES_MODALIAS, enums.PROVIDES_ANY):
             supported_type = True
-            system_architecture = apt_pkg.get_architectures()[0]
 
             # Emit packages that contain an application that can handle
             # the given mime type
@@ -1913,37 +2363,8 @@ class PackageKitAptBackend(PackageKitBaseBackend):
                 # strip off modalias(...) wrapper
                 search_item = search_item.split('(')[1][:-1]
 
-                for package in self._cache:
-                    # skip foreign architectures, we usually only want native
-                    # driver packages
-                    if (not package.candidate or
-                        package.candidate.architecture not in ("all",
-                                                          system_architecture)):
-                        continue
-
-                    try:
-                        m = package.candidate.record['Modaliases']
-                    except (KeyError, AttributeError):
-                        continue
-
-                    try:
-                        pkg_matches = False
-                        for part in m.split(')'):
-                            part = part.strip(', ')
-                            if not part:
-                                continue
-                            module, lst = part.split('(')
-                            for alias in lst.split(','):
-                                alias = alias.strip()
-                                if fnmatch.fnmatch(search_item, alias):
-                                    self._emit_visible_package(filters, package)
-                                    pkg_matches = True
-                                    break
-                            if pkg_matches:
-                                break
-                    except ValueError:
-                        pklog.warning("Package %s has invalid modalias header: %s" % (
-                            package.name, m))
+                names = self._get_provides_index().find_modalias(search_item)
+                self._emit_visible_packages_by_name(filters, sorted(names))
 
         # run plugins
         for plugin in self.plugins.get("what_provides", []):
@@ -2028,6 +2449,14 @@ class PackageKitAptBackend(PackageKitBaseBackend):
                           "There are broken dependecies on your system. "
                           "Please use an advanced package manage e.g. "
                           "Synaptic or aptitude to resolve this situation.")
+        self._reverse_depends = None
+        self._package_classes = {}
+        # The new cache has read the system pin files already
+        self._pin_files = None
+        # Every marking done through apt.Cache, apt.Package or the problem
+        # resolver is announced by this signal
+        self._marked = False
+        self._cache.connect("cache_post_change", self._on_cache_post_change)
         if rootdir:
             apt_pkg.config.clear("DPkg::Post-Invoke")
             apt_pkg.config.clear("DPkg::Options")
@@ -2035,6 +2464,13 @@ class PackageKitAptBackend(PackageKitBaseBackend):
             dpkg_log = "--log=%s/var/log/dpkg.log" % rootdir
             apt_pkg.config["DPkg::Options::"] = dpkg_log
         self._last_cache_refresh = time.time()
+        # Remember the dpkg status the cache has been built from
+        try:
+            self._status_mtime = os.stat(
+                apt_pkg.config["Dir::State::status"])[stat.ST_MTIME]
+            self._status_digest = self._get_status_digest()
+        except (OSError, IOError):
+            self._status_mtime = self._status_digest = None
 
     def _recover(self, start=95, end=100):
         """Try to recover from a package manager failure."""
@@ -2119,20 +2555,357 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         # been changed since the last refresh
         if not isinstance(self._cache, apt.cache.Cache) or \
            (self._cache.broken_count > 0) or \
-           (os.stat(apt_pkg.config["Dir::State::status"])[stat.ST_MTIME] > \
-            self._last_cache_refresh) or \
            (os.stat(pkg_cache)[stat.ST_MTIME] > self._last_cache_refresh) or \
-           (os.stat(src_cache)[stat.ST_MTIME] > self._last_cache_refresh):
+           (os.stat(src_cache)[stat.ST_MTIME] > self._last_cache_refresh) or \
+           self._has_status_changed():
             pklog.debug("Reloading the cache is required")
             self._open_cache(start, end, progress, fail_broken)
-        else:
+        # Read the pin files, including the one of Synaptic, if they have
+        # been changed since they were read last
+        reset = False
+        pin_files = self._get_pin_files_state()
+        if pin_files != self._pin_files:
+            if self._pin_files is not None:
+                # Reading the pin files again would only add to the policy,
+                # so start over with a new depcache and policy, which reads
+                # the system pin files
+                self._cache._depcache = apt_pkg.DepCache(self._cache._cache)
+            if os.path.exists(SYNAPTIC_PIN_FILE):
+                self._cache._depcache.read_pinfile(SYNAPTIC_PIN_FILE)
+            self._pin_files = pin_files
+            # The pinning could have changed the candidates and so their
+            # origins and dependencies
+            self._reverse_depends = None
+            self._package_classes = {}
+            reset = True
+        # Reset the depcache if the candidates have changed or if the last
+        # command could have left any marks behind. Packages kept back at
+        # their installed version are not counted, since there are such
+        # on any system with pending upgrades.
+        depcache = self._cache._depcache
+        if reset or self._marked or depcache.inst_count or \
+           depcache.del_count or depcache.broken_count:
+            self._cache.clear()
+            self._marked = False
+
+    def _on_cache_post_change(self):
+        """Remember that the depcache has been changed."""
+        self._marked = True
+
+    def _has_status_changed(self):
+        """Return True if the dpkg status has been changed since the cache
+        was opened.
+
+        dpkg rewrites the status file even if nothing has been changed, so
+        the content is compared if the modification time has moved.
+        """
+        status = apt_pkg.config["Dir::State::status"]
+        mtime = os.stat(status)[stat.ST_MTIME]
+        if mtime == self._status_mtime:
+            return False
+        if self._get_status_digest() != self._status_digest:
+            return True
+        self._status_mtime = mtime
+        return False
+
+    def _get_status_digest(self):
+        """Return the md5 digest of the dpkg status file."""
+        digest = hashlib.md5()
+        with open(apt_pkg.config["Dir::State::status"], "rb") as status:
+            for chunk in iter(lambda: status.read(65536), ""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _get_pin_files_state(self):
+        """Return the paths and modification times of the existing pin
+        files.
+        """
+        paths = [apt_pkg.config.find_file("Dir::Etc::Preferences"),
+                 SYNAPTIC_PIN_FILE]
+        paths.extend(glob.glob(os.path.join(
+            apt_pkg.config.find_dir("Dir::Etc::PreferencesParts"), "*")))
+        state = []
+        for path in sorted(paths):
+            try:
+                state.append((path, os.stat(path).st_mtime))
+            except OSError:
+                continue
+        return state
+
+    def _get_changelog_dir(self):
+        """Return the directory of the cached changelogs."""
+        #FIXME: Should be part of python-apt
+        changelog_dir = apt_pkg.config.find_dir("Dir::Cache::Changelogs")
+        if changelog_dir == "/":
+            changelog_dir = os.path.join(apt_pkg.config.find_dir("Dir::"
+                                                                 "Cache"),
+                                         "Changelogs")
+        return changelog_dir
+
+    def _get_changelog_path(self, pkg):
+        """Return the path of the cached changelog of the candidate."""
+        return os.path.join(self._get_changelog_dir(),
+                            "%s_%s.gz" % (pkg.name, pkg.candidate.version))
+
+    def _get_changelog(self, pkg):
+        """Return the changelog of the candidate of the package and if it
+        could be retrieved at all. The changelog is downloaded and cached
+        if it isn't cached yet.
+        """
+        filename = self._get_changelog_path(pkg)
+        if os.path.exists(filename):
+            pklog.debug("Reading changelog from cache")
+            changelog_file = gzip.open(filename, "rb")
+            try:
+                changelog_raw = changelog_file.read().decode("UTF-8")
+            finally:
+                changelog_file.close()
+            if changelog_raw:
+                return changelog_raw, True
+        pklog.debug("Downloading changelog")
+        changelog_raw = pkg.get_changelog()
+        # The internal download error string of python-apt ist not
+        # provided as unicode object
+        if not isinstance(changelog_raw, unicode):
+            return changelog_raw.decode("UTF-8"), False
+        # Write the changelog to the cache
+        changelog_dir = self._get_changelog_dir()
+        if not os.path.exists(changelog_dir):
+            os.makedirs(changelog_dir)
+        # Remove obsolete cached changelogs
+        pattern = os.path.join(changelog_dir, "%s_*.gz" % pkg.name)
+        for old_changelog in glob.glob(pattern):
+            try:
+                os.remove(old_changelog)
+            except OSError:
+                # Already removed by a concurrent prefetch
+                pass
+        # Write to a temporary file first, since the changelogs can be
+        # prefetched by other processes at the same time
+        temp_filename = "%s.%s" % (filename, os.getpid())
+        changelog_file = gzip.open(temp_filename, mode="wb")
+        try:
+            changelog_file.write(changelog_raw.encode("UTF-8"))
+        finally:
+            changelog_file.close()
+        os.rename(temp_filename, filename)
+        return changelog_raw, True
+
+    def _prefetch_changelogs(self, pkgs):
+        """Download the changelogs of the candidates of the given packages
+        into the cache, with up to PackageKit::Changelogs::Jobs downloads
+        at the same time.
+
+        The downloads are done by child processes, as the package records
+        cannot be shared between threads. They are killed if the backend
+        is cancelled or leaves before they are done.
+        """
+        jobs = max(apt_pkg.config.find_i("PackageKit::Changelogs::Jobs", 4),
+                   1)
+        pkgs = [pkg for pkg in pkgs if pkg.candidate and
+                not os.path.exists(self._get_changelog_path(pkg))]
+        if not pkgs:
+            return
+        # The children must not write any pending signals again
+        self.emitter.flush()
+        for lane in [pkgs[i::jobs] for i in range(min(jobs, len(pkgs)))]:
+            pid = os.fork()
+            if pid:
+                self._changelog_children.append(pid)
+                continue
+            try:
+                self._changelog_children = []
+                signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+                for pkg in lane:
+                    try:
+                        self._get_changelog(pkg)
+                    except Exception as error:
+                        pklog.debug("Failed to prefetch the changelog of "
+                                    "%s: %s" % (pkg.name, error))
+            finally:
+                os._exit(0)
+        try:
+            while self._changelog_children:
+                os.waitpid(self._changelog_children[0], 0)
+                # Only forget the child after it has been reaped, so its
+                # pid cannot have been reused when it gets killed
+                self._changelog_children.pop(0)
+        finally:
+            self._stop_changelog_prefetch()
+
+    def _stop_changelog_prefetch(self):
+        """Kill and reap the children which are still prefetching
+        changelogs and remove the changelogs they have partly written.
+        """
+        while self._changelog_children:
+            pid = self._changelog_children.pop()
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            pattern = os.path.join(self._get_changelog_dir(), "*.gz.%s" % pid)
+            for temp_filename in glob.glob(pattern):
+                try:
+                    os.remove(temp_filename)
+                except OSError:
+                    pass
+
+    def _get_changelog_details(self, pkg):
+        """Return a dict with the update text, the changelog in markdown
+        syntax, the bug and CVE urls and the issued and updated dates of
+        the candidate of the package.
+
+        The details are cached by source name and version, in memory and
+        next to the cached changelogs.
+        """
+        key = "%s_%s" % (pkg.candidate.source_name, pkg.candidate.version)
+        if key in self._changelog_details:
+            return self._changelog_details[key]
+        details_path = os.path.join(self._get_changelog_dir(),
+                                    "%s.details" % key)
+        try:
+            with open(details_path) as details_file:
+                details = json.load(details_file)
+        except (IOError, ValueError):
             pass
-        # Read the pin file of Synaptic if available
-        self._cache._depcache.read_pinfile()
-        if os.path.exists(SYNAPTIC_PIN_FILE):
-            self._cache._depcache.read_pinfile(SYNAPTIC_PIN_FILE)
-        # Reset the depcache
-        self._cache.clear()
+        else:
+            self._changelog_details[key] = details
+            return details
+        changelog_raw, success = self._get_changelog(pkg)
+        details = self._parse_changelog(changelog_raw,
+                                        pkg.candidate.source_name)
+        if not success:
+            return details
+        self._changelog_details[key] = details
+        pattern = os.path.join(self._get_changelog_dir(),
+                               "%s_*.details" % pkg.candidate.source_name)
+        try:
+            for old_details in glob.glob(pattern):
+                os.remove(old_details)
+            temp_path = "%s.%s" % (details_path, os.getpid())
+            with open(temp_path, "w") as details_file:
+                json.dump(details, details_file)
+            os.rename(temp_path, details_path)
+        except (IOError, OSError) as error:
+            pklog.debug("Failed to cache the changelog details: %s" % error)
+        return details
+
+    def _parse_changelog(self, changelog_raw, source_name):
+        """Return the details of the update from the changelog, see
+        _get_changelog_details.
+        """
+        issued = ""
+        updated = ""
+        update_text = []
+        # Convert the changelog to markdown syntax
+        changelog = []
+        for line in changelog_raw.split("\n"):
+            if line == "":
+                changelog.append(" \n")
+            else:
+                changelog.append("    %s  \n" % line)
+            if line.startswith(source_name):
+                match = MATCH_CHANGELOG_HEADER.match(line)
+                if match:
+                    update_text.append("%s\n%s\n\n" % (
+                        match.group("version"),
+                        "=" * len(match.group("version"))))
+            elif line.startswith("  "):
+                update_text.append("  %s  \n" % line)
+            elif line.startswith(" --"):
+                #FIXME: Add %z for the time zone - requires Python 2.6
+                update_text.append("  \n")
+                match = MATCH_CHANGELOG_TRAILER.match(line)
+                if not match:
+                    continue
+                date = datetime.datetime.strptime(match.group("date"),
+                                                  "%a, %d %b %Y %H:%M:%S")
+                issued = date.isoformat()
+                if not updated:
+                    updated = date.isoformat()
+        if issued == updated:
+            updated = ""
+        changelog = "".join(changelog)
+        bug_urls = []
+        for r in re.findall(MATCH_BUG_CLOSES_DEBIAN, changelog,
+                            re.IGNORECASE | re.MULTILINE):
+            bug_urls.extend([HREF_BUG_DEBIAN % bug for bug in \
+                             re.findall(MATCH_BUG_NUMBERS, r)])
+        for r in re.findall(MATCH_BUG_CLOSES_UBUNTU, changelog,
+                            re.IGNORECASE | re.MULTILINE):
+            bug_urls.extend([HREF_BUG_UBUNTU % bug for bug in \
+                             re.findall(MATCH_BUG_NUMBERS, r)])
+        cve_urls = [HREF_CVE % c for c in re.findall(MATCH_CVE, changelog,
+                                                     re.MULTILINE)]
+        return {"update_text": "".join(update_text),
+                "changelog": changelog,
+                "bugzilla_url": ";;".join(bug_urls),
+                "cve_url": ";;".join(cve_urls),
+                "issued": issued,
+                "updated": updated}
+
+    def _get_contents_files(self):
+        """Return the paths of the gzipped Contents files, e.g. downloaded
+        by apt-file.
+        """
+        return (glob.glob(os.path.join(apt_pkg.config.find_dir("Dir::Cache"),
+                                       "apt-file", "*Contents*.gz")) +
+                glob.glob(os.path.join(
+                    apt_pkg.config.find_dir("Dir::State::lists"),
+                    "*Contents*.gz")))
+
+    def _search_apt_file(self, filenames):
+        """Return the names of the packages which ship any of the files
+        according to apt-file.
+        """
+        #FIXME: Make use of rapt-file on Debian if the network is available
+        pklog.debug("Using apt-file")
+        filenames_regex = []
+        for filename in filenames:
+            if filename.startswith("/"):
+                pattern = "^%s$" % filename[1:].replace("/", "\/")
+            else:
+                pattern = "\/%s$" % filename
+            filenames_regex.append(pattern)
+        cmd = ["/usr/bin/apt-file", "--regexp", "--non-interactive",
+               "--package-only", "find", "|".join(filenames_regex)]
+        pklog.debug("Calling: %s" % cmd)
+        apt_file = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        stdout, stderr = apt_file.communicate()
+        if apt_file.returncode != 0:
+            raise PKError(enums.ERROR_INTERNAL_ERROR,
+                          format_string("%s %s" % (stdout, stderr)))
+        return set(stdout.split())
+
+    def _get_contents_index(self):
+        """Return the index of the Contents files."""
+        if not self._contents_index:
+            self._contents_index = ContentsIndex(
+                os.path.join(apt_pkg.config.find_dir("Dir::Cache"),
+                             "packagekit-contents"))
+        return self._contents_index
+
+    def _get_provides_index(self):
+        """Return the index of the modaliases and GStreamer capabilities,
+        after updating it if the cache has changed.
+        """
+        if not self._provides_index:
+            self._provides_index = ProvidesIndex(
+                os.path.join(apt_pkg.config.find_dir("Dir::Cache"),
+                             "packagekit-provides.db"))
+        pkg_cache = os.path.join(apt_pkg.config["Dir"],
+                                 apt_pkg.config["Dir::Cache"],
+                                 apt_pkg.config["Dir::Cache::pkgcache"])
+        # The installed versions are taken into account too, and so are the
+        # pin files, since they select the candidates
+        cache_key = "%s:%s:%s" % (
+            os.stat(pkg_cache).st_mtime,
+            os.stat(apt_pkg.config["Dir::State::status"]).st_mtime,
+            self._get_pin_files_state())
+        self._provides_index.update(self._cache, cache_key)
+        return self._provides_index
 
     def _emit_package(self, pkg, info=None, force_candidate=False):
         """Send the Package signal for a given APT package."""
@@ -2214,81 +2987,72 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         """
         if filters == [enums.FILTER_NONE]:
             return True
-        for filter in filters:
-            if ((filter == enums.FILTER_INSTALLED and not pkg.is_installed) or
-                (filter == enums.FILTER_NOT_INSTALLED and pkg.is_installed) or
-                (filter == enums.FILTER_SUPPORTED and not
-                 self._is_package_supported(pkg)) or
-                (filter == enums.FILTER_NOT_SUPPORTED and
-                 self._is_package_supported(pkg)) or
-                (filter == enums.FILTER_FREE and not
-                 not self._is_package_free(pkg)) or
-                (filter == enums.FILTER_NOT_FREE and
-                 not self._is_package_not_free(pkg)) or
-                (filter == enums.FILTER_GUI and
-                 not self._has_package_gui(pkg)) or
-                (filter == enums.FILTER_NOT_GUI and
-                 self._has_package_gui(pkg)) or
-                (filter == enums.FILTER_COLLECTIONS and not
-                 self._is_package_collection(pkg)) or
-                (filter == enums.FILTER_NOT_COLLECTIONS and
-                 self._is_package_collection(pkg)) or
-                 (filter == enums.FILTER_DEVELOPMENT and not
-                 self._is_package_devel(pkg)) or
-                (filter == enums.FILTER_NOT_DEVELOPMENT and
-                 self._is_package_devel(pkg))):
-                return False
-        return True
+        key = tuple(filters)
+        try:
+            required, forbidden = self._filter_masks[key]
+        except KeyError:
+            required = forbidden = 0
+            for filter in filters:
+                if filter in FILTER_FLAG_MAP:
+                    flag, wanted = FILTER_FLAG_MAP[filter]
+                    if wanted:
+                        required |= flag
+                    else:
+                        forbidden |= flag
+            self._filter_masks[key] = (required, forbidden)
+        if not required and not forbidden:
+            return True
+        flags = self._get_package_class(pkg)[0]
+        if pkg.is_installed:
+            flags |= FLAG_INSTALLED
+        return flags & required == required and not flags & forbidden
 
-    def _is_package_not_free(self, pkg):
-        """Return True if we can be sure that the package's license isn't any 
-        free one
-        """
-        #FIXME: Should check every origin
-        origins = pkg.candidate.origins
-        return (origins != None and \
-                ((origins[0].origin == "Ubuntu" and
-                  origins[0].component in ["multiverse", "restricted"]) or
-                 (origins[0].origin == "Debian" and
-                  origins[0].component in ["contrib", "non-free"])) and
-                origins[0].trusted == True)
-
-    def _is_package_collection(self, pkg):
-        """Return True if the package is a metapackge."""
-        section = pkg.section.split("/")[-1]
-        return section == "metapackages"
+    def _get_package_class(self, pkg):
+        """Return the flags and the PackageKit group of the package.
 
-    def _is_package_free(self, pkg):
-        """Return True if we can be sure that the package has got a free
-        license.
+        The classification only depends on the section and the origins of
+        the candidate, so it is calculated once per package and kept until
+        the cache gets reopened. The installed state is not part of it.
         """
+        try:
+            return self._package_classes[pkg.name]
+        except KeyError:
+            pass
+        flags = 0
+        section = pkg.section.split("/")[-1]
+        if section == "metapackages":
+            flags |= FLAG_COLLECTION
+        if section.lower() in ["x11", "gnome", "kde"]:
+            #FIXME: take application data into account. perhaps checking for
+            #       property in the xapian database
+            flags |= FLAG_GUI
+        if pkg.name.endswith("-dev") or pkg.name.endswith("-dbg") or \
+           section.lower() in ["devel", "libdevel"]:
+            flags |= FLAG_DEVEL
         #FIXME: Should check every origin
-        origins = pkg.candidate.origins
-        return (origins[0] != None and
-                ((origins[0].origin == "Ubuntu" and
-                  origins[0].component in ["main", "universe"]) or
-                 (origins[0].origin == "Debian" and
-                  origins[0].component == "main")) and
-                origins[0].trusted == True)
-
-    def _has_package_gui(self, pkg):
-        #FIXME: should go to a modified Package class
-        #FIXME: take application data into account. perhaps checking for
-        #       property in the xapian database
-        return pkg.section.split('/')[-1].lower() in ['x11', 'gnome', 'kde']
-
-    def _is_package_devel(self, pkg):
-        #FIXME: should go to a modified Package class
-        return pkg.name.endswith("-dev") or pkg.name.endswith("-dbg") or \
-               pkg.section.split('/')[-1].lower() in ['devel', 'libdevel']
-
-    def _is_package_supported(self, pkg):
-        origins = pkg.candidate.origins
-        #FIXME: iterate on all origins
-        return (origins != None and
-                origins[0].origin == "Ubuntu" and
-                origins[0].component in ["main", "restricted"] and
-                origins[0].trusted == True)
+        if pkg.candidate and pkg.candidate.origins:
+            origin = pkg.candidate.origins[0]
+            if origin.trusted == True:
+                if origin.origin == "Ubuntu":
+                    if origin.component in ["main", "universe"]:
+                        flags |= FLAG_FREE
+                    elif origin.component in ["multiverse", "restricted"]:
+                        flags |= FLAG_NOT_FREE
+                    if origin.component in ["main", "restricted"]:
+                        flags |= FLAG_SUPPORTED
+                elif origin.origin == "Debian":
+                    if origin.component == "main":
+                        flags |= FLAG_FREE
+                    elif origin.component in ["contrib", "non-free"]:
+                        flags |= FLAG_NOT_FREE
+        if section in SECTION_GROUP_MAP:
+            group = SECTION_GROUP_MAP[section]
+        else:
+            pklog.debug("Unkown package section %s of %s" % (pkg.section,
+                                                             pkg.name))
+            group = enums.GROUP_UNKNOWN
+        self._package_classes[pkg.name] = (flags, group)
+        return flags, group
 
     def _get_pkg_version_by_id(self, id):
         """Return a package version matching the given package id or None."""
@@ -2339,15 +3103,10 @@ class PackageKitAptBackend(PackageKitBaseBackend):
         """
         Return the packagekit group corresponding to the package's section
         """
-        section = pkg.section.split("/")[-1]
-        if section in SECTION_GROUP_MAP:
-            return SECTION_GROUP_MAP[section]
-        else:
-            pklog.debug("Unkown package section %s of %s" % (pkg.section,
-                                                             pkg.name))
-            return enums.GROUP_UNKNOWN
+        return self._get_package_class(pkg)[1]
 
     def _sigquit(self, signum, frame):
+        self._stop_changelog_prefetch()
         self._unlock_cache()
         sys.exit(1)
 
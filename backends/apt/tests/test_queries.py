@@ -106,6 +106,76 @@ class QueryTests(mox.MoxTestBase):
         self.backend.dispatch_command("search-details",
                                       ["None", "always fail"])
 
+    def test_search_file(self):
+        """Test searching for installed files."""
+        self._catch_callbacks("package")
+        self.backend.package("silly-base;0.1-0;all;",
+                             enums.INFO_INSTALLED,
+                             "working package")
+        self.backend.finished()
+        self.backend.package("silly-base;0.1-0;all;",
+                             enums.INFO_INSTALLED,
+                             "working package")
+        self.backend.finished()
+        self.backend.finished()
+        self.mox.ReplayAll()
+        self.backend._open_cache()
+
+        self.backend.dispatch_command("search-file",
+                                      ["installed",
+                                       "/usr/share/doc/silly-base/copyright"])
+        self.backend.dispatch_command("search-file",
+                                      ["installed", "silly-base/copyright"])
+        self.backend.dispatch_command("search-file",
+                                      ["installed", "/usr/share/doc/silly"])
+
+    def test_get_depends(self):
+        """Test getting the dependencies of a package."""
+        self._catch_callbacks("package")
+        self.backend.package("silly-base;0.1-0;all;",
+                             enums.INFO_INSTALLED,
+                             "working package")
+        self.backend.finished()
+        self.backend.package("silly-base;0.1-0;all;",
+                             enums.INFO_INSTALLED,
+                             "working package")
+        self.backend.package("silly-unavailbale;;;",
+                             enums.INFO_BLOCKED,
+                             "")
+        self.backend.finished()
+        self.mox.ReplayAll()
+        self.backend._open_cache()
+
+        self.backend.dispatch_command("get-depends",
+                                      ["None", "silly-depend-base;0.1-0;all;",
+                                       "true"])
+        self.backend.dispatch_command("get-depends",
+                                      ["None",
+                                       "silly-depend-base;0.1-0;all;&"
+                                       "silly-broken;0.1-0;all;",
+                                       "true"])
+
+    def test_get_requires(self):
+        """Test getting the packages which depend on a package."""
+        self._catch_callbacks("package")
+        self.backend.package("silly-depend-base;0.1-0;all;",
+                             enums.INFO_AVAILABLE,
+                             mox.IsA(str))
+        self.backend.package("silly-depend-base-lintian-broken;0.1-0;all;",
+                             enums.INFO_AVAILABLE,
+                             mox.IsA(str))
+        self.backend.finished()
+        self.backend.finished()
+        self.mox.ReplayAll()
+        self.backend._open_cache()
+
+        self.backend.dispatch_command("get-requires",
+                                      ["None", "silly-base;0.1-0;all;",
+                                       "true"])
+        self.backend.dispatch_command("get-requires",
+                                      ["installed", "silly-base;0.1-0;all;",
+                                       "false"])
+
 
     def test_what_provides_codec(self):
         """Test searching for package providing a codec."""
@@ -21,11 +21,15 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import copy
 import os
 import sys
 import signal
+import sqlite3
+import threading
 import time
 import traceback
+import Queue
 
 from packagekit.enums import ERROR_PACKAGE_ID_INVALID, ERROR_REPO_NOT_FOUND, \
     ERROR_INTERNAL_ERROR, \
@@ -80,12 +84,17 @@ except ImportError:
 
 import entropy.tools
 import entropy.dep
+import entropy.dump
 
 PK_DEBUG = False
 
 class PackageKitEntropyMixin(object):
 
     INST_PKGS_REPO_ID = "installed"
+    # number of repositories which are searched at the same time
+    MAX_SEARCH_WORKERS = 8
+    # name of the on-disk cache of the updates, see _etp_get_updates()
+    UPDATES_CACHE_ID = "packagekit_updates"
 
     """
     Entropy relaxed code can be found in this Mixin class.
@@ -141,16 +150,27 @@ class PackageKitEntropyMixin(object):
         @rtype: string
         """
         pkg_id, c_repo = pkg_match
+        return self._etp_data_to_id(c_repo.getStrictData(pkg_id),
+            self._get_repo_name(c_repo))
 
-        pkg_key, pkg_slot, pkg_ver, pkg_tag, pkg_rev, atom = \
-            c_repo.getStrictData(pkg_id)
+    def _etp_data_to_id(self, strict_data, repo_name):
+        """
+        Transform the metadata of an Entropy package into PackageKit id.
+        @param strict_data: the data returned by
+            EntropyRepository.getStrictData()
+        @type strict_data: tuple
+        @param repo_name: repository identifier of the package
+        @type repo_name: string
+        @return: PackageKit package id
+        @rtype: string
+        """
+        pkg_key, pkg_slot, pkg_ver, pkg_tag, pkg_rev, atom = strict_data
 
         pkg_ver += "%s%s" % (etpConst['entropyslotprefix'], pkg_slot,)
         if pkg_tag:
             pkg_ver += "%s%s" % (etpConst['entropytagprefix'], pkg_tag)
 
         cur_arch = etpConst['currentarch']
-        repo_name = self._get_repo_name(c_repo)
         if repo_name is None:
             self.error(ERROR_PACKAGE_ID_INVALID,
                 "Invalid metadata passed")
@@ -199,28 +219,48 @@ class PackageKitEntropyMixin(object):
 
         return pkg_id, c_repo
 
-    def _get_pk_group(self, category):
+    def _get_group_maps(self):
         """
-        Return PackageKit group belonging to given Entropy package category.
+        Return the lookup tables built from Entropy package groups: a dict
+        mapping categories to PackageKit groups, a dict mapping PackageKit
+        groups to the set of their categories and the set of all the
+        categories belonging to a group.
+        The tables are built once, and package groups are checked for
+        changes once per command.
         """
-        group_data = [key for key, data in \
-            self._entropy.get_package_groups().items() \
-                if category in data['categories']]
-        try:
-            generic_group_name = group_data.pop(0)
-        except IndexError:
-            return GROUP_UNKNOWN
+        if self._group_maps_checked:
+            return self._group_maps
+        entropy_groups = self._entropy.get_package_groups()
+        self._group_maps_checked = True
+        if self._group_maps is not None and \
+            entropy_groups == self._entropy_groups:
+            return self._group_maps
 
-        return PackageKitEntropyBackend.GROUP_MAP[generic_group_name]
+        group_map = PackageKitEntropyBackend.GROUP_MAP
+        category_groups = {}
+        group_categories = {}
+        all_categories = set()
+        for key, data in entropy_groups.items():
+            pk_group = group_map.get(key, GROUP_UNKNOWN)
+            for category in data['categories']:
+                # the first group listing a category wins
+                category_groups.setdefault(category, pk_group)
+            if key in group_map:
+                group_categories.setdefault(pk_group, set()).update(
+                    data['categories'])
+            all_categories.update(data['categories'])
+
+        # keep a copy, the groups may be changed in place
+        self._entropy_groups = copy.deepcopy(entropy_groups)
+        self._group_maps = (category_groups, group_categories,
+            frozenset(all_categories))
+        return self._group_maps
 
-    def _get_entropy_group(self, pk_group):
+    def _get_pk_group(self, category):
         """
-        Given a PackageKit group identifier, return Entropy packages group.
+        Return PackageKit group belonging to given Entropy package category.
         """
-        group_map = PackageKitEntropyBackend.GROUP_MAP
-        # reverse dict
-        group_map_reverse = dict((y, x) for x, y in group_map.items())
-        return group_map_reverse.get(pk_group, 'unknown')
+        return self._get_group_maps()[0].get(category, GROUP_UNKNOWN)
 
     def _get_all_repos(self):
         """
@@ -239,6 +279,95 @@ class PackageKitEntropyMixin(object):
             repos.append((repo_db, repo,))
         return repos
 
+    def _etp_search_repos(self, repos, search_func, source):
+        """
+        Run search_func against every repository in repos at the same time
+        and return the matches as a set of (repository identifier,
+        package identifier, EntropyRepository) tuples.
+
+        Every repository is searched by a worker thread, which uses its own
+        SQLite connection since EntropyRepository cursors are per thread.
+        A repository is only ever searched by one worker, so no
+        EntropyRepository is used by two threads at the same time, and all
+        the workers have finished when this returns or raises.
+        Output is only done by the calling thread, and percentage follows
+        the repositories that have been searched.
+        @param repos: list of tuples as returned by _get_all_repos()
+        @type repos: list
+        @param search_func: function taking an EntropyRepository and
+            returning the matched package identifiers
+        @type search_func: callable
+        @param source: name of the caller, used for logging
+        @type source: string
+        @return: the matched packages
+        @rtype: set
+        """
+        jobs = Queue.Queue()
+        for repo_db, repo in repos:
+            jobs.put((repo_db, repo))
+        results = Queue.Queue()
+
+        def _worker():
+            while True:
+                try:
+                    repo_db, repo = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    pkg_ids = search_func(repo_db)
+                except Exception:
+                    results.put((repo_db, repo, None, sys.exc_info()))
+                else:
+                    results.put((repo_db, repo, pkg_ids, None))
+
+        max_workers = PackageKitEntropyMixin.MAX_SEARCH_WORKERS
+        threads = []
+        for x in range(min(len(repos), max_workers)):
+            thread = threading.Thread(target = _worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        pkgs = set()
+        error = None
+        count = 0
+        max_count = len(repos)
+        while count < max_count:
+            try:
+                # use a timeout, so that signals are still delivered
+                repo_db, repo, pkg_ids, exc_info = results.get(True, 1)
+            except Queue.Empty:
+                continue
+            count += 1
+            if exc_info is not None:
+                # stop handing out repositories, and raise once the
+                # searches which are running have finished
+                if error is None:
+                    error = exc_info
+                while True:
+                    try:
+                        jobs.get_nowait()
+                    except Queue.Empty:
+                        break
+                    count += 1
+                continue
+            if error is not None:
+                continue
+
+            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
+
+            self._log_message(__name__, "%s: done %s/100" % (
+                source, percent,))
+
+            self.percentage(percent)
+            pkgs.update((repo, x, repo_db,) for x in pkg_ids)
+
+        for thread in threads:
+            thread.join()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return pkgs
+
     def _get_pkg_size(self, pkg_match):
         """
         Return package size for both installed and available packages.
@@ -275,10 +404,72 @@ class PackageKitEntropyMixin(object):
         EntropyRepository instance, feed PackageKit output by calling
         self._package()
         """
-        lambda_sort = lambda x: x[2].retrieveAtom(x[1])
+        repo_pkg_ids = {}
+        for repo, pkg_id, c_repo, pkg_type in pkgs:
+            repo_pkg_ids.setdefault(c_repo, []).append(pkg_id)
+
+        pkgs_data = {}
+        for c_repo, pkg_ids in repo_pkg_ids.items():
+            pkgs_data[c_repo] = self._etp_get_pkgs_data(c_repo, pkg_ids)
+
+        rows = []
+        for repo, pkg_id, c_repo, pkg_type in pkgs:
+            strict_data, desc = pkgs_data[c_repo][pkg_id]
+            rows.append((strict_data, desc, c_repo, pkg_type))
+
+        # sort by atom
+        rows.sort(key = lambda x: x[0][5])
+
+        inst_repo = self._entropy.installed_repository()
+        for strict_data, desc, c_repo, pkg_type in rows:
+            info = pkg_type
+            if not info:
+                if c_repo is inst_repo:
+                    info = INFO_INSTALLED
+                else:
+                    info = INFO_AVAILABLE
+            self.package(self._etp_data_to_id(strict_data,
+                self._get_repo_name(c_repo)), info, desc)
 
-        for repo, pkg_id, c_repo, pkg_type in sorted(pkgs, key = lambda_sort):
-            self._package((pkg_id, c_repo), info = pkg_type)
+    def _etp_get_pkgs_data(self, c_repo, pkg_ids):
+        """
+        Return the data needed to feed PackageKit output for the given
+        packages of an EntropyRepository, reading it with one query per
+        chunk of packages rather than with two queries per package.
+        @return: dict mapping the package identifiers to a tuple composed by
+            the getStrictData() output and the package description
+        @rtype: dict
+        """
+        pkgs_data = {}
+        # the public API only reads one package at a time, so the bulk
+        # query relies on the private cursor and the known SQLite schema,
+        # and falls back to the public API if either of them differs
+        if hasattr(c_repo, "_cursor"):
+            query = """
+            SELECT baseinfo.idpackage, baseinfo.category || '/' ||
+                baseinfo.name, baseinfo.slot, baseinfo.version,
+                baseinfo.versiontag, baseinfo.revision, baseinfo.atom,
+                extrainfo.description
+            FROM baseinfo LEFT JOIN extrainfo
+                ON baseinfo.idpackage = extrainfo.idpackage
+            WHERE baseinfo.idpackage IN (%s)"""
+            try:
+                # stay below the SQLite limit of bound parameters
+                for idx in range(0, len(pkg_ids), 500):
+                    chunk = pkg_ids[idx:idx + 500]
+                    cur = c_repo._cursor().execute(
+                        query % (','.join(['?'] * len(chunk)),), chunk)
+                    for row in cur:
+                        pkgs_data[row[0]] = (tuple(row[1:7]), row[7] or "")
+            except (EntropyRepositoryError, sqlite3.Error):
+                # unknown repository schema, use the public API below
+                pkgs_data.clear()
+
+        for pkg_id in pkg_ids:
+            if pkg_id not in pkgs_data:
+                pkgs_data[pkg_id] = (c_repo.getStrictData(pkg_id),
+                    c_repo.retrieveDescription(pkg_id))
+        return pkgs_data
 
     def _pk_filter_pkgs(self, pkgs, filters):
         """
@@ -296,9 +487,14 @@ class PackageKitEntropyMixin(object):
 
         return pkgs
 
-    def _pk_add_pkg_type(self, pkgs, important_check = False):
+    def _pk_add_pkg_type(self, pkgs, important = None):
         """
         Expand list of pkg tuples by adding PackageKit package type to it.
+        @keyword important: set of (package identifier, repository
+            identifier) tuples of the packages which are tagged as
+            INFO_IMPORTANT, the others are INFO_NORMAL. If None, the type is
+            left unset
+        @type important: set
         """
         # we have INFO_IMPORTANT, INFO_SECURITY, INFO_NORMAL
         new_pkgs = set()
@@ -306,10 +502,8 @@ class PackageKitEntropyMixin(object):
         for repo, pkg_id, c_repo in pkgs:
 
             pkg_type = None
-            if important_check:
-                sys_pkg = self._entropy.validate_package_removal(pkg_id,
-                    repo_id = repo)
-                if sys_pkg:
+            if important is not None:
+                if (pkg_id, repo) in important:
                     pkg_type = INFO_IMPORTANT
                 else:
                     pkg_type = INFO_NORMAL
@@ -324,6 +518,68 @@ class PackageKitEntropyMixin(object):
 
         return new_pkgs
 
+    def _etp_get_updates_key(self):
+        """
+        Return the key the cached updates are valid for, made of the
+        checksum of the installed packages repository and of the revision
+        of every available repository, or None if it cannot be computed.
+        """
+        try:
+            key = [self._entropy.installed_repository().checksum()]
+            if hasattr(self._settings, "packages_configuration_hash"):
+                key.append(self._settings.packages_configuration_hash())
+            for repo_id in self._entropy.repositories():
+                key.append((repo_id,
+                    self._entropy.get_repository_revision(repo_id)))
+        except (AttributeError, EntropyRepositoryError):
+            return None
+        return tuple(key)
+
+    def _etp_get_updates(self):
+        """
+        Return the packages which can be updated, as a list of (package
+        identifier, repository identifier) tuples, and the set of those
+        which are system packages.
+        Updates are only calculated again when the key returned by
+        _etp_get_updates_key() changes, they are kept in memory and on disk
+        in the meantime.
+        @raise SystemDatabaseError: if the installed packages repository is
+            broken
+        """
+        cache_id = PackageKitEntropyMixin.UPDATES_CACHE_ID
+        key = self._etp_get_updates_key()
+        if key is not None:
+            cached = self._updates_cache
+            if cached is None:
+                cached = entropy.dump.loadobj(cache_id)
+            if isinstance(cached, dict) and cached.get('key') == key:
+                self._updates_cache = cached
+                return cached['update'], cached['important']
+
+        update, remove, fine, spm_fine = self._entropy.calculate_updates()
+        important = set()
+        for pkg_id, repo_id in update:
+            if self._entropy.validate_package_removal(pkg_id,
+                repo_id = repo_id):
+                important.add((pkg_id, repo_id))
+
+        self._updates_cache = {
+            'key': key,
+            'update': update,
+            'important': important,
+        }
+        if key is not None:
+            entropy.dump.dumpobj(cache_id, self._updates_cache)
+        return update, important
+
+    def _etp_clear_updates_cache(self):
+        """
+        Forget the cached updates, after a transaction or a repositories
+        refresh.
+        """
+        self._updates_cache = None
+        entropy.dump.removeobj(PackageKitEntropyMixin.UPDATES_CACHE_ID)
+
     def _repo_enable(self, repoid):
         excluded_repos = self._settings['repositories']['excluded']
         available_repos = self._settings['repositories']['available']
@@ -500,6 +756,8 @@ class PackageKitEntropyMixin(object):
         self.percentage(0)
         self.status(STATUS_REMOVE)
         inst_repo = self._entropy.installed_repository()
+        if not simulate:
+            self._etp_clear_updates_cache()
 
         def _generate_map_item(etp_pkg_id):
             _etp_match = (etp_pkg_id, inst_repo)
@@ -714,6 +972,8 @@ class PackageKitEntropyMixin(object):
 
         # install
         self.status(STATUS_INSTALL)
+        if not simulate:
+            self._etp_clear_updates_cache()
 
         for match in run_queue:
             count += 1
@@ -871,6 +1131,10 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         signal.signal(signal.SIGQUIT, self.__sigquit)
         PkUrlFetcher._pk_progress = self.sub_percentage
         self._repo_name_cache = {}
+        self._entropy_groups = None
+        self._group_maps = None
+        self._group_maps_checked = False
+        self._updates_cache = None
         PackageKitEntropyClient._pk_progress = self.percentage
         PackageKitEntropyClient._pk_message = self._generic_message
 
@@ -883,6 +1147,11 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         self.destroy()
         PackageKitBaseBackend.unLock(self)
 
+    def finished(self):
+        # package groups may have changed before the next command
+        self._group_maps_checked = False
+        PackageKitBaseBackend.finished(self)
+
     def _convert_date_to_iso8601(self, unix_time_str):
         unix_time = float(unix_time_str)
         ux_t = time.localtime(unix_time)
@@ -1136,22 +1405,13 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         repos = self._get_all_repos()
 
-        pkgs = set()
-        count = 0
-        max_count = len(repos)
-        for repo_db, repo in repos:
-
-            count += 1
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
-
-            self._log_message(__name__, "get_packages: done %s/100" % (percent,))
-
-            self.percentage(percent)
+        def _search(repo_db):
             try:
-                pkg_ids = repo_db.listAllIdpackages()
+                return repo_db.listAllIdpackages()
             except AttributeError:
-                pkg_ids = repo_db.listAllPackageIds()
-            pkgs.update((repo, x, repo_db,) for x in pkg_ids)
+                return repo_db.listAllPackageIds()
+
+        pkgs = self._etp_search_repos(repos, _search, "get_packages")
 
         # now filter
         pkgs = self._pk_filter_pkgs(pkgs, filters)
@@ -1332,7 +1592,7 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         # this is the part that takes time
         self.percentage(0)
         try:
-            update, remove, fine, spm_fine = self._entropy.calculate_updates()
+            update, important = self._etp_get_updates()
         except SystemDatabaseError as err:
             self.error(ERROR_DEP_RESOLUTION_FAILED,
                 "System Repository error: %s" % (err,))
@@ -1355,7 +1615,7 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         # now filter
         pkgs = self._pk_filter_pkgs(pkgs, filters)
-        pkgs = self._pk_add_pkg_type(pkgs, important_check = True)
+        pkgs = self._pk_add_pkg_type(pkgs, important = important)
         # now feed stdout
         self._pk_feed_sorted_pkgs(pkgs)
 
@@ -1496,6 +1756,7 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
             return
 
         ex_rc = repo_intf.sync()
+        self._etp_clear_updates_cache()
         if not ex_rc:
             self._etp_update_repository_stats(repo_identifiers)
         else:
@@ -1557,21 +1818,13 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         repos = self._get_all_repos()
 
-        pkgs = set()
-        count = 0
-        max_count = len(repos)
-        for repo_db, repo in repos:
-
-            count += 1
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
-
-            self._log_message(__name__, "resolve: done %s/100" % (
-                percent,))
-
-            self.percentage(percent)
+        def _search(repo_db):
+            pkg_ids = set()
             for key in values:
-                pkg_ids, pkg_rc = repo_db.atomMatch(key, multiMatch = True)
-                pkgs.update((repo, x, repo_db,) for x in pkg_ids)
+                pkg_ids.update(repo_db.atomMatch(key, multiMatch = True)[0])
+            return pkg_ids
+
+        pkgs = self._etp_search_repos(repos, _search, "resolve")
 
         # now filter
         pkgs = self._pk_filter_pkgs(pkgs, filters)
@@ -1594,23 +1847,15 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         repos = self._get_all_repos()
 
-        pkgs = set()
-        count = 0
-        max_count = len(repos)
-        for repo_db, repo in repos:
-            count += 1
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
-
-            self._log_message(__name__, "search_details: done %s/100" % (
-                percent,))
-
-            self.percentage(percent)
+        def _search(repo_db):
+            pkg_ids = set()
             for key in values:
-                pkg_ids = repo_db.searchDescription(key,
-                    just_id = True)
-                pkg_ids |= repo_db.searchHomepage(key, just_id = True)
-                pkg_ids |= repo_db.searchLicense(key, just_id = True)
-                pkgs.update((repo, x, repo_db,) for x in pkg_ids)
+                pkg_ids.update(repo_db.searchDescription(key, just_id = True))
+                pkg_ids.update(repo_db.searchHomepage(key, just_id = True))
+                pkg_ids.update(repo_db.searchLicense(key, just_id = True))
+            return pkg_ids
+
+        pkgs = self._etp_search_repos(repos, _search, "search_details")
 
         # now filter
         pkgs = self._pk_filter_pkgs(pkgs, filters)
@@ -1634,18 +1879,8 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         reverse_symlink_map = self._settings['system_rev_symlinks']
         repos = self._get_all_repos()
 
-        pkgs = set()
-        count = 0
-        max_count = len(repos)
-        for repo_db, repo in repos:
-            count += 1
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
-
-            self._log_message(__name__, "search_file: done %s/100" % (
-                percent,))
-
-            self.percentage(percent)
-
+        def _search(repo_db):
+            found_ids = set()
             for key in values:
 
                 like = False
@@ -1670,7 +1905,10 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
                                 if pkg_ids:
                                     break
 
-                pkgs.update((repo, x, repo_db,) for x in pkg_ids)
+                found_ids.update(pkg_ids)
+            return found_ids
+
+        pkgs = self._etp_search_repos(repos, _search, "search_file")
 
         # now filter
         pkgs = self._pk_filter_pkgs(pkgs, filters)
@@ -1693,19 +1931,12 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         repos = self._get_all_repos()
 
-        entropy_groups = self._entropy.get_package_groups()
-        all_matched_categories = set()
-        for e_data in entropy_groups.values():
-            all_matched_categories.update(e_data['categories'])
-        all_matched_categories = sorted(all_matched_categories)
+        category_groups, group_categories, all_matched_categories = \
+            self._get_group_maps()
 
         selected_categories = set()
         for group in values:
-            entropy_group = self._get_entropy_group(group)
-            # group_data is None when there's no matching group
-            group_data = entropy_groups.get(entropy_group)
-            if group_data is not None:
-                selected_categories.update(group_data['categories'])
+            selected_categories.update(group_categories.get(group, ()))
 
         # if selected_categories is empty, then pull in pkgs with non matching
         # category in all_matched_categories
@@ -1774,20 +2005,13 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         repos = self._get_all_repos()
 
-        pkgs = set()
-        count = 0
-        max_count = len(repos)
-        for repo_db, repo in repos:
-            count += 1
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
-
-            self._log_message(__name__, "search_name: done %s/100" % (
-                percent,))
-
-            self.percentage(percent)
+        def _search(repo_db):
+            pkg_ids = set()
             for key in values:
-                pkg_ids = repo_db.searchPackages(key, just_id = True)
-                pkgs.update((repo, x, repo_db,) for x in pkg_ids)
+                pkg_ids.update(repo_db.searchPackages(key, just_id = True))
+            return pkg_ids
+
+        pkgs = self._etp_search_repos(repos, _search, "search_name")
 
         # now filter
         pkgs = self._pk_filter_pkgs(pkgs, filters)
@@ -1833,7 +2057,7 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
         # this is the part that takes time
         self.percentage(0)
         try:
-            update, remove, fine, spm_fine = self._entropy.calculate_updates()
+            update, important = self._etp_get_updates()
         except SystemDatabaseError as err:
             self.error(ERROR_DEP_RESOLUTION_FAILED,
                 "System Repository error: %s" % (err,))
@@ -1857,20 +2081,13 @@ class PackageKitEntropyBackend(PackageKitBaseBackend, PackageKitEntropyMixin):
 
         repos = self._get_all_repos()
 
-        pkgs = set()
-        count = 0
-        max_count = len(repos)
-        for repo_db, repo in repos:
-            count += 1
-            percent = PackageKitEntropyMixin.get_percentage(count, max_count)
-
-            self._log_message(__name__, "_what_provides_mime: done %s/100" % (
-                percent,))
-
-            self.percentage(percent)
+        def _search(repo_db):
+            pkg_ids = set()
             for key in values:
-                pkg_ids = repo_db.searchProvidedMime(key)
-                pkgs.update((repo, x, repo_db,) for x in pkg_ids)
+                pkg_ids.update(repo_db.searchProvidedMime(key))
+            return pkg_ids
+
+        pkgs = self._etp_search_repos(repos, _search, "_what_provides_mime")
 
         # now filter
         pkgs = self._pk_filter_pkgs(pkgs, filters)
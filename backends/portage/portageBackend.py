@@ -74,6 +74,7 @@ import layman.config
 import sys
 import signal
 import re
+import sqlite3
 from itertools import izip
 
 # NOTES:
@@ -226,6 +227,333 @@ class PortageBridge():
         self.settings.regenerate()
         self.settings.lock()
 
+        # the available packages only change with the settings or a sync,
+        # so they are indexed until the next update
+        self._available_cp = None
+        self._available_cp_list = None
+        self._available_cpv = {}
+
+        # (LICENSE, USE) -> (free, not free), see get_license_freeness
+        self._free_licenses = None
+        self._license_freeness = {}
+
+    def get_available_cp(self):
+        '''
+        Returns the list of the cp in the tree and the overlays, in the
+        order of portdb.cp_all(). The list is shared, so it must not be
+        modified.
+        '''
+        if self._available_cp_list is None:
+            self._available_cp_list = self.portdb.cp_all()
+            self._available_cp = frozenset(self._available_cp_list)
+        return self._available_cp_list
+
+    def get_all_cp(self):
+        '''
+        Returns the list of the installed cp followed by the available cp
+        which are not installed.
+        '''
+        cp_list = list(self.vardb.cp_all())
+        installed = set(cp_list)
+        self.get_available_cp()
+        cp_list.extend(cp for cp in self._available_cp_list
+                if cp not in installed)
+        return cp_list
+
+    def get_free_licenses(self):
+        '''
+        Returns the set of the licenses in the @FSF-APPROVED group, read
+        from the license_groups of the tree and the overlays.
+        '''
+        if self._free_licenses is not None:
+            return self._free_licenses
+
+        groups = {}
+        for tree in self.portdb.porttrees:
+            path = os.path.join(tree, "profiles", "license_groups")
+            try:
+                f = open(path)
+            except IOError:
+                continue
+            for line in f:
+                line = line.split('#', 1)[0].split()
+                if line:
+                    groups.setdefault(line[0], []).extend(line[1:])
+            f.close()
+
+        licenses = set()
+        expanded = set()
+        stack = ["FSF-APPROVED"]
+        while stack:
+            group = stack.pop()
+            if group in expanded:
+                continue
+            expanded.add(group)
+            for x in groups.get(group, []):
+                if x.startswith('@'):
+                    stack.append(x[1:])
+                else:
+                    licenses.add(x)
+
+        self._free_licenses = frozenset(licenses)
+        return self._free_licenses
+
+    def get_license_freeness(self, license_str, use):
+        '''
+        Returns a tuple telling if the LICENSE of a package can be satisfied
+        with free licenses only, and with non free licenses only.
+        '''
+        key = (license_str, use)
+        try:
+            return self._license_freeness[key]
+        except KeyError:
+            pass
+
+        free_licenses = self.get_free_licenses()
+
+        def _is_satisfied(deps, accepted):
+            # deps is a use_reduce()d LICENSE, where '||' is followed by
+            # the list of the alternatives
+            deps = iter(deps)
+            for x in deps:
+                if x == '||':
+                    choices = [y for y in deps.next()
+                            if _is_satisfied([y], accepted)]
+                    if not choices:
+                        return False
+                elif isinstance(x, list):
+                    if not _is_satisfied(x, accepted):
+                        return False
+                elif not accepted(x):
+                    return False
+            return True
+
+        deps = portage.dep.use_reduce(portage.dep.paren_reduce(license_str),
+                uselist=use.split())
+        freeness = (
+                _is_satisfied(deps, lambda x: x in free_licenses),
+                _is_satisfied(deps, lambda x: x not in free_licenses))
+        self._license_freeness[key] = freeness
+        return freeness
+
+    def match_available(self, cp):
+        '''
+        Returns the visible cpv of a cp in the tree and the overlays.
+        The list is shared, so it must not be modified.
+        '''
+        try:
+            return self._available_cpv[cp]
+        except KeyError:
+            cpv_list = self.portdb.match(cp)
+            self._available_cpv[cp] = cpv_list
+            return cpv_list
+
+
+class PortageMetadataCache(object):
+    '''
+    Cache of the metadata keys read for nearly every cpv.
+
+    The keys of a cpv are read with a single aux_get and kept in memory for
+    the lifetime of the backend, so they are shared by all the commands of
+    the dispatcher, and in a sqlite database between two runs. An entry is
+    keyed by the cpv, whether it is installed and the mtime of its ebuild or
+    vdb directory. The mtime is only checked once per request.
+
+    Eclasses change the metadata without touching the ebuilds, so all the
+    entries of not installed packages are dropped when the sync timestamp
+    or any eclass of the trees has changed, which is checked once per
+    request too.
+    '''
+
+    KEYS = ["KEYWORDS", "SLOT", "LICENSE", "USE", "repository",
+            "DESCRIPTION", "SIZE"]
+    DB_VERSION = 2
+
+    def __init__(self, pvar,
+            path='/var/cache/PackageKit/portage-metadata.sqlite'):
+        self.pvar = pvar
+        # (cpv, installed) -> (mtime, values)
+        self._entries = {}
+        # keys which have been checked during the current request
+        self._checked = set()
+        # entries which have to be written to the database
+        self._pending = []
+        # state of the timestamps and eclasses of the trees
+        self._tree_state = None
+        self._tree_checked = False
+        self._connection = self._connect(path)
+
+    def _connect(self, path):
+        columns = ', '.join(['"%s" TEXT' % key for key in self.KEYS])
+        try:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            connection = sqlite3.connect(path)
+            connection.text_factory = str
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.DB_VERSION:
+                connection.execute('DROP TABLE IF EXISTS metadata')
+                connection.execute('DROP TABLE IF EXISTS tree')
+                connection.execute('CREATE TABLE metadata (cpv TEXT, '
+                        'installed INTEGER, mtime REAL, %s, '
+                        'PRIMARY KEY (cpv, installed))' % columns)
+                connection.execute('CREATE TABLE tree (state TEXT)')
+                connection.execute('PRAGMA user_version = %d' %
+                        self.DB_VERSION)
+                connection.commit()
+        except (OSError, sqlite3.Error):
+            # the cache is only kept in memory then
+            return None
+        return connection
+
+    def _get_mtime(self, cpv, installed):
+        try:
+            if installed:
+                return os.stat(self.pvar.vardb.getpath(cpv)).st_mtime
+            return os.stat(self.pvar.portdb.findname(cpv)).st_mtime
+        except (OSError, TypeError):
+            # findname returns None if there is no ebuild
+            return None
+
+    def _get_tree_state(self):
+        state = []
+        for tree in self.pvar.portdb.porttrees:
+            paths = [os.path.join(tree, 'metadata', 'timestamp.chk')]
+            eclass_dir = os.path.join(tree, 'eclass')
+            try:
+                paths.extend([os.path.join(eclass_dir, name)
+                        for name in sorted(os.listdir(eclass_dir))
+                        if name.endswith('.eclass')])
+            except OSError:
+                pass
+            for path in paths:
+                try:
+                    state.append('%s:%s' % (path, os.stat(path).st_mtime))
+                except OSError:
+                    continue
+        return '\n'.join(state)
+
+    def _check_tree(self):
+        '''
+        Drop the entries of not installed packages if the trees changed
+        '''
+        self._tree_checked = True
+        state = self._get_tree_state()
+        if state == self._tree_state:
+            return
+        if self._tree_state is not None:
+            for key in self._entries.keys():
+                if not key[1]:
+                    del self._entries[key]
+            self._pending = [entry for entry in self._pending if entry[1]]
+        self._tree_state = state
+        if not self._connection:
+            return
+        try:
+            row = self._connection.execute('SELECT state FROM tree').fetchone()
+            if row and row[0] == state:
+                return
+            self._connection.execute('DELETE FROM metadata '
+                    'WHERE installed = 0')
+            self._connection.execute('DELETE FROM tree')
+            self._connection.execute('INSERT INTO tree VALUES (?)', (state,))
+            self._connection.commit()
+        except sqlite3.Error:
+            pass
+
+    def _read_database(self, keys, mtimes):
+        found = []
+        try:
+            for key in keys:
+                row = self._connection.execute('SELECT * FROM metadata '
+                        'WHERE cpv = ? AND installed = ?', key).fetchone()
+                if row and row[2] == mtimes[key]:
+                    self._entries[key] = (row[2], list(row[3:]))
+                    found.append(key)
+        except sqlite3.Error:
+            pass
+        return found
+
+    def prefetch(self, cpv_list):
+        '''
+        Make sure the metadata of all the cpvs is available, reading the
+        missing or outdated entries from the database, and then from portage.
+        '''
+        if not self._tree_checked:
+            self._check_tree()
+        keys = []
+        for cpv in cpv_list:
+            key = (cpv, self.pvar.vardb.cpv_exists(cpv))
+            if key not in self._checked:
+                keys.append(key)
+        if not keys:
+            return
+
+        mtimes = dict((key, self._get_mtime(*key)) for key in keys)
+        missing = [key for key in keys if key not in self._entries
+                or self._entries[key][0] != mtimes[key]]
+
+        if missing and self._connection:
+            found = set(self._read_database(missing, mtimes))
+            missing = [key for key in missing if key not in found]
+
+        for key in missing:
+            cpv, installed = key
+            if installed:
+                aux_get = self.pvar.vardb.aux_get
+            else:
+                aux_get = self.pvar.portdb.aux_get
+            try:
+                values = aux_get(cpv, self.KEYS)
+            except KeyError:
+                # let get() raise the error of portage
+                keys.remove(key)
+                continue
+            self._entries[key] = (mtimes[key], values)
+            if mtimes[key] is not None:
+                self._pending.append(
+                        (cpv, int(installed), mtimes[key]) + tuple(values))
+
+        self._checked.update(keys)
+        if len(self._pending) >= 1000:
+            self.flush()
+
+    def get(self, cpv, keys):
+        '''
+        Return the values of the keys, which have to be in KEYS.
+        '''
+        self.prefetch([cpv])
+        key = (cpv, self.pvar.vardb.cpv_exists(cpv))
+        if key not in self._entries:
+            raise KeyError(cpv)
+        values = self._entries[key][1]
+        return [values[self.KEYS.index(k)] for k in keys]
+
+    def flush(self):
+        '''
+        Write the new entries to the database
+        '''
+        pending = self._pending
+        self._pending = []
+        if not pending or not self._connection:
+            return
+        try:
+            self._connection.executemany('INSERT OR REPLACE INTO metadata '
+                    'VALUES (%s)' % ', '.join('?' * (len(self.KEYS) + 3)),
+                    pending)
+            self._connection.commit()
+        except sqlite3.Error:
+            pass
+
+    def end_request(self):
+        '''
+        The mtimes have to be checked again by the next request
+        '''
+        self.flush()
+        self._checked.clear()
+        self._tree_checked = False
+
 
 class PackageKitPortageMixin(object):
 
@@ -233,6 +561,7 @@ class PackageKitPortageMixin(object):
         object.__init__(self)
 
         self.pvar = PortageBridge()
+        self._metadata_cache = PortageMetadataCache(self.pvar)
         # TODO: should be removed when using non-verbose function API
         # FIXME: avoid using /dev/null, dangerous (ro fs)
         self._dev_null = open('/dev/null', 'w')
@@ -243,6 +572,7 @@ class PackageKitPortageMixin(object):
 
     # TODO: should be removed when using non-verbose function API
     def _block_output(self):
+        self.emitter.flush()
         sys.stdout = self._dev_null
         sys.stderr = self._dev_null
 
@@ -526,6 +856,13 @@ class PackageKitPortageMixin(object):
         If in_dict is True, metadata is returned in a dict object.
         If add_cache_keys is True, cached keys are added to keys in parameter.
         '''
+        if not add_cache_keys and \
+                set(keys).issubset(PortageMetadataCache.KEYS):
+            values = self._metadata_cache.get(cpv, keys)
+            if in_dict:
+                return dict(izip(keys, values))
+            return values
+
         if self._is_installed(cpv):
             aux_get = self.pvar.vardb.aux_get
             if add_cache_keys:
@@ -589,31 +926,18 @@ class PackageKitPortageMixin(object):
         if not cpv_list:
             return cpv_list
 
-        def _has_validLicense(cpv):
-            metadata = self._get_metadata(cpv, ["LICENSE", "USE", "SLOT"], True)
-            return not self.pvar.settings._getMissingLicenses(cpv, metadata)
-
-        if FILTER_FREE in filters or FILTER_NOT_FREE in filters:
-            free_licenses = "@FSF-APPROVED"
-            if FILTER_FREE in filters:
-                licenses = "-* " + free_licenses
-            elif FILTER_NOT_FREE in filters:
-                licenses = "* -" + free_licenses
-            backup_license = self.pvar.settings["ACCEPT_LICENSE"]
-
-            self.pvar.settings.unlock()
-            self.pvar.settings["ACCEPT_LICENSE"] = licenses
-            self.pvar.settings.backup_changes("ACCEPT_LICENSE")
-            self.pvar.settings.regenerate()
-
-            cpv_list = filter(_has_validLicense, cpv_list)
+        if FILTER_FREE in filters:
+            index = 0
+        elif FILTER_NOT_FREE in filters:
+            index = 1
+        else:
+            return cpv_list
 
-            self.pvar.settings["ACCEPT_LICENSE"] = backup_license
-            self.pvar.settings.backup_changes("ACCEPT_LICENSE")
-            self.pvar.settings.regenerate()
-            self.pvar.settings.lock()
+        def _has_validLicense(cpv):
+            license_str, use = self._get_metadata(cpv, ["LICENSE", "USE"])
+            return self.pvar.get_license_freeness(license_str, use)[index]
 
-        return cpv_list
+        return filter(_has_validLicense, cpv_list)
 
     def _filter_newest(self, cpv_list, filters):
         if len(cpv_list) == 0:
@@ -660,13 +984,9 @@ class PackageKitPortageMixin(object):
         if FILTER_INSTALLED in filters:
             cp_list = self.pvar.vardb.cp_all()
         elif FILTER_NOT_INSTALLED in filters:
-            cp_list = self.pvar.portdb.cp_all()
+            cp_list = list(self.pvar.get_available_cp())
         else:
-            # need installed packages first
-            cp_list = self.pvar.vardb.cp_all()
-            for cp in self.pvar.portdb.cp_all():
-                if cp not in cp_list:
-                    cp_list.append(cp)
+            cp_list = self.pvar.get_all_cp()
 
         return cp_list
 
@@ -685,14 +1005,17 @@ class PackageKitPortageMixin(object):
         if FILTER_INSTALLED in filters:
             cpv_list = self.pvar.vardb.match(cp)
         elif FILTER_NOT_INSTALLED in filters:
-            for cpv in self.pvar.portdb.match(cp):
+            for cpv in self.pvar.match_available(cp):
                 if not self._is_installed(cpv):
                     cpv_list.append(cpv)
         else:
             cpv_list = self.pvar.vardb.match(cp)
-            for cpv in self.pvar.portdb.match(cp):
-                if cpv not in cpv_list:
-                    cpv_list.append(cpv)
+            installed = set(cpv_list)
+            cpv_list.extend([cpv for cpv in self.pvar.match_available(cp)
+                if cpv not in installed])
+
+        # read the metadata used by the filters at once
+        self._metadata_cache.prefetch(cpv_list)
 
         # free filter
         cpv_list = self._filter_free(cpv_list, filters)
@@ -846,6 +1169,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         PackageKitPortageMixin.__init__(self)
         PackageKitBaseBackend.__init__(self, args)
 
+    def finished(self):
+        self._metadata_cache.end_request()
+        PackageKitBaseBackend.finished(self)
+
     def _package(self, cpv, info=None):
         desc = self._get_metadata(cpv, ["DESCRIPTION"])[0]
         if not info:
@@ -1045,7 +1372,7 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         nb_cp = float(len(cp_list))
         cp_processed = 0.0
 
-        for cp in self._get_all_cp(filters):
+        for cp in cp_list:
             for cpv in self._get_all_cpv(cp, filters):
                 try:
                     self._package(cpv)
@@ -1210,7 +1537,7 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         # check if a candidate can be updated
         for cp in update_candidates:
             cpv_list_inst = self.pvar.vardb.match(cp)
-            cpv_list_avai = self.pvar.portdb.match(cp)
+            cpv_list_avai = self.pvar.match_available(cp)
 
             cpv_dict_inst = self._get_cpv_slotted(cpv_list_inst)
             cpv_dict_avai = self._get_cpv_slotted(cpv_list_avai)
@@ -1422,6 +1749,9 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         finally:
             self._unblock_output()
 
+        # the tree has changed, reload it like emerge does after a sync
+        self.pvar.update()
+
     def remove_packages(self, allowdep, autoremove, pkgs):
         return self._remove_packages(allowdep, autoremove, pkgs)
 
@@ -1588,6 +1918,9 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
                         "Failed to enable repository "+repoid+" : "+str(e))
                 return
 
+        # the overlays have changed, reload the tree and its indexes
+        self.pvar.update()
+
     def resolve(self, filters, pkgs):
         self.status(STATUS_QUERY)
         self.allow_cancel(True)
@@ -1684,6 +2017,10 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
         cpv_processed = 0.0
         is_full_path = True
 
+        # free filter
+        cpv_list = self._filter_free(cpv_list, filters)
+        nb_cpv = float(len(cpv_list))
+
         count = 0
         values_len = len(values)
         for key in values:
@@ -1693,10 +2030,6 @@ class PackageKitPortageBackend(PackageKitPortageMixin, PackageKitBaseBackend):
                 key = re.escape(key)
                 searchre = re.compile("/" + key + "$", re.IGNORECASE)
 
-            # free filter
-            cpv_list = self._filter_free(cpv_list, filters)
-            nb_cpv = float(len(cpv_list))
-
             for cpv in cpv_list:
                 for f in self._get_file_list(cpv):
                     if (is_full_path and key == f) \
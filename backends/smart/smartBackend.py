@@ -31,6 +31,7 @@ import sys
 import os
 import codecs
 import locale
+import sqlite3
 
 # TODO: move Groups to a separate class (including the lookup table)
 # TODO: move Filter to a separate class (and use "PackagekitFilter")
@@ -40,12 +41,13 @@ pkprogress = PackagekitProgress()
 pkpackage = PackagekitPackage()
 
 def needs_cache(func):
-    """ Load smart's channels, and save the cache when done. """
+    """ Load smart's channels and index them, and save the cache when done. """
     def cache_wrap(obj, *args, **kwargs):
         if not obj._cacheloaded:
             obj.status(STATUS_LOADING_CACHE)
             obj.allow_cancel(True)
             obj.ctrl.reloadChannels()
+            obj._update_search_index()
         result = None
         try:
             obj.reset()
@@ -59,6 +61,198 @@ def needs_cache(func):
     return cache_wrap
 
 
+def _glob_escape(value):
+    """ Escape the GLOB wildcards in a search value. """
+    return re.sub(r'([*?[])', r'[\1]', value)
+
+
+class SmartSearchIndex:
+    """
+    Index of the file paths, groups and description tokens of the packages
+    of every channel, used by search_file, search_group and search_details.
+
+    The index is kept in a sqlite database and a channel is only indexed
+    again when its digest has changed, so the metadata of the loaders is
+    only read after the channels have been updated. Channels without a
+    digest are indexed again by every process that uses the index.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self._path = path
+        self._connection = None
+        # the loaders without a digest indexed by this process
+        self._loaders = {}
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+        try:
+            connection = sqlite3.connect(self._path)
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.Error:
+            # keep the index in memory if the database cannot be used
+            connection = sqlite3.connect(":memory:")
+            version = None
+        connection.text_factory = str
+        if version != self.VERSION:
+            for table in ("channels", "packages", "paths", "tokens",
+                          "postings"):
+                connection.execute("DROP TABLE IF EXISTS %s" % table)
+            connection.execute("CREATE TABLE channels "
+                               "(alias TEXT PRIMARY KEY, digest TEXT)")
+            connection.execute("CREATE TABLE packages "
+                               "(pkgid INTEGER PRIMARY KEY, alias TEXT, "
+                               "name TEXT, pkgkey TEXT, grp TEXT, "
+                               "description TEXT)")
+            connection.execute("CREATE INDEX packages_alias "
+                               "ON packages (alias)")
+            connection.execute("CREATE INDEX packages_grp ON packages (grp)")
+            connection.execute("CREATE TABLE paths (path TEXT, pkgid INTEGER)")
+            connection.execute("CREATE INDEX paths_path ON paths (path)")
+            connection.execute("CREATE INDEX paths_pkgid ON paths (pkgid)")
+            connection.execute("CREATE TABLE tokens "
+                               "(tokenid INTEGER PRIMARY KEY, "
+                               "token TEXT UNIQUE)")
+            connection.execute("CREATE TABLE postings "
+                               "(tokenid INTEGER, pkgid INTEGER)")
+            connection.execute("CREATE INDEX postings_tokenid "
+                               "ON postings (tokenid)")
+            connection.execute("CREATE INDEX postings_pkgid "
+                               "ON postings (pkgid)")
+            connection.execute("PRAGMA user_version = %d" % self.VERSION)
+            connection.commit()
+        self._connection = connection
+        return connection
+
+    def _remove_channel(self, alias):
+        connection = self._connect()
+        connection.execute("DELETE FROM paths WHERE pkgid IN "
+                           "(SELECT pkgid FROM packages WHERE alias = ?)",
+                           (alias,))
+        connection.execute("DELETE FROM postings WHERE pkgid IN "
+                           "(SELECT pkgid FROM packages WHERE alias = ?)",
+                           (alias,))
+        connection.execute("DELETE FROM packages WHERE alias = ?", (alias,))
+        connection.execute("DELETE FROM channels WHERE alias = ?", (alias,))
+
+    def _add_loader(self, loader, alias, digest):
+        connection = self._connect()
+        self._remove_channel(alias)
+        paths = []
+        postings = []
+        for package in loader.getPackages():
+            info = loader.getInfo(package)
+            description = info.getDescription() or ""
+            cursor = connection.execute("INSERT INTO packages "
+                                        "(alias, name, pkgkey, grp, "
+                                        "description) "
+                                        "VALUES (?, ?, ?, ?, ?)",
+                                        (alias, package.name, str(package),
+                                         info.getGroup() or "", description))
+            pkgid = cursor.lastrowid
+            paths.extend([(path, pkgid) for path in info.getPathList()])
+            postings.extend([(token, pkgid)
+                             for token in set(description.split())])
+        connection.executemany("INSERT INTO paths VALUES (?, ?)", paths)
+        connection.executemany("INSERT OR IGNORE INTO tokens (token) "
+                               "VALUES (?)",
+                               set((token,) for token, pkgid in postings))
+        tokenids = dict(connection.execute("SELECT token, tokenid "
+                                           "FROM tokens"))
+        connection.executemany("INSERT INTO postings VALUES (?, ?)",
+                               [(tokenids[token], pkgid)
+                                for token, pkgid in postings])
+        connection.execute("INSERT INTO channels VALUES (?, ?)",
+                           (alias, digest))
+
+    def update(self, cache):
+        """
+        Index the channels which are new or have changed, and forget the
+        ones which are gone.
+        """
+        connection = self._connect()
+        stored = dict(connection.execute("SELECT alias, digest FROM channels"))
+        current = set()
+        changed = False
+        for loader in cache.getLoaders():
+            channel = loader.getChannel()
+            alias = channel.getAlias()
+            digest = None
+            if hasattr(channel, "getDigest"):
+                digest = channel.getDigest()
+            current.add(alias)
+            if digest is None:
+                # the loader is only known to be unchanged in this process,
+                # so no digest is stored and the next process indexes it
+                if self._loaders.get(alias) is not loader:
+                    self._add_loader(loader, alias, None)
+                    self._loaders[alias] = loader
+                    changed = True
+            elif stored.get(alias) != str(digest):
+                self._add_loader(loader, alias, str(digest))
+                self._loaders.pop(alias, None)
+                changed = True
+        for alias in stored:
+            if alias not in current:
+                self._remove_channel(alias)
+                changed = True
+        if not changed:
+            return
+        # drop the tokens which are not used by any package any more
+        connection.execute("DELETE FROM tokens WHERE tokenid NOT IN "
+                           "(SELECT tokenid FROM postings)")
+        connection.commit()
+
+    def find_paths(self, paths):
+        """
+        Return the (alias, name, pkgkey) of the packages owning the paths.
+        """
+        connection = self._connect()
+        found = set()
+        for path in paths:
+            found.update(connection.execute("SELECT p.alias, p.name, "
+                                            "p.pkgkey "
+                                            "FROM paths f JOIN packages p "
+                                            "ON p.pkgid = f.pkgid "
+                                            "WHERE f.path = ?", (path,)))
+        return found
+
+    def get_groups(self):
+        """ Return the distinct groups of the indexed packages. """
+        connection = self._connect()
+        return [row[0] for row in
+                connection.execute("SELECT DISTINCT grp FROM packages")]
+
+    def find_group(self, group):
+        """ Return the (alias, name, pkgkey) of the packages of a group. """
+        connection = self._connect()
+        return connection.execute("SELECT alias, name, pkgkey FROM packages "
+                                  "WHERE grp = ?", (group,)).fetchall()
+
+    def find_description(self, value):
+        """
+        Return the (alias, name, pkgkey) of the packages whose description
+        contains the value.
+        """
+        connection = self._connect()
+        if value and len(value.split()) == 1 and value == value.strip():
+            # a value without whitespace is only found inside of a token
+            return connection.execute("SELECT DISTINCT p.alias, p.name, "
+                                      "p.pkgkey "
+                                      "FROM tokens t JOIN postings o "
+                                      "ON o.tokenid = t.tokenid "
+                                      "JOIN packages p ON p.pkgid = o.pkgid "
+                                      "WHERE t.token GLOB ?",
+                                      ("*%s*" % _glob_escape(value),)
+                                      ).fetchall()
+        return [(alias, name, pkgkey) for alias, name, pkgkey, description in
+                connection.execute("SELECT alias, name, pkgkey, description "
+                                   "FROM packages")
+                if value in description]
+
+
 class PackageKitSmartInterface(Interface):
 
     def __init__(self, ctrl, backend):
@@ -158,6 +352,7 @@ class PackageKitSmartBackend(PackageKitBaseBackend):
 
         self._package_list = []
         self._packagesdict = None
+        self._search_index = None
 
     def status(self, state):
         PackageKitBaseBackend.status(self, state)
@@ -519,20 +714,16 @@ class PackageKitSmartBackend(PackageKitBaseBackend):
     def search_file(self, filters, searchstrings):
         self.status(STATUS_QUERY)
         self.allow_cancel(True)
-        packages = self.ctrl.getCache().getPackages()
-        for package in packages:
-            if self._package_passes_filters(package, filters):
-                paths = []
-                for loader in package.loaders:
-                    if package.installed and not loader.getInstalled():
-                        continue
-                    info = loader.getInfo(package)
-                    paths = info.getPathList()
-                    if len(paths) > 0:
-                        break
-                for searchstring in searchstrings:
-                    if searchstring in paths:
-                        self._add_package(package)
+        index = self._search_index
+        found = set()
+        for package, loader in \
+        self._get_indexed_packages(index.find_paths(searchstrings)):
+            if package.installed and not loader.getInstalled():
+                continue
+            if package not in found and \
+            self._package_passes_filters(package, filters):
+                found.add(package)
+                self._add_package(package)
         self._post_process_package_list(filters)
         self._show_package_list()
 
@@ -544,14 +735,25 @@ class PackageKitSmartBackend(PackageKitBaseBackend):
         for searchstring in searchstrings:
             if searchstring.find("desktop") != -1:
                 filter_desktops = True
-        packages = self.ctrl.getCache().getPackages()
-        for package in packages:
-            if self._package_passes_filters(package, filters):
-                info = package.loaders.keys()[0].getInfo(package)
-                group = self._get_group(info, filter_desktops)
-                for searchstring in searchstrings:
-                    if searchstring in group:
-                        self._add_package(package)
+        index = self._search_index
+        groups = {}
+        for group in index.get_groups():
+            # the package name is needed to map some of the groups
+            if group in self.NAMED_GROUPS or \
+            [searchstring for searchstring in searchstrings
+             if searchstring in self._map_group(group)]:
+                for row in index.find_group(group):
+                    groups[row] = group
+        for package, loader in self._get_indexed_packages(groups.keys()):
+            if loader is not package.loaders.keys()[0]:
+                continue
+            group = groups[(loader.getChannel().getAlias(), package.name,
+                            str(package))]
+            group = self._map_group(group, package.name, filter_desktops)
+            if [searchstring for searchstring in searchstrings
+                if searchstring in group] and \
+            self._package_passes_filters(package, filters):
+                self._add_package(package)
         self._post_process_package_list(filters)
         self._show_package_list()
 
@@ -559,14 +761,16 @@ class PackageKitSmartBackend(PackageKitBaseBackend):
     def search_details(self, filters, searchstrings):
         self.status(STATUS_QUERY)
         self.allow_cancel(True)
-        packages = self.ctrl.getCache().getPackages()
-        for package in packages:
-            if self._package_passes_filters(package, filters):
-                info = package.loaders.keys()[0].getInfo(package)
-                desc = info.getDescription()
-                for searchstring in searchstrings:
-                    if searchstring in desc:
-                        self._add_package(package)
+        index = self._search_index
+        rows = set()
+        for searchstring in searchstrings:
+            rows.update(index.find_description(searchstring))
+        for package, loader in self._get_indexed_packages(rows):
+            if loader is package.loaders.keys()[0] and \
+            self._package_passes_filters(package, filters):
+                self._add_package(package)
+        self._post_process_package_list(filters)
+        self._show_package_list()
 
     @needs_cache
     def get_packages(self, filters):
@@ -586,6 +790,7 @@ class PackageKitSmartBackend(PackageKitBaseBackend):
         self.ctrl.rebuildSysConfChannels()
         self.ctrl.reloadChannels(None, caching=smart.const.NEVER)
         self.ctrl.saveSysConf()
+        self._update_search_index()
 
     GROUPS = {
     # RPM (redhat)
@@ -1170,17 +1375,24 @@ class PackageKitSmartBackend(PackageKitBaseBackend):
                             return True
         return False
 
+    # groups which are mapped depending on the package name
+    NAMED_GROUPS = ('User Interface/X', 'Applications/Productivity',
+                    'User Interface/Desktops')
+
     def _get_group(self, info, filter_desktops=True):
-        group = info.getGroup()
+        return self._map_group(info.getGroup(), info.getPackage().name,
+                               filter_desktops)
+
+    def _map_group(self, group, package=None, filter_desktops=True):
         if group in self.GROUPS:
-            package = info.getPackage().name
-            if group == 'User Interface/X' and \
+            if group == 'User Interface/X' and package and \
             package.find('-fonts') != -1:
                 return GROUP_FONTS
-            if group == 'Applications/Productivity' and \
+            if group == 'Applications/Productivity' and package and \
             package.find('-langpack') != -1:
                 return GROUP_LOCALIZATION
-            if group == 'User Interface/Desktops' and filter_desktops:
+            if group == 'User Interface/Desktops' and package and \
+            filter_desktops:
                 if self._package_in_requires(package, "^gnome-desktop") or \
                 self._package_in_requires(package, "^gnome-desktop-optional"):
                     return GROUP_DESKTOP_GNOME
@@ -1201,6 +1413,37 @@ class PackageKitSmartBackend(PackageKitBaseBackend):
                 group = GROUP_UNKNOWN
         return group
 
+    def _update_search_index(self):
+        """ Bring the search index up to date with the loaded channels. """
+        if self._search_index is None:
+            path = os.path.join(smart.sysconf.get("data-dir"),
+                                "packagekit-search.sqlite")
+            self._search_index = SmartSearchIndex(path)
+        self._search_index.update(self.ctrl.getCache())
+        return self._search_index
+
+    def _get_indexed_packages(self, rows):
+        """
+        Map the (alias, name, pkgkey) rows of the search index to the
+        matching (package, loader) tuples.
+        """
+        cache = self.ctrl.getCache()
+        loaders = {}
+        for loader in cache.getLoaders():
+            loaders[loader.getChannel().getAlias()] = loader
+        result = []
+        seen = set()
+        for alias, name, pkgkey in rows:
+            loader = loaders.get(alias)
+            if loader is None:
+                continue
+            for package in cache.getPackages(name):
+                if str(package) == pkgkey and loader in package.loaders and \
+                (package, loader) not in seen:
+                    seen.add((package, loader))
+                    result.append((package, loader))
+        return result
+
     def _get_status(self, package):
         for loader in package.loaders:
             if hasattr(loader, 'getErrata'):
@@ -48,6 +48,7 @@ import rpmUtils
 import exceptions
 import types
 import signal
+import select
 import time
 import os.path
 import logging
@@ -61,6 +62,7 @@ import ConfigParser
 
 from yumFilter import *
 from yumComps import *
+from yumSearchIndex import *
 
 # Global vars
 yumbase = None
@@ -258,12 +260,37 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
             self.infra_packages = []
         except Exception, e:
             raise PkError(ERROR_REPO_CONFIGURATION_ERROR, "Failed to load Yum.conf: %s" % _to_unicode(e))
+        try:
+            self.parallel_downloads = config.getint('Backend', 'ParallelDownloadsPerRepo')
+        except ConfigParser.NoOptionError, e:
+            self.parallel_downloads = 3
+        except Exception, e:
+            raise PkError(ERROR_REPO_CONFIGURATION_ERROR, "Failed to load Yum.conf: %s" % _to_unicode(e))
+        try:
+            self.parallel_downloads_total = config.getint('Backend', 'ParallelDownloads')
+        except ConfigParser.NoOptionError, e:
+            self.parallel_downloads_total = 8
+        except Exception, e:
+            raise PkError(ERROR_REPO_CONFIGURATION_ERROR, "Failed to load Yum.conf: %s" % _to_unicode(e))
+        try:
+            self.parallel_refresh = config.getint('Backend', 'ParallelRefreshRepos')
+        except ConfigParser.NoOptionError, e:
+            self.parallel_refresh = 4
+        except Exception, e:
+            raise PkError(ERROR_REPO_CONFIGURATION_ERROR, "Failed to load Yum.conf: %s" % _to_unicode(e))
 
         # get the lock early
         if lock:
             self.doLock()
 
         self.package_summary_cache = {}
+        self.package_cache = PackageIdCache()
+
+        # searches fall back to yum if the index cannot be used
+        self.search_index = yumSearchIndex(self.yumbase)
+        if not self.search_index.connect():
+            self.search_index = None
+
         self.comps = yumComps(self.yumbase)
         if not self.comps.connect():
             self.refresh_cache(True)
@@ -378,6 +405,7 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
         ''' Unlock Yum'''
         if self.isLocked():
             PackageKitBaseBackend.unLock(self)
+            self.package_cache.clear()
             try:
                 self.yumbase.closeRpmDB()
                 self.yumbase.doUnlock(YUM_PID_FILE)
@@ -419,8 +447,11 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
             installed = []
             available = []
             try:
-                res = self.yumbase.searchGenerator(searchlist, values)
-                for (pkg, inst) in res:
+                pkgs = self._do_index_search(searchlist, values)
+                if pkgs is None:
+                    res = self.yumbase.searchGenerator(searchlist, values)
+                    pkgs = [pkg for (pkg, inst) in res]
+                for pkg in pkgs:
                     if pkg.repo.id.startswith('installed'):
                         installed.append(pkg)
                     else:
@@ -439,6 +470,21 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
                 package_list = pkgfilter.get_package_list()
                 self._show_package_list(package_list)
 
+    def _do_index_search(self, searchlist, values):
+        '''
+        Search for yum packages using the search index
+        Returns None if the index cannot answer the query
+        '''
+        if not self.search_index:
+            return None
+        if searchlist == ['name']:
+            details = False
+        elif searchlist == ['name', 'summary', 'description', 'group']:
+            details = True
+        else:
+            return None
+        return self.search_index.search(values, details)
+
     def _show_package_list(self, lst):
         for (pkg, status) in lst:
             self._show_package(pkg, status)
@@ -594,7 +640,6 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
             raise PkError(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
         if len(repos) == 0:
             raise PkError(ERROR_REPO_NOT_FOUND, "cannot find repo %s" % repo_id)
-        print "found repos"
 
         # the repo might have been disabled if it is no longer contactable
         if not repos[0].isEnabled():
@@ -1079,12 +1124,11 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
         self.yumbase.conf.cache = 0 # Allow new files
         self.allow_cancel(True)
         self.status(STATUS_DOWNLOAD)
-        percentage = 0
-        bump = 100 / len(package_ids)
+        self.percentage(0)
 
-        # download each package
+        # find all the packages before we start downloading
+        pkgs = []
         for package_id in package_ids:
-            self.percentage(percentage)
             try:
                 pkg, inst = self._findPackage(package_id)
             except PkError, e:
@@ -1095,62 +1139,189 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
                 self.message(MESSAGE_COULD_NOT_FIND_PACKAGE, "Could not find the package %s" % package_id)
                 continue
 
-            n, a, e, v, r = pkg.pkgtup
-            try:
-                packs = self.yumbase.pkgSack.searchNevra(n, e, v, r, a)
-            except yum.Errors.RepoError, e:
-                self.error(ERROR_NO_CACHE, "failed to search package sack: %s" %_to_unicode(e), exit=False)
-                return
-            except exceptions.IOError, e:
-                self.error(ERROR_NO_SPACE_ON_DEVICE, "Disk error: %s" % _to_unicode(e))
-            except Exception, e:
-                self.error(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
+            # installed packages have to be downloaded from a repo with the same nevra
+            if inst:
+                n, a, e, v, r = pkg.pkgtup
+                try:
+                    packs = self.yumbase.pkgSack.searchNevra(n, e, v, r, a)
+                except yum.Errors.RepoError, e:
+                    self.error(ERROR_NO_CACHE, "failed to search package sack: %s" %_to_unicode(e), exit=False)
+                    return
+                except exceptions.IOError, e:
+                    self.error(ERROR_NO_SPACE_ON_DEVICE, "Disk error: %s" % _to_unicode(e))
+                except Exception, e:
+                    self.error(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
 
-            # if we couldn't map package_id -> pkg
-            if len(packs) == 0:
-                self.message(MESSAGE_COULD_NOT_FIND_PACKAGE, "Could not find a match for package %s" % package_id)
-                continue
+                # if we couldn't map package_id -> pkg
+                if len(packs) == 0:
+                    self.message(MESSAGE_COULD_NOT_FIND_PACKAGE, "Could not find a match for package %s" % package_id)
+                    continue
 
-            # choose the first entry, as the same NEVRA package in multiple repos is fine
-            pkg_download = packs[0]
-            self._show_package(pkg_download, INFO_DOWNLOADING)
-            try:
-                repo = self.yumbase.repos.getRepo(pkg_download.repoid)
-            except exceptions.IOError, e:
-                self.error(ERROR_NO_SPACE_ON_DEVICE, "Disk error: %s" % _to_unicode(e))
-            except Exception, e:
-                self.error(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
-            remote = pkg_download.returnSimple('relativepath')
+                # choose the first entry, as the same NEVRA package in multiple repos is fine
+                pkg = packs[0]
+            pkgs.append(pkg)
+
+        if directory and not os.path.exists(directory):
+            self.error(ERROR_PACKAGE_DOWNLOAD_FAILED, "No destination directory exists", exit=False)
+            return
+
+        # work out where each package goes
+        jobs = []
+        for pkg in pkgs:
+            local = None
             if directory:
-                local = os.path.basename(remote)
-                if not os.path.exists(directory):
-                    self.error(ERROR_PACKAGE_DOWNLOAD_FAILED, "No destination directory exists", exit=False)
-                    return
-                local = os.path.join(directory, local)
-                if (os.path.exists(local) and os.path.getsize(local) == int(pkg_download.returnSimple('packagesize'))):
+                local = os.path.join(directory, os.path.basename(pkg.returnSimple('relativepath')))
+                if (os.path.exists(local) and os.path.getsize(local) == int(pkg.returnSimple('packagesize'))):
                     self.error(ERROR_PACKAGE_DOWNLOAD_FAILED, "Package already exists as %s" % local, exit=False)
                     return
-            # Disable cache otherwise things won't download
-            repo.cache = 0
+            # load what the download needs from the sack before forking
+            pkg.returnIdSum()
+            jobs.append((pkg, local))
+            self._show_package(pkg, INFO_DOWNLOADING)
 
-            #  set the localpath we want
-            if directory:
-                pkg_download.localpath = local
-            try:
-                path = repo.getPackage(pkg_download)
+        self.dnlCallback.setPackages(pkgs, 0, 100)
+        downloads = self._download_packages_parallel(jobs)
+        try:
+            for pkg, path, error in downloads:
+                if error:
+                    self.error(ERROR_PACKAGE_DOWNLOAD_FAILED, "Cannot download %s: %s" % (pkg.name, error), exit=False)
+                    return
 
                 # emit the file we downloaded
-                package_id_tmp = self._pkg_to_id(pkg_download)
+                package_id_tmp = self._pkg_to_id(pkg)
                 self.files(package_id_tmp, path)
-
-            except IOError, e:
-                self.error(ERROR_PACKAGE_DOWNLOAD_FAILED, "Cannot write to file", exit=False)
-                return
-            percentage += bump
+                self.dnlCallback.finishedPackage(pkg)
+        finally:
+            # stop the downloads which are still running
+            downloads.close()
 
         # in case we don't sum to 100
         self.percentage(100)
 
+    def _download_packages_parallel(self, jobs):
+        '''
+        Download a list of (pkg, localpath) with up to parallel_downloads
+        packages being downloaded from each repo, and parallel_downloads_total
+        packages in all, at the same time.
+        Yields (pkg, path, error) for each package as it finishes.
+        '''
+        # share the packages of each repo out over a number of lanes,
+        # which are each downloaded in turn by one child
+        lanes = []
+        repo_jobs = {}
+        for index in range(len(jobs)):
+            repo_jobs.setdefault(jobs[index][0].repoid, []).append(index)
+        for indexes in repo_jobs.values():
+            count = min(self.parallel_downloads, len(indexes))
+            for i in range(count):
+                lanes.append(indexes[i::count])
+
+        # the lanes over the limit are merged into the others
+        count = max(1, self.parallel_downloads_total)
+        if len(lanes) > count:
+            lanes = [sum(lanes[i::count], []) for i in range(count)]
+
+        for index, path, error in self._run_forked(lanes, lambda index: self._download_job(jobs[index])):
+            yield jobs[index][0], path, error
+
+    def _download_job(self, job):
+        '''
+        Download one (pkg, localpath), returning the path it was saved to
+        '''
+        pkg, local = job
+        repo = self.yumbase.repos.getRepo(pkg.repoid)
+
+        # Disable cache otherwise things won't download
+        repo.cache = 0
+
+        #  set the localpath we want
+        if local:
+            pkg.localpath = local
+        return repo.getPackage(pkg)
+
+    def _run_forked(self, lanes, func):
+        '''
+        Call func(index) for every index in the lanes, with one child
+        process per lane working through its indexes in turn.
+        Yields (index, result, error) as each call finishes.
+
+        The work is done in child processes rather than threads, as
+        urlgrabber cannot be used from more than one thread. The children
+        inherit the yum lock and the open rpmdb and sqlite handles, so they
+        must not close them: they only download into the cache and always
+        leave with os._exit. Every child is killed and waited for if the
+        caller stops early or anything fails.
+        '''
+        # the children must not send signals, so disable the download meter
+        self.emitter.flush()
+        self.yumbase.repos.setProgressBar(None)
+        children = {}
+        try:
+            for lane in lanes:
+                fd_read, fd_write = os.pipe()
+                try:
+                    pid = os.fork()
+                except OSError:
+                    os.close(fd_read)
+                    os.close(fd_write)
+                    raise
+                if pid == 0:
+                    os.close(fd_read)
+                    self._run_lane(lane, func, fd_write)
+                children[fd_read] = (pid, '')
+                os.close(fd_write)
+
+            # each finished call is reported as index<TAB>result<TAB>error
+            while children:
+                readable = select.select(children.keys(), [], [])[0]
+                for fd in readable:
+                    pid, buf = children[fd]
+                    data = os.read(fd, 4096)
+                    if not data:
+                        os.close(fd)
+                        os.waitpid(pid, 0)
+                        del children[fd]
+                        continue
+                    lines = (buf + data).split('\n')
+                    children[fd] = (pid, lines.pop())
+                    for line in lines:
+                        index, result, error = line.split('\t', 2)
+                        yield int(index), result, error
+        finally:
+            for fd, (pid, buf) in children.items():
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError, e:
+                    pass
+            for fd, (pid, buf) in children.items():
+                try:
+                    os.close(fd)
+                except OSError, e:
+                    pass
+                try:
+                    os.waitpid(pid, 0)
+                except OSError, e:
+                    pass
+            self.yumbase.repos.setProgressBar(self.dnlCallback)
+
+    def _run_lane(self, lane, func, fd):
+        '''
+        Runs in a child process: call func for the indexes in the lane one
+        after another, and report each one on fd
+        '''
+        signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+        try:
+            for index in lane:
+                result = ''
+                error = ''
+                try:
+                    result = func(index) or ''
+                except Exception, e:
+                    error = _format_str(_to_unicode(e)).replace('\t', ' ').encode('utf-8')
+                os.write(fd, "%i\t%s\t%s\n" % (index, result, error))
+        finally:
+            os._exit(0)
+
     def _is_meta_package(self, package_id):
         grp = None
         if len(package_id.split(';')) > 1:
@@ -1181,6 +1352,19 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
         return grp
 
     def _findPackage(self, package_id):
+        '''
+        find a package based on a package id (name;version;arch;repoid),
+        using the packages found by earlier calls where possible
+        '''
+        pkg_inst = self.package_cache.get(package_id)
+        if pkg_inst:
+            return pkg_inst
+        pkg, inst = self._findPackageUncached(package_id)
+        if pkg:
+            self.package_cache.add(package_id, (pkg, inst))
+        return pkg, inst
+
+    def _findPackageUncached(self, package_id):
         '''
         find a package based on a package id (name;version;arch;repoid)
         '''
@@ -1806,47 +1990,68 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
         self.allow_cancel(True)
         self.percentage(0)
         self.status(STATUS_REFRESH_CACHE)
+        self.package_cache.clear()
 
         # we are working offline
         if not self.has_network:
             self.error(ERROR_NO_NETWORK, "cannot refresh cache when offline", exit=False)
             return
 
-        pct = 0
         try:
-            if len(self.yumbase.repos.listEnabled()) == 0:
+            repos = self.yumbase.repos.listEnabled()
+            if len(repos) == 0:
                 self.percentage(100)
                 return
 
-            #work out the slice for each one
-            bump = (95/len(self.yumbase.repos.listEnabled()))/2
-
-            for repo in self.yumbase.repos.listEnabled():
-
-                # emit details for UI
+            # emit details for UI
+            for repo in repos:
                 self.repo_detail(repo.id, repo.name, True)
 
-                # is physical media
-                if repo.mediaid:
-                    continue
+            # download the metadata of the network repos into the cache at
+            # the same time, each repo being reported as it finishes; the
+            # physical media are skipped as they were before
+            network = [repo for repo in repos if not repo.mediaid]
+            count = min(self.parallel_refresh, len(network))
+            lanes = [range(i, len(network), count) for i in range(count)]
+            done = 0
+            refreshed = set()
+            for index, result, error in self._run_forked(lanes, lambda index: self._refresh_repo(network[index])):
+                done += 1
+                if not error:
+                    refreshed.add(index)
+                self.percentage(80 * done / len(network))
+
+            # read back the repomd.xml the children downloaded
+            for index in refreshed:
+                del network[index].repoXML
+
+            # refresh the repos that failed again here, so that the errors
+            # are reported the usual way
+            self.percentage(80)
+            failed = [repo for index, repo in enumerate(network) if index not in refreshed]
+            for i, repo in enumerate(failed):
                 repo.metadata_expire = 0
                 self.yumbase.repos.populateSack(which=[repo.id], mdtype='metadata', cacheonly=1)
-                pct += bump
-                self.percentage(pct)
+                self.percentage(80 + (30 * i + 15) / (2 * len(failed)))
                 self.yumbase.repos.populateSack(which=[repo.id], mdtype='filelists', cacheonly=1)
-                pct += bump
-                self.percentage(pct)
+                self.percentage(80 + 15 * (i + 1) / len(failed))
 
             self.percentage(95)
-            # Setup categories/groups
-            try:
-                self.yumbase.doGroupSetup()
-            except yum.Errors.GroupsError, e:
-                pass
-            except exceptions.IOError, e:
-                self.error(ERROR_NO_SPACE_ON_DEVICE, "Disk error: %s" % _to_unicode(e))
-            except Exception, e:
-                self.error(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
+            # bring the search index up to date with the new metadata
+            if self.search_index:
+                self.search_index.update()
+
+            # Setup categories/groups, if any of them has changed
+            comps_changed = not self.comps.is_current()
+            if comps_changed:
+                try:
+                    self.yumbase.doGroupSetup()
+                except yum.Errors.GroupsError, e:
+                    pass
+                except exceptions.IOError, e:
+                    self.error(ERROR_NO_SPACE_ON_DEVICE, "Disk error: %s" % _to_unicode(e))
+                except Exception, e:
+                    self.error(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
             #we might have a rounding error
             self.percentage(100)
 
@@ -1862,7 +2067,19 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
             self.error(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
         else:
             # update the comps groups too
-            self.comps.refresh()
+            if comps_changed:
+                self.comps.refresh()
+
+    def _refresh_repo(self, repo):
+        '''
+        Runs in a child process: download the metadata, filelists and comps
+        of a repo into the cache, so loading them afterwards is quick
+        '''
+        repo.metadata_expire = 0
+        self.yumbase.repos.populateSack(which=[repo.id], mdtype='metadata', cacheonly=1)
+        self.yumbase.repos.populateSack(which=[repo.id], mdtype='filelists', cacheonly=1)
+        if get_repo_checksum(repo, 'group'):
+            repo.getGroups()
 
     def resolve(self, filters, packages):
         '''
@@ -2442,8 +2659,12 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
         try:
             rpmDisplay = PackageKitCallback(self)
             callback = ProcessTransPackageKitCallback(self)
+            self.package_cache.clear()
             self.yumbase.processTransaction(callback=callback,
                                   rpmDisplay=rpmDisplay)
+            # keep the installed rows of the index in step with the rpmdb
+            if self.search_index:
+                self.search_index.update_installed()
         except yum.Errors.YumDownloadError, ye:
             raise PkError(ERROR_PACKAGE_DOWNLOAD_FAILED, _format_msgs(ye.value))
         except yum.Errors.YumGPGCheckError, ye:
@@ -2762,6 +2983,7 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
 
         # clear the package sack so we can get new updates
         self.yumbase.pkgSack = None
+        self.package_cache.clear()
 
         package_list = []
         pkgfilter = YumFilter(filters)
@@ -2840,6 +3062,7 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
             return
         self.yumbase.conf.cache = 0 # Allow new files
         self.status(STATUS_INFO)
+        self.package_cache.clear()
         try:
             repo = self.yumbase.repos.getRepo(repoid)
             if not enable:
@@ -2866,7 +3089,8 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
             self.error(ERROR_INTERNAL_ERROR, _format_str(traceback.format_exc()))
 
         # update the comps groups too
-        self.comps.refresh()
+        if not self.comps.is_current():
+            self.comps.refresh()
 
     def get_repo_list(self, filters):
         '''
@@ -3087,6 +3311,7 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
             self.error(e.code, e.details, exit=False)
             return
         self.yumbase.conf.cache = 0 # Allow new files
+        self.package_cache.clear()
         # Get the repo
         try:
             repo = self.yumbase.repos.getRepo(repoid)
@@ -3181,12 +3406,14 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
                     root = self.yumbase._media_find_root(repo.mediaid)
                     if not root:
                         self.yumbase.repos.disableRepo(repo.id)
+                        self.package_cache.clear()
                         self.message(MESSAGE_REPO_METADATA_DOWNLOAD_FAILED,
                                      "Could not contact media source '%s', so it will be disabled" % repo.id)
             except exceptions.IOError, e:
                 self.error(ERROR_NO_SPACE_ON_DEVICE, "Disk error: %s" % _to_unicode(e))
             except yum.Errors.RepoError, e:
                 self.yumbase.repos.disableRepo(repo.id)
+                self.package_cache.clear()
                 self.message(MESSAGE_REPO_METADATA_DOWNLOAD_FAILED, "Could not contact source '%s', so it will be disabled" % repo.id)
 
         # should we suggest yum-complete-transaction?
@@ -3197,6 +3424,10 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
         # default to 100% unless method overrides
         self.yumbase.conf.throttle = "90%"
 
+        # forget the packages we found if the rpmdb changed, the cache is
+        # cleared by the commands that reset the sacks
+        self.package_cache.validate(get_rpmdb_checksum())
+
     def _setup_yum(self):
         try:
             # setup Yum Config
@@ -3208,12 +3439,59 @@ class PackageKitYumBackend(PackageKitBaseBackend, PackagekitPackage):
         self.dnlCallback = DownloadCallback(self, showNames=True)
         self.yumbase.repos.setProgressBar(self.dnlCallback)
 
+class PackageIdCache:
+    """
+    Least recently used cache of package_id -> (pkg, installed), so the
+    dispatcher does not search the sacks again for the same package.
+    The hits and misses attributes count the lookups.
+    """
+    def __init__(self, size=2000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._key = None
+        # package_id -> [value, last use]
+        self._cache = {}
+        self._clock = 0
+
+    def validate(self, key):
+        """ empty the cache if the state it was filled from has changed """
+        if key != self._key:
+            self.clear()
+            self._key = key
+
+    def clear(self):
+        self._cache.clear()
+
+    def get(self, package_id):
+        try:
+            entry = self._cache[package_id]
+        except KeyError:
+            self.misses += 1
+            return None
+        # mark it as the most recently used
+        self._clock += 1
+        entry[1] = self._clock
+        self.hits += 1
+        return entry[0]
+
+    def add(self, package_id, value):
+        self._clock += 1
+        self._cache[package_id] = [value, self._clock]
+        if len(self._cache) > self.size:
+            # drop the least recently used half at once, so the sort is
+            # only done every size / 2 additions
+            entries = sorted(self._cache.items(), key=lambda item: item[1][1])
+            for key, entry in entries[:len(entries) / 2]:
+                del self._cache[key]
+
 class DownloadCallback(BaseMeter):
     """ Customized version of urlgrabber.progress.BaseMeter class """
     def __init__(self, base, showNames = False):
         BaseMeter.__init__(self)
         self.base = base
         self.percent_start = 0
+        self.percent_length = 0
         self.saved_pkgs = None
         self.number_packages = 0
         self.download_package_number = 0
@@ -3222,6 +3500,19 @@ class DownloadCallback(BaseMeter):
         self.saved_pkgs = new_pkgs
         self.number_packages = float(len(self.saved_pkgs))
         self.percent_start = percent_start
+        self.percent_length = percent_length
+        self.download_package_number = 0
+
+    def finishedPackage(self, pkg):
+        '''
+        A package was downloaded without using the meter, e.g. by a child
+        process, so update the progress of the whole set of packages
+        '''
+        self.base._show_package(pkg, INFO_FINISHED)
+        self.download_package_number += 1
+        if self.number_packages > 0:
+            pct = self.percent_start + (self.percent_length * self.download_package_number / self.number_packages)
+            self.base.percentage(pct)
 
     def _getPackage(self, name):
 
@@ -21,9 +21,43 @@
 from packagekit.enums import *
 import sqlite3
 import os
+import logging
 import yum
+from yumSearchIndex import get_repo_checksum
+
+__DB_VER__ = '3'
+__GROUP_MAP__ = '/usr/share/PackageKit/helpers/yum/yum-comps-groups.conf'
+
+log = logging.getLogger('PackageKitBackend')
+
+_group_map = None
+
+def _get_group_map():
+    ''' load the map of comps groups to PackageKit groups, once per process '''
+    global _group_map
+    if _group_map is not None:
+        return _group_map
+    _group_map = {}
+    mapping = open(__GROUP_MAP__, 'r')
+    lines = mapping.readlines()
+    mapping.close()
+    for line in lines:
+        line = line.replace('\n', '')
+
+        # blank line
+        if len(line) == 0:
+            continue
+
+        # fonts=base-system;fonts,base-system;legacy-fonts
+        split = line.split('=')
+        if len(split) < 2:
+            continue
+
+        entries = split[1].split(',')
+        for entry in entries:
+            _group_map[entry] = split[0]
+    return _group_map
 
-__DB_VER__ = '1'
 class yumComps:
 
     def __init__(self, yumbase, db = None):
@@ -39,25 +73,8 @@ class yumComps:
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
 
-        # load the group map
-        self.groupMap = {}
-        mapping = open('/usr/share/PackageKit/helpers/yum/yum-comps-groups.conf', 'r')
-        lines = mapping.readlines()
-        for line in lines:
-            line = line.replace('\n', '')
-
-            # blank line
-            if len(line) == 0:
-                continue
-
-            # fonts=base-system;fonts,base-system;legacy-fonts
-            split = line.split('=')
-            if len(split) < 2:
-                continue
-
-            entries = split[1].split(',')
-            for entry in entries:
-                self.groupMap[entry] = split[0]
+        # the group map only changes when PackageKit is upgraded
+        self.groupMap = _get_group_map()
 
     def connect(self):
         ''' connect to database '''
@@ -66,7 +83,7 @@ class yumComps:
             self.connection = sqlite3.connect(self.db)
             self.cursor = self.connection.cursor()
         except Exception, e:
-            print 'cannot connect to database %s: %s' % (self.db, str(e))
+            log.warning('cannot connect to database %s: %s' % (self.db, str(e)))
             return False
 
         try:
@@ -78,7 +95,7 @@ class yumComps:
                 break
             # Check if we have the right DB version
             if not version or version != __DB_VER__:
-                print "Wrong database versions : %s needs %s " % (version, __DB_VER__)
+                log.info('Wrong database versions : %s needs %s' % (version, __DB_VER__))
                 self._make_database_tables()
         except Exception, e:
             # We couldn't get the version, so create a new database
@@ -94,20 +111,40 @@ class yumComps:
             self.connection = sqlite3.connect(self.db)
             self.cursor = self.connection.cursor()
         except Exception, e:
-            print e
+            log.warning('cannot create database %s: %s' % (self.db, str(e)))
         else:
             self.cursor.execute('CREATE TABLE groups (name TEXT, category TEXT, groupid TEXT, group_enum TEXT, pkgtype Text);')
+            self.cursor.execute('CREATE INDEX groups_name ON groups (name);')
+            self.cursor.execute('CREATE INDEX groups_groupid ON groups (groupid);')
+            self.cursor.execute('CREATE INDEX groups_category ON groups (category);')
+            self.cursor.execute('CREATE TABLE repos (repoid TEXT PRIMARY KEY, checksum TEXT);')
             self.cursor.execute('CREATE TABLE version (version TEXT);')
             self.cursor.execute('INSERT INTO version values(?);', __DB_VER__)
             self.connection.commit()
             self.refresh()
 
-    def _add_db(self, name, category, groupid, pkgroup, pkgtype):
-        ''' add an item into the database '''
-        self.cursor.execute('INSERT INTO groups values(?, ?, ?, ?, ?);', (name, category, groupid, pkgroup, pkgtype))
+    def _get_repo_checksums(self):
+        ''' the comps checksum of every enabled repo that has comps '''
+        checksums = {}
+        for repo in self.yumbase.repos.listEnabled():
+            checksum = get_repo_checksum(repo, 'group')
+            if checksum:
+                checksums[repo.id] = checksum
+        return checksums
+
+    def is_current(self):
+        ''' True if no repo's comps have changed since the last refresh '''
+        checksums = {}
+        self.cursor.execute('SELECT repoid, checksum FROM repos;')
+        for row in self.cursor:
+            checksums[row[0]] = row[1]
+        return checksums == self._get_repo_checksums()
 
     def refresh(self, force=False):
-        ''' get the data from yum (slow, REALLY SLOW) '''
+        '''
+        get the data from yum, and rewrite the groups that have changed
+        since the last refresh in a single transaction
+        '''
         try:
             cats = self.yumbase.comps.categories
         except yum.Errors.RepoError, e:
@@ -115,25 +152,45 @@ class yumComps:
         except Exception, e:
             return False
         if self.yumbase.comps.compscount == 0:
+            # there is nothing to rebuild until the comps change
+            self._store_repo_checksums()
+            self.connection.commit()
             return False
 
-        # delete old data else we get multiple entries
-        self.cursor.execute('DELETE FROM groups;')
-
-        # store to sqlite
+        # work out the rows of every group
+        rows = {}
         for category in cats:
             grps = map(lambda x: self.yumbase.comps.return_group(x),
                filter(lambda x: self.yumbase.comps.has_group(x), category.groups))
-            self._add_groups_to_db(grps, category.categoryid)
+            self._add_groups_to_rows(grps, category.categoryid, rows)
+        self._add_non_catagorized_groups(rows)
+
+        # get the rows of the groups we have already
+        old_rows = {}
+        self.cursor.execute('SELECT name, category, groupid, group_enum, pkgtype FROM groups;')
+        for row in self.cursor:
+            old_rows.setdefault(row[2], []).append(tuple(row))
+
+        # only rewrite the groups that were added, removed or changed
+        for groupid in set(old_rows.keys()) | set(rows.keys()):
+            new = sorted(rows.get(groupid, []))
+            if new == sorted(old_rows.get(groupid, [])):
+                continue
+            self.cursor.execute('DELETE FROM groups WHERE groupid = ?;', [groupid])
+            self.cursor.executemany('INSERT INTO groups values(?, ?, ?, ?, ?);', new)
+
+        # remember which comps the groups were built from
+        self._store_repo_checksums()
 
         # write to disk
         self.connection.commit()
-        print "Non Categorized groups"
-        self._add_non_catagorized_groups()
-        self.connection.commit()
         return True
 
-    def _add_groups_to_db(self, grps, cat_id):
+    def _store_repo_checksums(self):
+        self.cursor.execute('DELETE FROM repos;')
+        self.cursor.executemany('INSERT INTO repos values(?, ?);', self._get_repo_checksums().items())
+
+    def _add_groups_to_rows(self, grps, cat_id, rows):
         for group in grps:
             # strip out rpmfusion from the group name
             group_name = group.groupid
@@ -145,27 +202,28 @@ class yumComps:
             if self.groupMap.has_key(group_id):
                 group_enum = self.groupMap[group_id]
             else:
-                print 'unknown group enum', group_id
+                log.debug('unknown group enum %s' % group_id)
 
+            group_rows = []
             for package in group.mandatory_packages:
-                self._add_db(package, cat_id, group_name, group_enum, 'mandatory')
+                group_rows.append((package, cat_id, group_name, group_enum, 'mandatory'))
             for package in group.default_packages:
-                self._add_db(package, cat_id, group_name, group_enum, 'default')
+                group_rows.append((package, cat_id, group_name, group_enum, 'default'))
             for package in group.optional_packages:
-                self._add_db(package, cat_id, group_name, group_enum, 'optional')
-
+                group_rows.append((package, cat_id, group_name, group_enum, 'optional'))
+            if group_rows:
+                rows.setdefault(group_name, []).extend(group_rows)
 
-    def _add_non_catagorized_groups(self):
+    def _add_non_catagorized_groups(self, rows):
         to_add = []
         # Go through all the groups
         for grp in self.yumbase.comps.groups:
-            # check if it is already added to the db
-            if self.get_category(grp.groupid):
+            # check if it is already added
+            if rows.has_key(grp.groupid):
                 continue
             elif grp.user_visible:
                 to_add.append(grp)
-        self._add_groups_to_db(to_add, "other")
-
+        self._add_groups_to_rows(to_add, "other", rows)
 
     def get_package_list(self, group_key):
         ''' for a PK group, get the packagelist for this group '''
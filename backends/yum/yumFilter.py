@@ -26,17 +26,44 @@ import rpmUtils
 import re
 
 GUI_KEYS = re.compile(r'(qt)|(gtk)')
+DEVEL_SUFFIXES = ('-devel', '-debuginfo', '-static', '-libs')
 
 class YumFilter(PackagekitFilter):
 
     def __init__(self, fltlist="none"):
-        PackagekitFilter.__init__(self, fltlist)
         basearch = rpmUtils.arch.getBaseArch()
         if basearch == 'i386':
             self.basearch_list = ['i386', 'i486', 'i586', 'i686']
         else:
             self.basearch_list = [basearch]
         self.basearch_list.append('noarch')
+        self._license_is_free = {}
+        PackagekitFilter.__init__(self, fltlist)
+
+    def _get_flag_predicate(self, flag):
+        '''
+        Use cheaper checks than the _pkg_is_* methods where we can
+        '''
+        if flag == 'arch':
+            basearch = frozenset(self.basearch_list)
+            return lambda pkg: pkg.arch in basearch
+        if flag == 'devel':
+            return lambda pkg: pkg.name.endswith(DEVEL_SUFFIXES)
+        if flag == 'free':
+            return self._pkg_license_is_free
+        return PackagekitFilter._get_flag_predicate(self, flag)
+
+    def _pkg_license_is_free(self, pkg):
+        '''
+        Return if the package is free software, only checking each
+        license field once
+        '''
+        try:
+            return self._license_is_free[pkg.license]
+        except KeyError:
+            is_free = self.check_license_field(pkg.license)
+            self._license_is_free[pkg.license] = is_free
+            return is_free
 
     def _is_main_package(self, repo):
         if repo.endswith('-debuginfo'):
@@ -60,7 +87,7 @@ class YumFilter(PackagekitFilter):
         '''
         base_list = []
         output_list = []
-        base_list_already_got = []
+        base_list_already_got = set()
 
         #find out the srpm name and add to a new array of compound data
         for (pkg, status) in package_list:
@@ -74,20 +101,20 @@ class YumFilter(PackagekitFilter):
         for (pkg, status, base, version) in base_list:
             if base == pkg.name and (base, version) not in base_list_already_got:
                 output_list.append((pkg, status))
-                base_list_already_got.append ((base, version))
+                base_list_already_got.add ((base, version))
 
         #for all the ones not yet got, can we match against a non devel match?
         for (pkg, status, base, version) in base_list:
             if (base, version) not in base_list_already_got:
                 if self._is_main_package(pkg.name):
                     output_list.append((pkg, status))
-                    base_list_already_got.append ((base, version))
+                    base_list_already_got.add ((base, version))
 
         #add the remainder of the packages, which should just be the single debuginfo's
         for (pkg, status, base, version) in base_list:
             if (base, version) not in base_list_already_got:
                 output_list.append((pkg, status))
-                base_list_already_got.append ((base, version))
+                base_list_already_got.add ((base, version))
         return output_list
 
     def _do_newest_filtering(self, pkglist):
@@ -102,19 +129,17 @@ class YumFilter(PackagekitFilter):
 
             # we've already come across this package
             if key in newest:
+                rc = pkg.verCMP(newest[key][0])
 
                 # the current package is older version than the one we have stored
-                if pkg.verCMP(newest[key][0]) < 0:
+                if rc < 0:
                     continue
 
                 # the current package is the same version, but the repository has a lower priority
-                if pkg.verCMP(newest[key][0]) == 0 and \
-                   pkg.repo >= newest[key][0].repo:
+                if rc == 0 and pkg.repo >= newest[key][0].repo:
                     continue
 
-                # the current package is newer than what we have stored or the repository has a higher priority, so nuke the old package
-                del newest[key]
-
+            # the current package is newer than what we have stored or the repository has a higher priority, so replace the old package
             newest[key] = (pkg, state)
         return newest.values()
 
@@ -160,15 +185,7 @@ class YumFilter(PackagekitFilter):
         '''
         Return if the package is development.
         '''
-        if pkg.name.endswith('-devel'):
-            return True
-        if pkg.name.endswith('-debuginfo'):
-            return True
-        if pkg.name.endswith('-static'):
-            return True
-        if pkg.name.endswith('-libs'):
-            return True
-        return False
+        return pkg.name.endswith(DEVEL_SUFFIXES)
 
     def _pkg_is_gui(self, pkg):
         '''
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Copyright (C) 2010
+#    Richard Hughes <richard@hughsie.com>
+
+import sqlite3
+import os
+import logging
+
+__DB_VER__ = '2'
+
+log = logging.getLogger('PackageKitBackend')
+
+# the postings are split by the field the token came from
+FIELD_NAME = 0
+FIELD_DETAILS = 1
+
+# the rpmdb is indexed like a repo with this id
+INSTALLED_REPO_ID = 'installed'
+RPMDB_PACKAGES = '/var/lib/rpm/Packages'
+
+def _to_unicode(txt, encoding='utf-8'):
+    if isinstance(txt, basestring):
+        if not isinstance(txt, unicode):
+            txt = unicode(txt, encoding, errors='replace')
+    return txt
+
+def _prefix_end(value):
+    ''' the smallest string greater than every string starting with value '''
+    while value and value[-1] == u'\uffff':
+        value = value[:-1]
+    if not value:
+        return None
+    return value[:-1] + unichr(ord(value[-1]) + 1)
+
+def _get_suffixes(token):
+    return [token[i:] for i in range(len(token))]
+
+def get_repo_checksum(repo, mdtype='primary'):
+    ''' the checksum of some repo metadata, or None if the repo does not have it '''
+    try:
+        return repo.repoXML.getData(mdtype).checksum[1]
+    except Exception, e:
+        return None
+
+def get_rpmdb_checksum():
+    try:
+        return str(os.stat(RPMDB_PACKAGES).st_mtime)
+    except OSError, e:
+        return None
+
+class yumSearchIndex:
+    '''
+    An inverted index over the name, summary, description and group of
+    every package, used to answer search-name and search-details.
+
+    Package names are stored as one token, and the other fields are split
+    on whitespace. As every token is lowercase, a value without whitespace
+    is a substring of a field if and only if it is a substring of one of
+    its tokens, which keeps the results the same as the LIKE queries yum
+    does in searchGenerator. Every suffix of a token is stored too, so a
+    substring is found as a prefix of a suffix using the suffixes index.
+
+    Each repo is indexed separately and keyed by the checksum of its
+    primary metadata, so only the repos that changed are reindexed. The
+    index is only brought up to date by update(), and is not used while
+    any enabled repo or the rpmdb has changed since.
+    '''
+
+    def __init__(self, yumbase, db = None):
+        self.yumbase = yumbase
+        self.cursor = None
+        self.connection = None
+        if not db:
+            db = '/var/cache/PackageKit/search.sqlite'
+        self.db = db
+
+        # ensure the directory exists
+        dirname = os.path.dirname(db)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def connect(self):
+        ''' connect to database '''
+        try:
+            # will be created if it does not exist
+            self.connection = sqlite3.connect(self.db)
+            self.cursor = self.connection.cursor()
+        except Exception, e:
+            log.warning('cannot connect to database %s: %s' % (self.db, str(e)))
+            return False
+
+        try:
+            version = None
+            # Get the current database version
+            self.cursor.execute('SELECT version FROM version')
+            for row in self.cursor:
+                version = str(row[0])
+                break
+            # Check if we have the right DB version
+            if not version or version != __DB_VER__:
+                log.info('Wrong database versions : %s needs %s' % (version, __DB_VER__))
+                return self._make_database_tables()
+        except Exception, e:
+            # We couldn't get the version, so create a new database
+            return self._make_database_tables()
+
+        return True
+
+    def _make_database_tables(self):
+        ''' Setup an empty database, the repos are indexed when first used '''
+        try: # kill the old db
+            self.connection.close()
+            os.unlink(self.db) # kill the db
+        except Exception, e:
+            pass
+        try:
+            self.connection = sqlite3.connect(self.db)
+            self.cursor = self.connection.cursor()
+            self.cursor.execute('CREATE TABLE repos (repoid TEXT PRIMARY KEY, checksum TEXT);')
+            self.cursor.execute('CREATE TABLE packages (pkgkey INTEGER PRIMARY KEY, repoid TEXT, '
+                                'name TEXT, arch TEXT, epoch TEXT, version TEXT, release TEXT);')
+            self.cursor.execute('CREATE INDEX packages_repoid ON packages (repoid);')
+            self.cursor.execute('CREATE TABLE tokens (tokenid INTEGER PRIMARY KEY, token TEXT UNIQUE);')
+            self.cursor.execute('CREATE TABLE suffixes (suffix TEXT, tokenid INTEGER);')
+            self.cursor.execute('CREATE INDEX suffixes_suffix ON suffixes (suffix);')
+            self.cursor.execute('CREATE TABLE postings (tokenid INTEGER, pkgkey INTEGER, field INTEGER);')
+            self.cursor.execute('CREATE INDEX postings_tokenid ON postings (tokenid);')
+            self.cursor.execute('CREATE INDEX postings_pkgkey ON postings (pkgkey);')
+            self.cursor.execute('CREATE TABLE version (version TEXT);')
+            self.cursor.execute('INSERT INTO version values(?);', __DB_VER__)
+            self.connection.commit()
+        except Exception, e:
+            log.warning('cannot create database %s: %s' % (self.db, str(e)))
+            return False
+        return True
+
+    def _get_checksum(self, repoid):
+        self.cursor.execute('SELECT checksum FROM repos WHERE repoid = ?;', [repoid])
+        for row in self.cursor:
+            return row[0]
+        return None
+
+    def _add_repo(self, repoid, checksum, pkgs):
+        ''' replace the indexed packages of a repo in a single transaction '''
+        self.cursor.execute('DELETE FROM postings WHERE pkgkey IN '
+                            '(SELECT pkgkey FROM packages WHERE repoid = ?);', [repoid])
+        self.cursor.execute('DELETE FROM packages WHERE repoid = ?;', [repoid])
+
+        self.cursor.execute('SELECT MAX(pkgkey) FROM packages;')
+        pkgkey = self.cursor.fetchone()[0] or 0
+        packages = []
+        postings = []
+        for pkg in pkgs:
+            pkgkey += 1
+            packages.append((pkgkey, repoid, pkg.name, pkg.arch, pkg.epoch, pkg.version, pkg.release))
+            postings.append((_to_unicode(pkg.name).lower(), pkgkey, FIELD_NAME))
+            tokens = set()
+            for text in (pkg.summary, pkg.description, getattr(pkg, 'group', None)):
+                if text:
+                    tokens.update(_to_unicode(text).lower().split())
+            for token in tokens:
+                postings.append((token, pkgkey, FIELD_DETAILS))
+        self.cursor.executemany('INSERT INTO packages values(?, ?, ?, ?, ?, ?, ?);', packages)
+
+        # add the tokens that are not known yet, with their suffixes
+        tokenids = {}
+        self.cursor.execute('SELECT token, tokenid FROM tokens;')
+        for row in self.cursor:
+            tokenids[row[0]] = row[1]
+        new_tokens = set(posting[0] for posting in postings if posting[0] not in tokenids)
+        for token in new_tokens:
+            self.cursor.execute('INSERT INTO tokens (token) values(?);', [token])
+            tokenids[token] = self.cursor.lastrowid
+        self.cursor.executemany('INSERT INTO suffixes values(?, ?);',
+                                ((suffix, tokenids[token]) for token in new_tokens
+                                 for suffix in _get_suffixes(token)))
+
+        # map the postings onto the token ids
+        self.cursor.executemany('INSERT INTO postings values(?, ?, ?);',
+                                ((tokenids[token], key, field) for (token, key, field) in postings))
+
+        # forget the tokens that are no longer used by any repo
+        self.cursor.execute('DELETE FROM tokens WHERE tokenid NOT IN (SELECT tokenid FROM postings);')
+        self.cursor.execute('DELETE FROM suffixes WHERE tokenid NOT IN (SELECT tokenid FROM tokens);')
+        self.cursor.execute('INSERT OR REPLACE INTO repos values(?, ?);', (repoid, checksum))
+        self.connection.commit()
+
+    def update_repo(self, repo):
+        '''
+        reindex a repo if its metadata has changed since it was indexed
+        returns False if the repo has no metadata that can be indexed
+        '''
+        checksum = get_repo_checksum(repo)
+        if not checksum:
+            return False
+        if checksum == self._get_checksum(repo.id):
+            return True
+        self.yumbase.repos.populateSack(which=[repo.id], mdtype='metadata', cacheonly=1)
+        self._add_repo(repo.id, checksum, repo.sack.returnPackages())
+        return True
+
+    def update_installed(self):
+        '''
+        reindex the installed packages if the rpmdb has changed
+        returns False if the rpmdb cannot be indexed
+        '''
+        checksum = get_rpmdb_checksum()
+        if not checksum:
+            return False
+        if checksum == self._get_checksum(INSTALLED_REPO_ID):
+            return True
+        self._add_repo(INSTALLED_REPO_ID, checksum, self.yumbase.rpmdb.returnPackages())
+        return True
+
+    def update(self):
+        '''
+        bring the index up to date with the rpmdb and all enabled repos
+        returns False if any of them could not be indexed
+        '''
+        if not self.update_installed():
+            return False
+        for repo in self.yumbase.repos.listEnabled():
+            if not self.update_repo(repo):
+                return False
+        return True
+
+    def is_current(self):
+        ''' is the index up to date with the rpmdb and all enabled repos '''
+        checksum = get_rpmdb_checksum()
+        if not checksum or checksum != self._get_checksum(INSTALLED_REPO_ID):
+            return False
+        for repo in self.yumbase.repos.listEnabled():
+            checksum = get_repo_checksum(repo)
+            if not checksum or checksum != self._get_checksum(repo.id):
+                return False
+        return True
+
+    def search(self, values, details=False):
+        '''
+        find the packages where any of the values is a substring of the name,
+        or also of the summary, description or group if details is set.
+        returns None if the values cannot be answered from the index
+        '''
+        if not self.is_current():
+            return None
+        if details:
+            for value in values:
+                if len(value.split()) != 1:
+                    return None
+            fields = (FIELD_NAME, FIELD_DETAILS)
+        else:
+            fields = (FIELD_NAME,)
+
+        # only return packages from repos that are enabled now
+        repos = {INSTALLED_REPO_ID : self.yumbase.rpmdb}
+        for repo in self.yumbase.repos.listEnabled():
+            repos[repo.id] = repo.sack
+
+        found = {}
+        for value in values:
+            value = _to_unicode(value).lower()
+            end = _prefix_end(value)
+            if end is None:
+                return None
+            self.cursor.execute('SELECT DISTINCT pk.repoid, pk.name, pk.arch, pk.epoch, pk.version, pk.release '
+                                'FROM suffixes s JOIN postings p ON p.tokenid = s.tokenid '
+                                'JOIN packages pk ON pk.pkgkey = p.pkgkey '
+                                'WHERE s.suffix >= ? AND s.suffix < ? AND p.field IN (%s);' % ', '.join('?' * len(fields)),
+                                [value, end] + list(fields))
+            for row in self.cursor:
+                if row[0] in repos:
+                    found.setdefault(row[0], set()).add(tuple(row[1:]))
+
+        # get the package objects for the matched pkgtups, a repo at a time;
+        # a repo sack stays empty until its metadata has been loaded
+        pkgs = []
+        for repoid, pkgtups in found.items():
+            if repoid != INSTALLED_REPO_ID:
+                self.yumbase.repos.populateSack(which=[repoid], mdtype='metadata', cacheonly=1)
+            names = list(set(pkgtup[0] for pkgtup in pkgtups))
+            for pkg in repos[repoid].searchNames(names):
+                if pkg.pkgtup in pkgtups:
+                    pkgs.append(pkg)
+        return pkgs
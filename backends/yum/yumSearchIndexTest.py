@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from yumSearchIndex import *
+import os
+import subprocess
+import sys
+import yum
+
+_db = "/var/cache/PackageKit/search-test.sqlite"
+
+def search(value):
+    ''' search a built index the way a newly spawned backend does '''
+    _yb = yum.YumBase()
+    index = yumSearchIndex(_yb, _db)
+    index.connect()
+    _pkgs = index.search([value])
+    if _pkgs is None:
+        print "index not current"
+        sys.exit(1)
+    available = [pkg for pkg in _pkgs if pkg.repoid != 'installed']
+    print "found %i packages, %i available" % (len(_pkgs), len(available))
+    if not available:
+        sys.exit(1)
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--search':
+        search(sys.argv[2])
+        return
+    _yb = yum.YumBase()
+    index = yumSearchIndex(_yb, _db)
+    index.connect()
+    print "building index"
+    print 40 * "="
+    print index.update()
+    print "searching 'lib' in a new process"
+    print 40 * "="
+    ret = subprocess.call([sys.executable, sys.argv[0], '--search', 'lib'])
+    os.unlink(_db) # kill the db
+    if ret != 0:
+        print "FAILED: no available packages returned"
+        sys.exit(1)
+    print "OK"
+
+if __name__ == "__main__":
+    main()
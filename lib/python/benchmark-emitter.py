@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (C) 2010 Richard Hughes <richard@hughsie.com>
+#
+# Compares how many package lines per second the python backends can send
+# to the daemon with the flush-per-line and the buffered signal emitters,
+# and how many writes and flushes reach the pipe. Like in a real backend,
+# stdout is wrapped in the UTF-8 writer of packagekit.backend.
+#
+# Usage: benchmark-emitter.py [number-of-packages]
+#
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+from packagekit.backend import _UTF8Writer
+from packagekit.emitter import SignalEmitter, BufferedSignalEmitter
+
+class CountingStream:
+    ''' counts the writes and flushes that reach the pipe '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writes = 0
+        self.flushes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.stream.write(data)
+
+    def flush(self):
+        self.flushes += 1
+        self.stream.flush()
+
+def run(emitter, count):
+    # write into a pipe that is drained by another process, just like the
+    # daemon reads the output of a spawned backend
+    devnull = open(os.devnull, 'w')
+    reader = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=devnull)
+    stdout = sys.stdout
+    pipe = CountingStream(os.fdopen(os.dup(reader.stdin.fileno()), 'w'))
+    sys.stdout = _UTF8Writer(pipe)
+    try:
+        start = time.time()
+        for i in range(count):
+            emitter.emit_progress('percentage', "percentage\t%i" % (i * 100 / count))
+            emitter.emit("package\tavailable\tpackage%i;1.0-1;x86_64;fedora\tSummary" % i)
+        emitter.emit_state("finished")
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+        pipe.stream.close()
+        reader.stdin.close()
+        reader.wait()
+        devnull.close()
+    return count / elapsed, pipe.writes, pipe.flushes
+
+def main():
+    count = 40000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    before, before_writes, before_flushes = run(SignalEmitter(), count)
+    after, after_writes, after_flushes = run(BufferedSignalEmitter(), count)
+    print("flush per line: %10.0f lines/s %8i writes %8i flushes" % (before, before_writes, before_flushes))
+    print("buffered:       %10.0f lines/s %8i writes %8i flushes" % (after, after_writes, after_flushes))
+    print("speedup:        %10.1fx" % (after / before))
+
+if __name__ == "__main__":
+    main()
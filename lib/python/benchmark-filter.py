@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (C) 2010 Richard Hughes <richard@hughsie.com>
+#
+# Times PackagekitFilter.get_package_list on synthetic package lists of
+# growing size, to check the filters scale linearly with the list length.
+#
+# Usage: benchmark-filter.py [filters]
+#
+from __future__ import print_function
+
+import sys
+import time
+
+from packagekit.enums import *
+from packagekit.filter import PackagekitFilter
+
+class _Package:
+    def __init__(self, name, version, arch):
+        self.name = name
+        self.version = version
+        self.arch = arch
+
+class _BenchmarkFilter(PackagekitFilter):
+
+    def _pkg_compare(self, pkg1, pkg2):
+        if pkg1.arch != pkg2.arch:
+            return -2
+        return cmp(pkg1.version, pkg2.version)
+
+    def _pkg_get_name(self, pkg):
+        return pkg.name
+
+    def _pkg_is_installed(self, pkg):
+        return pkg.version == 1
+
+    def _pkg_is_devel(self, pkg):
+        return pkg.name.endswith('-devel')
+
+    def _pkg_is_arch(self, pkg):
+        return pkg.arch != 'i686'
+
+    def post_process(self):
+        if FILTER_NEWEST not in self.fltlist:
+            return self.package_list
+        newest = {}
+        for pkg, state in self.package_list:
+            key = (pkg.name, pkg.arch)
+            if key not in newest or pkg.version > newest[key][0].version:
+                newest[key] = (pkg, state)
+        return newest.values()
+
+def run(filters, count):
+    ''' a third of the names are installed, and every name has three versions '''
+    pkgfilter = _BenchmarkFilter(filters)
+    for i in range(count / 3):
+        name = 'package%i' % i
+        if i % 5 == 0:
+            name += '-devel'
+        arch = ('x86_64', 'i686', 'noarch')[i % 3]
+        if i % 3 == 0:
+            pkgfilter.add_installed([_Package(name, 1, arch)])
+        else:
+            pkgfilter.add_available([_Package(name, 1, arch)])
+        pkgfilter.add_available([_Package(name, 2, arch), _Package(name, 0, arch)])
+    start = time.time()
+    pkgfilter.get_package_list()
+    return time.time() - start
+
+def main():
+    filters = [FILTER_NOT_DEVELOPMENT, FILTER_ARCH, FILTER_NEWEST]
+    if len(sys.argv) > 1:
+        filters = sys.argv[1].split(';')
+    print("filters: %s" % ';'.join(filters))
+    for count in (12500, 25000, 50000, 100000):
+        elapsed = run(filters, count)
+        print("%7i packages: %6.3fs, %5.2fus per package" % (count, elapsed, elapsed * 1000000 / count))
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@ import traceback
 import os.path
 
 from .enums import *
+from .emitter import SignalEmitter, BufferedSignalEmitter, _to_utf8
 
 PACKAGE_IDS_DELIM = '&'
 FILENAME_DELIM = '|'
@@ -38,27 +39,6 @@ def _to_unicode(txt, encoding='utf-8'):
             txt = unicode(txt, encoding, errors='replace')
     return txt
 
-def _to_utf8(txt, errors='replace'):
-    '''convert practically anything to a utf-8-encoded byte string'''
-
-    # convert to unicode object
-    if isinstance(txt, str):
-        txt = txt.decode('utf-8', errors=errors)
-    if not isinstance(txt, basestring):
-        # try to convert non-string objects like exceptions
-        try:
-            # if txt.__unicode__() exists, or txt.__str__() returns ASCII
-            txt = unicode(txt)
-        except UnicodeDecodeError:
-            # if txt.__str__() exists
-            txt = str(txt).decode('utf-8', errors=errors)
-        except:
-            # no __str__(), __unicode__() methods, use representation
-            txt = unicode(repr(txt))
-
-    # return encoded as UTF-8
-    return txt.encode('utf-8', errors=errors)
-
 # Classes
 
 class _UTF8Writer(codecs.StreamWriter):
@@ -106,6 +86,7 @@ class PackageKitBaseBackend:
         self.cache_age = 0
         self.percentage_old = 0
         self.sub_percentage_old = 0
+        self.emitter = BufferedSignalEmitter()
 
         # try to get LANG
         try:
@@ -151,25 +132,32 @@ class PackageKitBaseBackend:
     def isLocked(self):
         return self._locked
 
+    def set_emitter(self, emitter):
+        '''
+        Replace the object used to send signals to the daemon
+        @param emitter: a SignalEmitter, e.g. SignalEmitter() to flush
+                        every line as soon as it is emitted
+        '''
+        self.emitter.flush()
+        self.emitter = emitter
+
     def percentage(self, percent=None):
         '''
         Write progress percentage
         @param percent: Progress percentage (int preferred)
         '''
         if percent == None:
-            print("no-percentage-updates")
+            self.emitter.emit_progress('percentage', "no-percentage-updates")
         elif percent == 0 or percent > self.percentage_old:
-            print("percentage\t%i" % (percent))
+            self.emitter.emit_progress('percentage', "percentage\t%i" % (percent))
             self.percentage_old = percent
-        sys.stdout.flush()
 
     def speed(self, bps=0):
         '''
         Write progress speed
         @param bps: Progress speed (int, bytes per second)
         '''
-        print("speed\t%i" % (bps))
-        sys.stdout.flush()
+        self.emitter.emit_progress('speed', "speed\t%i" % (bps))
 
     def item_percentage(self, package_id, percent=None):
         '''
@@ -177,8 +165,7 @@ class PackageKitBaseBackend:
         @param package_id: The package ID name, e.g. openoffice-clipart;2.6.22;ppc64;fedora
         @param percent: percentage of the current item (int preferred)
         '''
-        print("item-percentage\t%s\t%i" % (package_id, percent))
-        sys.stdout.flush()
+        self.emitter.emit_progress('item-percentage', "item-percentage\t%s\t%i" % (package_id, percent))
 
     def sub_percentage(self, percent=None):
         '''
@@ -186,9 +173,8 @@ class PackageKitBaseBackend:
         @param percent: subprogress percentage (int preferred)
         '''
         if percent == 0 or percent > self.sub_percentage_old:
-            print("subpercentage\t%i" % (percent))
+            self.emitter.emit_progress('subpercentage', "subpercentage\t%i" % (percent))
             self.sub_percentage_old = percent
-        sys.stdout.flush()
 
     def error(self, err, description, exit=True):
         '''
@@ -202,8 +188,7 @@ class PackageKitBaseBackend:
             self.unLock()
 
         # this should be fast now
-        print("error\t%s\t%s" % (err, description))
-        sys.stdout.flush()
+        self.emitter.emit_state("error\t%s\t%s" % (err, description))
         if exit:
             # Paradoxically, we don't want to print "finished" to stdout here.
             # Python takes an _enormous_ amount of time to exit, and leaves a
@@ -217,8 +202,7 @@ class PackageKitBaseBackend:
         send 'message' signal
         @param typ: MESSAGE_BROKEN_MIRROR
         '''
-        print("message\t%s\t%s" % (typ, msg))
-        sys.stdout.flush()
+        self.emitter.emit_state("message\t%s\t%s" % (typ, msg))
 
     def package(self, package_id, status, summary):
         '''
@@ -227,8 +211,7 @@ class PackageKitBaseBackend:
         @param package_id: The package ID name, e.g. openoffice-clipart;2.6.22;ppc64;fedora
         @param summary: The package Summary
         '''
-        print("package\t%s\t%s\t%s" % (status, package_id, summary), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit("package\t%s\t%s\t%s" % (status, package_id, summary))
 
     def media_change_required(self, mtype, id, text):
         '''
@@ -237,8 +220,7 @@ class PackageKitBaseBackend:
         @param id: the localised label of the media
         @param text: the localised text describing the media
         '''
-        print("media-change-required\t%s\t%s\t%s" % (mtype, id, text), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit_state("media-change-required\t%s\t%s\t%s" % (mtype, id, text))
 
     def distro_upgrade(self, dtype, name, summary):
         '''
@@ -247,16 +229,14 @@ class PackageKitBaseBackend:
         @param name: The distro name, e.g. "fedora-9"
         @param summary: The localised distribution name and description
         '''
-        print("distro-upgrade\t%s\t%s\t%s" % (dtype, name, summary), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit("distro-upgrade\t%s\t%s\t%s" % (dtype, name, summary))
 
     def status(self, state):
         '''
         send 'status' signal
         @param state: STATUS_DOWNLOAD, STATUS_INSTALL, STATUS_UPDATE, STATUS_REMOVE, STATUS_WAIT
         '''
-        print("status\t%s" % (state))
-        sys.stdout.flush()
+        self.emitter.emit_state("status\t%s" % (state))
 
     def repo_detail(self, repoid, name, state):
         '''
@@ -264,16 +244,14 @@ class PackageKitBaseBackend:
         @param repoid: The repo id tag
         @param state: false is repo is disabled else true.
         '''
-        print("repo-detail\t%s\t%s\t%s" % (repoid, name, _bool_to_string(state)), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit("repo-detail\t%s\t%s\t%s" % (repoid, name, _bool_to_string(state)))
 
     def data(self, data):
         '''
         send 'data' signal:
         @param data:  The current worked on package
         '''
-        print("data\t%s" % (data))
-        sys.stdout.flush()
+        self.emitter.emit("data\t%s" % (data))
 
     def details(self, package_id, package_license, group, desc, url, bytes):
         '''
@@ -285,16 +263,14 @@ class PackageKitBaseBackend:
         @param url: The upstream project homepage
         @param bytes: The size of the package, in bytes
         '''
-        print("details\t%s\t%s\t%s\t%s\t%s\t%ld" % (package_id, package_license, group, desc, url, bytes), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit("details\t%s\t%s\t%s\t%s\t%s\t%ld" % (package_id, package_license, group, desc, url, bytes))
 
     def files(self, package_id, file_list):
         '''
         Send 'files' signal
         @param file_list: List of the files in the package, separated by ';'
         '''
-        print("files\t%s\t%s" % (package_id, file_list), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit("files\t%s\t%s" % (package_id, file_list))
 
     def category(self, parent_id, cat_id, name, summary, icon):
         '''
@@ -305,15 +281,14 @@ class PackageKitBaseBackend:
         summery   : a summary of the category in current locale.
         icon      : an icon name to represent the category
         '''
-        print("category\t%s\t%s\t%s\t%s\t%s" % (parent_id, cat_id, name, summary, icon), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit("category\t%s\t%s\t%s\t%s\t%s" % (parent_id, cat_id, name, summary, icon))
 
     def finished(self):
         '''
         Send 'finished' signal
         '''
-        print("finished", file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit_state("finished")
+        self.emitter.reset()
 
     def update_detail(self, package_id, updates, obsoletes, vendor_url, bugzilla_url, cve_url, restart, update_text, changelog, state, issued, updated):
         '''
@@ -331,8 +306,7 @@ class PackageKitBaseBackend:
         @param issued:
         @param updated:
         '''
-        print("updatedetail\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (package_id, updates, obsoletes, vendor_url, bugzilla_url, cve_url, restart, update_text, changelog, state, issued, updated), file=sys.stdout)
-        sys.stdout.flush()
+        self.emitter.emit("updatedetail\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (package_id, updates, obsoletes, vendor_url, bugzilla_url, cve_url, restart, update_text, changelog, state, issued, updated))
 
     def require_restart(self, restart_type, details):
         '''
@@ -340,8 +314,7 @@ class PackageKitBaseBackend:
         @param restart_type: RESTART_SYSTEM, RESTART_APPLICATION, RESTART_SESSION
         @param details: Optional details about the restart
         '''
-        print("requirerestart\t%s\t%s" % (restart_type, details))
-        sys.stdout.flush()
+        self.emitter.emit("requirerestart\t%s\t%s" % (restart_type, details))
 
     def allow_cancel(self, allow):
         '''
@@ -352,8 +325,7 @@ class PackageKitBaseBackend:
             data = 'true'
         else:
             data = 'false'
-        print("allow-cancel\t%s" % (data))
-        sys.stdout.flush()
+        self.emitter.emit_state("allow-cancel\t%s" % (data))
 
     def repo_signature_required(self, package_id, repo_name, key_url, key_userid, key_id, key_fingerprint, key_timestamp, sig_type):
         '''
@@ -367,10 +339,9 @@ class PackageKitBaseBackend:
         @param key_timestamp:   Key timestamp
         @param sig_type:        Key type (GPG)
         '''
-        print("repo-signature-required\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+        self.emitter.emit_state("repo-signature-required\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
             package_id, repo_name, key_url, key_userid, key_id, key_fingerprint, key_timestamp, sig_type
             ))
-        sys.stdout.flush()
 
     def eula_required(self, eula_id, package_id, vendor_name, license_agreement):
         '''
@@ -380,10 +351,9 @@ class PackageKitBaseBackend:
         @param vendor_name:     Name of the vendor that wrote the EULA
         @param license_agreement: The license text
         '''
-        print("eula-required\t%s\t%s\t%s\t%s" % (
+        self.emitter.emit_state("eula-required\t%s\t%s\t%s\t%s" % (
             eula_id, package_id, vendor_name, license_agreement
             ))
-        sys.stdout.flush()
 
 #
 # Backend Action Methods
@@ -658,184 +628,44 @@ class PackageKitBaseBackend:
         self.dispatch_command(cmd, args)
 
     def dispatch_command(self, cmd, args):
-        if cmd == 'download-packages':
-            directory = args[0]
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.download_packages(directory, package_ids)
-            self.finished()
-        elif cmd == 'get-depends':
-            filters = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            recursive = _text_to_bool(args[2])
-            self.get_depends(filters, package_ids, recursive)
-            self.finished()
-        elif cmd == 'get-details':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.get_details(package_ids)
-            self.finished()
-        elif cmd == 'get-files':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.get_files(package_ids)
-            self.finished()
-        elif cmd == 'get-packages':
-            filters = args[0].split(';')
-            self.get_packages(filters)
-            self.finished()
-        elif cmd == 'get-repo-list':
-            filters = args[0].split(';')
-            self.get_repo_list(filters)
-            self.finished()
-        elif cmd == 'get-requires':
-            filters = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            recursive = _text_to_bool(args[2])
-            self.get_requires(filters, package_ids, recursive)
-            self.finished()
-        elif cmd == 'get-update-detail':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.get_update_detail(package_ids)
-            self.finished()
-        elif cmd == 'get-distro-upgrades':
-            self.get_distro_upgrades()
-            self.finished()
-        elif cmd == 'get-updates':
-            filters = args[0].split(';')
-            self.get_updates(filters)
-            self.finished()
-        elif cmd == 'install-files':
-            only_trusted = _text_to_bool(args[0])
-            files_to_inst = args[1].split(FILENAME_DELIM)
-            self.install_files(only_trusted, files_to_inst)
-            self.finished()
-        elif cmd == 'install-packages':
-            only_trusted = _text_to_bool(args[0])
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.install_packages(only_trusted, package_ids)
-            self.finished()
-        elif cmd == 'install-signature':
-            sigtype = args[0]
-            key_id = args[1]
-            package_id = args[2]
-            self.install_signature(sigtype, key_id, package_id)
-            self.finished()
-        elif cmd == 'refresh-cache':
-            force = _text_to_bool(args[0])
-            self.refresh_cache(force)
-            self.finished()
-        elif cmd == 'remove-packages':
-            allowdeps = _text_to_bool(args[0])
-            autoremove = _text_to_bool(args[1])
-            package_ids = args[2].split(PACKAGE_IDS_DELIM)
-            self.remove_packages(allowdeps, autoremove, package_ids)
-            self.finished()
-        elif cmd == 'repo-enable':
-            repoid = args[0]
-            state = _text_to_bool(args[1])
-            self.repo_enable(repoid, state)
-            self.finished()
-        elif cmd == 'repo-set-data':
-            repoid = args[0]
-            para = args[1]
-            value = args[2]
-            self.repo_set_data(repoid, para, value)
-            self.finished()
-        elif cmd == 'resolve':
-            filters = args[0].split(';')
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.resolve(filters, package_ids)
-            self.finished()
-        elif cmd == 'search-details':
-            filters = args[0].split(';')
-            values = _to_unicode(args[1]).split(PACKAGE_IDS_DELIM)
-            self.search_details(filters, values)
-            self.finished()
-        elif cmd == 'search-file':
-            filters = args[0].split(';')
-            values = args[1].split(PACKAGE_IDS_DELIM)
-            self.search_file(filters, values)
-            self.finished()
-        elif cmd == 'search-group':
-            filters = args[0].split(';')
-            values = args[1].split(PACKAGE_IDS_DELIM)
-            self.search_group(filters, values)
-            self.finished()
-        elif cmd == 'search-name':
-            filters = args[0].split(';')
-            values = _to_unicode(args[1]).split(PACKAGE_IDS_DELIM)
-            self.search_name(filters, values)
-            self.finished()
-        elif cmd == 'signature-install':
-            package = args[0]
-            self.repo_signature_install(package)
-            self.finished()
-        elif cmd == 'update-packages':
-            only_trusted = _text_to_bool(args[0])
-            package_ids = args[1].split(PACKAGE_IDS_DELIM)
-            self.update_packages(only_trusted, package_ids)
-            self.finished()
-        elif cmd == 'update-system':
-            only_trusted = _text_to_bool(args[0])
-            self.update_system(only_trusted)
-            self.finished()
-        elif cmd == 'what-provides':
-            filters = args[0].split(';')
-            provides_type = args[1]
-            values = _to_unicode(args[2]).split(PACKAGE_IDS_DELIM)
-            self.what_provides(filters, provides_type, values)
-            self.finished()
-        elif cmd == 'set-locale':
-            code = args[0]
-            self.set_locale(code)
-            self.finished()
-        elif cmd == 'get-categories':
-            self.get_categories()
-            self.finished()
-        elif cmd == 'simulate-install-files':
-            files_to_inst = args[0].split(FILENAME_DELIM)
-            self.simulate_install_files(files_to_inst)
-            self.finished()
-        elif cmd == 'simulate-install-packages':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.simulate_install_packages(package_ids)
-            self.finished()
-        elif cmd == 'simulate-remove-packages':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.simulate_remove_packages(package_ids)
-            self.finished()
-        elif cmd == 'simulate-update-packages':
-            package_ids = args[0].split(PACKAGE_IDS_DELIM)
-            self.simulate_update_packages(package_ids)
-            self.finished()
-        elif cmd == 'upgrade-system':
-            self.upgrade_system(args[0])
-            self.finished()
-        elif cmd == 'repair-system':
-            self.repair_system(args[0])
-            self.finished()
-        elif cmd == 'simulate-repair-system':
-            self.simulate_repair_system()
-            self.finished()
-        else:
+        try:
+            method_name, parsers = _COMMANDS[cmd]
+        except KeyError:
             errmsg = "command '%s' is not known" % cmd
             self.error(ERROR_INTERNAL_ERROR, errmsg, exit=False)
             self.finished()
+            return
+        if len(args) < len(parsers):
+            errmsg = "command '%s' needs %i arguments, got %i" % (cmd, len(parsers), len(args))
+            self.error(ERROR_INTERNAL_ERROR, errmsg, exit=False)
+            self.finished()
+            return
+        values = [parse(arg) for parse, arg in zip(parsers, args)]
+        getattr(self, method_name)(*values)
+        self.finished()
+
+    def _read_line(self):
+        # don't keep the daemon waiting for lines while we block on stdin
+        self.emitter.flush()
+        try:
+            return sys.stdin.readline().strip('\n')
+        except IOError as e:
+            self.error(ERROR_TRANSACTION_CANCELLED, 'could not read from stdin: %s' % str(e))
+        except KeyboardInterrupt as e:
+            self.error(ERROR_PROCESS_KILL, 'process was killed by ctrl-c: %s' % str(e))
 
     def dispatcher(self, args):
         if len(args) > 0:
             self.dispatch_command(args[0], args[1:])
         while True:
-            try:
-                line = sys.stdin.readline().strip('\n')
-            except IOError as e:
-                self.error(ERROR_TRANSACTION_CANCELLED, 'could not read from stdin: %s' % str(e))
-            except KeyboardInterrupt as e:
-                self.error(ERROR_PROCESS_KILL, 'process was killed by ctrl-c: %s' % str(e))
+            line = self._read_line()
             if not line or line == 'exit':
                 break
             args = line.split('\t')
             self.dispatch_command(args[0], args[1:])
 
         # unlock backend and exit with success
+        self.emitter.flush()
         if self.isLocked():
             self.unLock()
         sys.exit(0)
@@ -871,6 +701,60 @@ def split_package_id(id):
     """
     return id.split(";", 4)
 
+def _text_to_filters(text):
+    return text.split(';')
+
+def _text_to_package_ids(text):
+    return text.split(PACKAGE_IDS_DELIM)
+
+def _text_to_values(text):
+    return _to_unicode(text).split(PACKAGE_IDS_DELIM)
+
+def _text_to_files(text):
+    return text.split(FILENAME_DELIM)
+
+def _text_passthrough(text):
+    return text
+
+# command name -> (backend method, parser for each argument)
+_COMMANDS = {
+    'download-packages': ('download_packages', (_text_passthrough, _text_to_package_ids)),
+    'get-categories': ('get_categories', ()),
+    'get-depends': ('get_depends', (_text_to_filters, _text_to_package_ids, _text_to_bool)),
+    'get-details': ('get_details', (_text_to_package_ids,)),
+    'get-distro-upgrades': ('get_distro_upgrades', ()),
+    'get-files': ('get_files', (_text_to_package_ids,)),
+    'get-packages': ('get_packages', (_text_to_filters,)),
+    'get-repo-list': ('get_repo_list', (_text_to_filters,)),
+    'get-requires': ('get_requires', (_text_to_filters, _text_to_package_ids, _text_to_bool)),
+    'get-update-detail': ('get_update_detail', (_text_to_package_ids,)),
+    'get-updates': ('get_updates', (_text_to_filters,)),
+    'install-files': ('install_files', (_text_to_bool, _text_to_files)),
+    'install-packages': ('install_packages', (_text_to_bool, _text_to_package_ids)),
+    'install-signature': ('install_signature', (_text_passthrough, _text_passthrough, _text_passthrough)),
+    'refresh-cache': ('refresh_cache', (_text_to_bool,)),
+    'remove-packages': ('remove_packages', (_text_to_bool, _text_to_bool, _text_to_package_ids)),
+    'repair-system': ('repair_system', (_text_passthrough,)),
+    'repo-enable': ('repo_enable', (_text_passthrough, _text_to_bool)),
+    'repo-set-data': ('repo_set_data', (_text_passthrough, _text_passthrough, _text_passthrough)),
+    'resolve': ('resolve', (_text_to_filters, _text_to_package_ids)),
+    'search-details': ('search_details', (_text_to_filters, _text_to_values)),
+    'search-file': ('search_file', (_text_to_filters, _text_to_package_ids)),
+    'search-group': ('search_group', (_text_to_filters, _text_to_package_ids)),
+    'search-name': ('search_name', (_text_to_filters, _text_to_values)),
+    'set-locale': ('set_locale', (_text_passthrough,)),
+    'signature-install': ('repo_signature_install', (_text_passthrough,)),
+    'simulate-install-files': ('simulate_install_files', (_text_to_files,)),
+    'simulate-install-packages': ('simulate_install_packages', (_text_to_package_ids,)),
+    'simulate-remove-packages': ('simulate_remove_packages', (_text_to_package_ids,)),
+    'simulate-repair-system': ('simulate_repair_system', ()),
+    'simulate-update-packages': ('simulate_update_packages', (_text_to_package_ids,)),
+    'update-packages': ('update_packages', (_text_to_bool, _text_to_package_ids)),
+    'update-system': ('update_system', (_text_to_bool,)),
+    'upgrade-system': ('upgrade_system', (_text_passthrough,)),
+    'what-provides': ('what_provides', (_text_to_filters, _text_passthrough, _text_to_values)),
+}
+
 def exceptionHandler(typ, value, tb, base):
     # Restore original exception handler
     sys.excepthook = sys.__excepthook__
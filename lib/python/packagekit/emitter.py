@@ -0,0 +1,148 @@
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (C) 2007-2010 Richard Hughes <richard@hughsie.com>
+#
+# This file contains the classes that write backend signals to the daemon
+#
+
+# imports
+import codecs
+import sys
+import time
+
+def _to_utf8(txt, errors='replace'):
+    '''convert practically anything to a utf-8-encoded byte string'''
+
+    # convert to unicode object
+    if isinstance(txt, str):
+        txt = txt.decode('utf-8', errors=errors)
+    if not isinstance(txt, basestring):
+        # try to convert non-string objects like exceptions
+        try:
+            # if txt.__unicode__() exists, or txt.__str__() returns ASCII
+            txt = unicode(txt)
+        except UnicodeDecodeError:
+            # if txt.__str__() exists
+            txt = str(txt).decode('utf-8', errors=errors)
+        except:
+            # no __str__(), __unicode__() methods, use representation
+            txt = unicode(repr(txt))
+
+    # return encoded as UTF-8
+    return txt.encode('utf-8', errors=errors)
+
+class SignalEmitter:
+    '''
+    Writes every signal line to stdout and flushes it straight away.
+
+    This is the traditional behaviour of the python backends, where each
+    emitted package costs one write to the daemon.
+    '''
+
+    def __init__(self):
+        self._last_progress = {}
+
+    def emit(self, line):
+        '''
+        Queue a data line (package, details, files etc) for the daemon
+        '''
+        self._write(line)
+
+    def emit_state(self, line):
+        '''
+        Send a line that changes the transaction state (status, error,
+        finished etc) together with anything queued before it
+        '''
+        self._write(line)
+
+    def emit_progress(self, kind, line):
+        '''
+        Send a progress line, dropping it if it repeats the last line
+        sent for the same kind of progress
+        @param kind: the progress being reported, e.g. 'percentage'
+        '''
+        if self._last_progress.get(kind) == line:
+            return
+        self._last_progress[kind] = line
+        self.emit_state(line)
+
+    def flush(self):
+        '''
+        Write anything that has been queued
+        '''
+        pass
+
+    def reset(self):
+        '''
+        Forget the progress sent so far, as the next command starts afresh
+        '''
+        self._last_progress = {}
+
+    def _write(self, line):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+class BufferedSignalEmitter(SignalEmitter):
+    '''
+    Coalesces data lines into large writes.
+
+    Data lines are held back until max_lines of them have been queued, or
+    the oldest has been waiting for more than max_delay seconds, or a
+    state or progress line is sent. The delay is only checked every
+    check_lines data lines, so there is no upper bound on how long a line
+    waits while the backend is busy without emitting: lines never outlive
+    the next state signal, the 'finished' that ends the command, or an
+    explicit flush(), which backends call before doing anything that
+    blocks.
+
+    The lines are encoded once and written to the byte stream beneath
+    the UTF-8 writer that the backend puts around stdout.
+    '''
+
+    def __init__(self, max_lines=500, max_delay=0.1, check_lines=32):
+        SignalEmitter.__init__(self)
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.check_lines = check_lines
+        self._lines = []
+        self._first_queued = 0
+
+    def emit(self, line):
+        if not self._lines:
+            self._first_queued = time.time()
+        self._lines.append(_to_utf8(line) + '\n')
+        queued = len(self._lines)
+        if queued >= self.max_lines or \
+           (queued % self.check_lines == 0 and
+            time.time() - self._first_queued > self.max_delay):
+            self.flush()
+
+    def emit_state(self, line):
+        self._lines.append(_to_utf8(line) + '\n')
+        self.flush()
+
+    def flush(self):
+        if not self._lines:
+            return
+        data = ''.join(self._lines)
+        self._lines = []
+        stream = sys.stdout
+        if isinstance(stream, codecs.StreamWriter):
+            # the data is UTF-8 already, don't let the writer encode it again
+            stream = stream.stream
+        stream.write(data)
+        stream.flush()
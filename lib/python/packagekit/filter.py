@@ -21,7 +21,20 @@
 # imports
 from .enums import *
 from .package import PackagekitPackage
-import collections
+
+# filter -> (package flag, wanted value of the flag)
+_FILTER_FLAGS = {
+    FILTER_GUI : ('gui', True),
+    FILTER_NOT_GUI : ('gui', False),
+    FILTER_DEVELOPMENT : ('devel', True),
+    FILTER_NOT_DEVELOPMENT : ('devel', False),
+    FILTER_FREE : ('free', True),
+    FILTER_NOT_FREE : ('free', False),
+    FILTER_ARCH : ('arch', True),
+    FILTER_NOT_ARCH : ('arch', False),
+    FILTER_INSTALLED : ('installed', True),
+    FILTER_NOT_INSTALLED : ('installed', False),
+}
 
 class PackagekitFilter(object, PackagekitPackage):
 
@@ -31,6 +44,10 @@ class PackagekitFilter(object, PackagekitPackage):
         self.package_list = [] #we can't do emitting as found if we are post-processing
         self.installed_unique = {}
 
+        # work out the checks once, rather than for every package
+        self._base_checks = self._compile_checks(('gui', 'devel', 'free', 'arch'))
+        self._installed_checks = self._compile_checks(('installed',))
+
     def add_installed(self, pkgs):
         ''' add a list of packages that are already installed '''
         for pkg in pkgs:
@@ -45,29 +62,41 @@ class PackagekitFilter(object, PackagekitPackage):
         ''' add a custom packages indervidually '''
         self.package_list.append((pkg, info))
 
+    def _compile_checks(self, flags):
+        '''
+        Returns a list of (predicate, wanted value) for the filters in
+        fltlist that test one of the given package flags
+        '''
+        checks = []
+        for flt in self.fltlist:
+            if flt not in _FILTER_FLAGS:
+                continue
+            flag, want = _FILTER_FLAGS[flt]
+            if flag in flags:
+                checks.append((self._get_flag_predicate(flag), want))
+        return checks
+
+    def _get_flag_predicate(self, flag):
+        '''
+        Returns a function that takes a package and returns the value of the
+        flag ('gui', 'devel', 'free', 'arch' or 'installed') for it.
+        Override in a sub class to supply something cheaper than the
+        _pkg_is_* methods, e.g. a lookup of flags that are already known.
+        '''
+        return getattr(self, '_pkg_is_%s' % flag)
+
     def _filter_base(self, pkg):
         ''' do extra filtering (gui, devel etc) '''
-        for flt in self.fltlist:
-            if flt in (FILTER_GUI, FILTER_NOT_GUI):
-                if not self._do_gui_filtering(flt, pkg):
-                    return False
-            elif flt in (FILTER_DEVELOPMENT, FILTER_NOT_DEVELOPMENT):
-                if not self._do_devel_filtering(flt, pkg):
-                    return False
-            elif flt in (FILTER_FREE, FILTER_NOT_FREE):
-                if not self._do_free_filtering(flt, pkg):
-                    return False
-            elif flt in (FILTER_ARCH, FILTER_NOT_ARCH):
-                if not self._do_arch_filtering(flt, pkg):
-                    return False
+        for predicate, want in self._base_checks:
+            if predicate(pkg) != want:
+                return False
         return True
 
     def _filter_installed(self, pkg):
         ''' do extra filtering (gui, devel etc) '''
-        for flt in self.fltlist:
-            if flt in (FILTER_INSTALLED, FILTER_NOT_INSTALLED):
-                if not self._do_installed_filtering(flt, pkg):
-                    return False
+        for predicate, want in self._installed_checks:
+            if predicate(pkg) != want:
+                return False
         return True
 
     def get_package_list(self):
@@ -75,30 +104,27 @@ class PackagekitFilter(object, PackagekitPackage):
         do filtering we couldn't do when generating the list
         '''
 
-        # filter common things here like architecture
+        # filter common things here like architecture, and prepare a lookup
+        # table of installed packages
         # NOTE: we can't do installed and ~installed here as we need
         # this data for the newest and downgrade checks below
-        package_list = self.package_list
-        self.package_list = []
-        for pkg, state in package_list:
-            if self._filter_base(pkg):
-                self.package_list.append((pkg, state))
-
-        # prepare lookup table of installed packages
-        installed_dict = collections.defaultdict(list)
+        package_list = []
+        installed_dict = {}
         for pkg, state in self.package_list:
+            if not self._filter_base(pkg):
+                continue
+            package_list.append((pkg, state))
             if state is INFO_INSTALLED:
-                installed_dict[self._pkg_get_name(pkg)].append(pkg)
+                installed_dict.setdefault(self._pkg_get_name(pkg), []).append(pkg)
 
         # check there are not available versions in the package list
-        # that are older than the installed version
-        package_list = self.package_list
+        # that are older than the installed version, and filter
+        # installed state last
         self.package_list = []
         for pkg, state in package_list:
-
-            add = True
-            if state is INFO_AVAILABLE:
-                for pkg_tmp in installed_dict[self._pkg_get_name(pkg)]:
+            if state is INFO_AVAILABLE and installed_dict:
+                add = True
+                for pkg_tmp in installed_dict.get(self._pkg_get_name(pkg), ()):
                     rc = self._pkg_compare(pkg, pkg_tmp)
 
                     # don't add if the same as the installed package
@@ -106,14 +132,8 @@ class PackagekitFilter(object, PackagekitPackage):
                     if rc == 0 or rc == -1:
                         add = False
                         break
-
-            if add:
-                self.package_list.append((pkg, state))
-
-        # filter installed state last
-        package_list = self.package_list
-        self.package_list = []
-        for pkg, state in package_list:
+                if not add:
+                    continue
             if self._filter_installed(pkg):
                 self.package_list.append((pkg, state))
 
@@ -181,43 +201,3 @@ class PackagekitFilter(object, PackagekitPackage):
         '''
         return True
 
-    def _do_installed_filtering(self, flt, pkg):
-        is_installed = self._pkg_is_installed(pkg)
-        if flt == FILTER_INSTALLED:
-            want_installed = True
-        else:
-            want_installed = False
-        return is_installed == want_installed
-
-    def _do_devel_filtering(self, flt, pkg):
-        is_devel = self._pkg_is_devel(pkg)
-        if flt == FILTER_DEVELOPMENT:
-            want_devel = True
-        else:
-            want_devel = False
-        return is_devel == want_devel
-
-    def _do_gui_filtering(self, flt, pkg):
-        is_gui = self._pkg_is_gui(pkg)
-        if flt == FILTER_GUI:
-            want_gui = True
-        else:
-            want_gui = False
-        return is_gui == want_gui
-
-    def _do_free_filtering(self, flt, pkg):
-        is_free = self._pkg_is_free(pkg)
-        if flt == FILTER_FREE:
-            want_free = True
-        else:
-            want_free = False
-        return is_free == want_free
-
-    def _do_arch_filtering(self, flt, pkg):
-        is_arch = self._pkg_is_arch(pkg)
-        if flt == FILTER_ARCH:
-            want_arch = True
-        else:
-            want_arch = False
-        return is_arch == want_arch
-